@@ -8,6 +8,9 @@ import shutil
 import zipfile
 import subprocess
 import argparse
+import hashlib
+import json
+import sys
 
 from getpass import getuser
 from os.path import join
@@ -24,6 +27,15 @@ SAVE_DIR = 'Server-Automation-Setup-master'
 INSTALL_DIR = ''
 BIN_LOCATION = ''
 INSTALL_COMMAND = 'python3 -m pip install .'
+WHEEL_COMMAND = 'python3 -m pip wheel . --wheel-dir'
+# Downloaded into the wheelhouse so we can bootstrap pip on boxes that don't have it
+BOOTSTRAP_WHEELS = ['pip', 'setuptools', 'wheel']
+MANIFEST_FILE = 'wheelhouse.json'
+INSTALLED_STATE_FILE = 'installed-wheels.json'
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--build-wheelhouse', help='Download the tool and all its dependencies as wheels into this directory, for use with --wheelhouse later')
+parser.add_argument('--wheelhouse', help='Install from a wheelhouse directory built with --build-wheelhouse. No network access required')
 
 def _install_pip():
     print('Downloading Pip')
@@ -33,7 +45,108 @@ def _install_pip():
     run(['python3', join(TEMP_DIR, PIP_FILE)])
 
 
+def _sha256(file_path):
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as wheel:
+        for chunk in iter(lambda: wheel.read(1 << 20), b''):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
+
+def _parse_wheel_name(wheel_file):
+    # Wheel file names are {name}-{version}(-{build})?-{python}-{abi}-{platform}.whl
+    name, version = wheel_file.split('-')[0:2]
+    return name.replace('_', '-').lower(), version
+
+def _installed_version(name):
+    try:
+        from importlib import metadata
+        return metadata.version(name)
+    except Exception:
+        return None
+
+def _download_source():
+    print('Downloading latest version from git')
+    with urllib.request.urlopen(GIT_URL) as response, open(join(TEMP_DIR, OUTPUT_ZIP), 'wb') as out_file:
+        copyfileobj(response, out_file)
+
+    repo_zip = zipfile.ZipFile(join(TEMP_DIR, OUTPUT_ZIP), 'r')
+    repo_zip.extractall(TEMP_DIR)
+    repo_zip.close()
+
+    os.chdir(join(TEMP_DIR, SAVE_DIR))
+    os.rename('base-setup.py', 'setup.py')
+    file = open('serverautomation/__init__.py', 'w')
+    file.close()
+
+def _build_wheelhouse(wheelhouse):
+    wheelhouse = os.path.abspath(wheelhouse)
+    os.makedirs(wheelhouse, exist_ok=True)
+    _download_source()
+
+    print(f'Building wheels into {wheelhouse}')
+    run(WHEEL_COMMAND.split(' ') + [wheelhouse], check=True)
+    run(['python3', '-m', 'pip', 'download', '--only-binary=:all:', '--dest', wheelhouse] + BOOTSTRAP_WHEELS, check=True)
+
+    wheels = []
+    for wheel_file in sorted(os.listdir(wheelhouse)):
+        if not wheel_file.endswith('.whl'):
+            continue
+        name, version = _parse_wheel_name(wheel_file)
+        wheels.append(dict(
+            file=wheel_file,
+            name=name,
+            version=version,
+            sha256=_sha256(join(wheelhouse, wheel_file)),
+            bootstrap=name in BOOTSTRAP_WHEELS
+        ))
+    with open(join(wheelhouse, MANIFEST_FILE), 'w') as manifest:
+        json.dump(dict(wheels=wheels), manifest, indent=4)
+    print(f'Wheelhouse ready. Copy {wheelhouse} to your offline box and run this script with --wheelhouse {wheelhouse}')
+
+def _install_from_wheelhouse(wheelhouse):
+    wheelhouse = os.path.abspath(wheelhouse)
+    with open(join(wheelhouse, MANIFEST_FILE)) as manifest:
+        wheels = json.load(manifest)['wheels']
+
+    print('Verifying wheelhouse')
+    for wheel in wheels:
+        if _sha256(join(wheelhouse, wheel['file'])) != wheel['sha256']:
+            raise Exception(f"Checksum mismatch for {wheel['file']}. Refusing to install from a corrupted wheelhouse")
+
+    output = run(['python3', '-m', 'pip', '--version'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if output.returncode != 0:
+        print('Unable to find pip. Installing it from the wheelhouse')
+        pip_wheel = [wheel for wheel in wheels if wheel['name'] == 'pip'][0]
+        # A pip wheel can run itself, which is how we install it without the network
+        run(['python3', join(wheelhouse, pip_wheel['file'], 'pip'), 'install', '--no-index', join(wheelhouse, pip_wheel['file'])], check=True)
+
+    installed_state_file = join(INSTALL_DIR, INSTALLED_STATE_FILE)
+    installed_state = {}
+    if os.path.exists(installed_state_file):
+        with open(installed_state_file) as state:
+            installed_state = json.load(state)
+
+    to_install = []
+    for wheel in wheels:
+        if wheel['bootstrap']:
+            continue
+        if installed_state.get(wheel['file']) == wheel['sha256'] and _installed_version(wheel['name']) == wheel['version']:
+            print(f"{wheel['name']} {wheel['version']} already installed. Skipping")
+            continue
+        to_install.append(wheel)
+
+    if to_install:
+        print('Installing Server Automation Tool')
+        # Every dependency is pinned in the wheelhouse, so there is nothing for pip to resolve
+        run(['python3', '-m', 'pip', 'install', '--no-index', '--no-deps', '--find-links', wheelhouse] + [join(wheelhouse, wheel['file']) for wheel in to_install], check=True)
+        installed_state.update({wheel['file']: wheel['sha256'] for wheel in to_install})
+        os.makedirs(INSTALL_DIR, exist_ok=True)
+        with open(installed_state_file, 'w') as state:
+            json.dump(installed_state, state, indent=4)
+
 def main():
+    global TEMP_DIR, INSTALL_DIR, BIN_LOCATION
+    input_args = parser.parse_args()
     if platform.system() == 'Windows':
         TEMP_DIR = join("C:", "Users", getuser(), 'AppData', 'Local', "tmp")
         raise Exception('Windows install via manual install is not supported at this time')
@@ -45,6 +158,7 @@ def main():
 
     if platform.system() == 'Darwin':
         TEMP_DIR = join("/tmp", "serverautomation")
+        INSTALL_DIR = join("/Users", getuser(), "Library", "serverautomation")
 
     if TEMP_DIR == '':
         raise Exception("Unable to establish OS type!")
@@ -59,23 +173,23 @@ def main():
     except FileExistsError:
         pass
 
+    if input_args.wheelhouse:
+        _install_from_wheelhouse(input_args.wheelhouse)
+        shutil.rmtree(TEMP_DIR)
+        print("Finished! Execute 'serverautomation --help' to get started!")
+        return
+
     output = run(['python3', '-m', 'pip'], stdout=subprocess.DEVNULL)
     if output.returncode == 1 and 'No module named pip' in output.stdout:
         print('Unable to find pip')
         _install_pip()
 
-    print('Downloading latest version from git')
-    with urllib.request.urlopen(GIT_URL) as response, open(join(TEMP_DIR, OUTPUT_ZIP), 'wb') as out_file:
-        copyfileobj(response, out_file)
-
-    repo_zip = zipfile.ZipFile(join(TEMP_DIR, OUTPUT_ZIP), 'r')
-    repo_zip.extractall(TEMP_DIR)
-    repo_zip.close()
+    if input_args.build_wheelhouse:
+        _build_wheelhouse(input_args.build_wheelhouse)
+        shutil.rmtree(TEMP_DIR)
+        return
 
-    os.chdir(join(TEMP_DIR, SAVE_DIR))
-    os.rename('base-setup.py', 'setup.py')
-    file = open('serverautomation/__init__.py', 'w')
-    file.close()
+    _download_source()
 
     print('Installing Server Automation Tool')
     run(INSTALL_COMMAND.split(' '))
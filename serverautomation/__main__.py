@@ -22,6 +22,15 @@ import subprocess
 import pickle
 import datetime
 import platform
+import time
+import shlex
+import signal
+import threading
+import concurrent.futures
+import base64
+import io
+import contextlib
+import functools
 
 try:
     import yaml
@@ -47,33 +56,84 @@ try:
     import invoke
     import invoke.exceptions as invoke_exceptions
     from invoke import Responder
+    from invoke.watchers import StreamWatcher
 except ImportError as exception:
     print("Invoke not installed. Please re-run setup script. 'Execute setupscript.py'")
     raise exception
 
 if _serverautomation_module_available:
-    from serverautomation.configuration import Configuration 
+    from serverautomation.configuration import Configuration, console_prompt
     from serverautomation.distrolayer import DistroAbstractionLayer
+    from serverautomation.sessionproxy import SessionProxy, SUPPORTED as SESSION_PROXY_SUPPORTED
+    from serverautomation.history import StepHistory, format_duration
+    from serverautomation.validation import validate_files
+    from serverautomation.transfer import upload_file, UploadFailed, release_artifacts
+    from serverautomation.resources import ResourceLimits, parse_limits
+    from serverautomation.cassette import Cassette, Recorder, Replayer
+    from serverautomation.relay import ArtifactRelay
+    from serverautomation.sessiond import SessionDaemonClient, ensure_running as ensure_session_daemon, IDLE_TIMEOUT as SESSION_IDLE_TIMEOUT
+    from serverautomation import failures
+    from serverautomation.rules import KEY_TYPES
+    from serverautomation.mirrors import BACKUP_DIRECTORY as MIRROR_BACKUP_DIRECTORY
+    from serverautomation import messages
+    from serverautomation.messages import print
 else:
-    from configuration import Configuration
+    from configuration import Configuration, console_prompt
     from distrolayer import DistroAbstractionLayer
+    from sessionproxy import SessionProxy, SUPPORTED as SESSION_PROXY_SUPPORTED
+    from history import StepHistory, format_duration
+    from validation import validate_files
+    from transfer import upload_file, UploadFailed, release_artifacts
+    from resources import ResourceLimits, parse_limits
+    from cassette import Cassette, Recorder, Replayer
+    from relay import ArtifactRelay
+    from sessiond import SessionDaemonClient, ensure_running as ensure_session_daemon, IDLE_TIMEOUT as SESSION_IDLE_TIMEOUT
+    import failures
+    from rules import KEY_TYPES
+    from mirrors import BACKUP_DIRECTORY as MIRROR_BACKUP_DIRECTORY
+    import messages
+    from messages import print
 from getpass import getpass, getuser
 from random import randint
 from os.path import isfile, join
 
 parser = argparse.ArgumentParser()
-parser.add_argument("-f", "--file", help=f"A Configured Input File (Required). Available Formats are: {_available_formats}")
+parser.add_argument("-f", "--file", nargs='+', help=f"One or more Configured Input Files (Required). Available Formats are: {_available_formats}")
+parser.add_argument("-p", "--parallel", help="How many servers to set up at the same time when more than one file is provided. Default is 1 (with --validate, the number of cpus)", type=int)
+parser.add_argument("--limit", help="How many servers may use a shared resource at once, as name=count (e.g. mirror=4). Can be given more than once", action='append', default=[])
+parser.add_argument("--incremental", help="Only run the steps that changed since the last time this server was set up", action='store_true')
+parser.add_argument("--prune", help="With --incremental, undo steps (users, dependencies) that were removed from the configuration since the last run", action='store_true')
+parser.add_argument("--validate", help="Check the provided files (or directories of files) without connecting to anything, and print any problems as JSON", action='store_true')
 parser.add_argument("-v", "--verbose", help="LOG ALL THE THINGS", action='store_true')
 parser.add_argument("-e", "--onfail", help="How to handle failure. Options are (continue:default, die)")
 parser.add_argument('-d', '--debug', help="When enabled, instead of executing commands on remote server, we simply print them to console.", action='store_true')
+parser.add_argument('--connect-timeout', help="How long (in seconds) to wait for the server to start accepting ssh connections. Default is 300", type=int, default=300)
+parser.add_argument('--timeout', help="Default limit (in seconds) for how long a single step may run. 0 means no limit. Default is 0", type=float, default=0)
+parser.add_argument('--stall-timeout', help="Default limit (in seconds) for how long a step may go without printing anything. 0 means no limit. Default is 0", type=float, default=0)
+parser.add_argument('--reboot-timeout', help="How long (in seconds) to wait for the server to come back after a reboot step. Default is 600", type=int, default=600)
+parser.add_argument('--retries', help="How many times to retry a step that failed for a reason that usually passes (a package manager lock, a network problem). Default depends on the reason (6 for locks, 4 for the network). 0 turns retrying off", type=int)
+parser.add_argument('--relay', help="Have the servers pass big scripts on to each other, instead of us uploading a copy to every server", action='store_true')
+parser.add_argument('--relay-seeds', help="With --relay, how many servers we upload each script to ourselves. Default is 2", type=int, default=2)
+parser.add_argument('--relay-port', help="With --relay, the ssh port the servers reach each other on. Default is the one we connect to", type=int)
+parser.add_argument('--keep-sessions', help=f"Keep the ssh sessions open (in a background process) for the next run against the same servers, closing them after this many seconds of not being used. Default is {SESSION_IDLE_TIMEOUT}", nargs='?', type=int, const=SESSION_IDLE_TIMEOUT, metavar='SECONDS')
+parser.add_argument('--record', help="Record every command sent to the servers (and what came back, and how long it took) into this cassette file")
+parser.add_argument('--replay', help="Answer every command from this cassette file instead of connecting to the servers")
+parser.add_argument('--replay-speed', help="With --replay, how fast to replay. 0 answers immediately, 1 takes as long as the recording did. Default is 0", type=float, default=0)
 
 SUDOPASS_LAMBDA = lambda elevation_password: Responder(
     pattern=r'\[sudo\] password:',
     response=f'{elevation_password}\n'
 )
 
+def make_connect_kwargs(ssh_key, password, passphrase):
+    # Fabric chokes on key_filename=None, so only pass along what we were actually given
+    connect_kwargs = dict(key_filename=ssh_key, password=password, passphrase=passphrase)
+    return {key: value for key, value in connect_kwargs.items() if value is not None}
+
 TMP_PATH = ''
 CACHE_DIR = ''
+# Where we keep track (on the server) of what has been applied to it
+APPLIED_STATE_FILE = '/var/lib/serverautomation/applied-state.json'
 if platform.system() == 'Windows':
     TMP_PATH = os.path.join('C:\\', 'Users', getuser(), 'serverautomation', 'tmp')
     CACHE_DIR = os.path.join('C:\\', 'Users', getuser(), 'serverautomation')
@@ -86,9 +146,307 @@ try:
 except FileExistsError:
     pass
 
+# Runs on the server (as root) to merge ssh keys into authorized_keys. $KEYS$ is replaced with a base64 encoded
+# json dictionary of username to key lines. Keys already present (compared by type and key, not comment) are left alone.
+# Everything in a user's home is done by a child running as that user, so whatever they link their files to, we can't
+# touch anything they couldn't have touched themselves
+KEY_MERGE_SCRIPT = '''
+import base64, json, os, pwd, secrets
+
+def key_id(line):
+    parts = line.split()
+    for index, part in enumerate(parts):
+        if part.startswith($KEY_TYPES$) and index + 1 < len(parts):
+            return part + ' ' + parts[index + 1]
+    return line.strip()
+
+def merge(user, keys):
+    ssh_directory = os.path.join(user.pw_dir, '.ssh')
+    authorized_keys = os.path.join(ssh_directory, 'authorized_keys')
+    if os.path.islink(ssh_directory) or os.path.islink(authorized_keys):
+        raise Exception(f'{ssh_directory} or {authorized_keys} is a symlink. Leaving it alone')
+    if not os.path.exists(ssh_directory):
+        os.mkdir(ssh_directory, 0o700)
+    existing = []
+    if os.path.exists(authorized_keys):
+        with os.fdopen(os.open(authorized_keys, os.O_RDONLY | os.O_NOFOLLOW)) as authorized_keys_file:
+            existing = authorized_keys_file.read().splitlines()
+    present = set(key_id(line) for line in existing if line.strip() and not line.startswith('#'))
+    added = []
+    for key in keys:
+        if key_id(key) not in present:
+            present.add(key_id(key))
+            added.append(key)
+    if added:
+        temporary = f'{authorized_keys}.{secrets.token_hex(8)}'
+        with os.fdopen(os.open(temporary, os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW, 0o600), 'w') as authorized_keys_file:
+            authorized_keys_file.write('\\n'.join(existing + added) + '\\n')
+        os.replace(temporary, authorized_keys)
+    os.chmod(ssh_directory, 0o700)
+    if os.path.exists(authorized_keys):
+        os.chmod(authorized_keys, 0o600)
+    return dict(added=len(added), present=len(keys) - len(added))
+
+def merge_as(user, keys):
+    if not os.path.lexists(user.pw_dir):
+        # A user made without a home. mkdir doesn't follow links, and there was nothing there to follow
+        os.mkdir(user.pw_dir, 0o700)
+        os.lchown(user.pw_dir, user.pw_uid, user.pw_gid)
+    reader, writer = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(reader)
+        try:
+            os.initgroups(user.pw_name, user.pw_gid)
+            os.setgid(user.pw_gid)
+            os.setuid(user.pw_uid)
+            result = merge(user, keys)
+        except Exception as exception:
+            result = dict(error=str(exception))
+        with os.fdopen(writer, 'w') as output:
+            output.write(json.dumps(result))
+        os._exit(0)
+    os.close(writer)
+    with os.fdopen(reader) as output:
+        result = output.read()
+    os.waitpid(pid, 0)
+    return json.loads(result) if result else dict(error='Stopped without saying why')
+
+report = {}
+for username, keys in json.loads(base64.b64decode('$KEYS$').decode('utf-8')).items():
+    try:
+        report[username] = merge_as(pwd.getpwnam(username), keys)
+    except Exception as exception:
+        report[username] = dict(error=str(exception))
+os.remove(__file__)
+print(json.dumps(report))
+'''.replace('$KEY_TYPES$', repr(KEY_TYPES))
+
+# Jump host connections, shared by every server behind the same jump host in this process
+_gateways = {}
+_gateways_lock = threading.Lock()
+
+class StepTimeout(Exception):
+    pass
+
+class ConnectionFailed(Exception):
+    pass
+
+class StepResult:
+    def __init__(self, step_type, step_name, status, duration, failure_reason=None, failure_class=None, retries=0):
+        self.step_type = step_type
+        self.step_name = step_name
+        self.status = status
+        self.duration = duration
+        self.failure_reason = failure_reason
+        # See failures.py. Only set for failed steps
+        self.failure_class = failure_class
+        self.retries = retries
+
+class SetupResult:
+    """
+        What happened to one server. steps holds a StepResult for every step we attempted, in order
+    """
+    def __init__(self, hostname, distro=None, status=None, steps=None, skipped=0, resume_file=None, error=None):
+        self.hostname = hostname
+        self.distro = distro
+        self.status = status
+        self.steps = steps if steps is not None else []
+        self.skipped = skipped
+        self.resume_file = resume_file
+        self.error = error
+
+    @property
+    def succeeded(self):
+        return self.status == Configuration.Config.STATUS_SUCCESS and self.error is None
+
+class ActivityWatcher(StreamWatcher):
+    """
+        Doesn't respond to anything, just keeps track of when the command last printed something
+    """
+    def __init__(self):
+        super().__init__()
+        self.last_output = time.monotonic()
+        self.finished = threading.Event()
+        self.stalled = False
+
+    def submit(self, stream):
+        self.last_output = time.monotonic()
+        return []
+
 class Driver:
     DEBUG = False
     VERBOSE = False
+    CONNECT_TIMEOUT = 300
+    REBOOT_TIMEOUT = 600
+    # How long a timed out step gets to clean up after being asked to stop, before it is killed
+    KILL_GRACE = 10
+    last_failure_reason = None
+    # Why the last step failed (see failures.py), and how many times it was retried
+    last_failure_class = None
+    last_retries = 0
+    # How long (in seconds) the last step's last attempt ran for. Waiting for its resource, failed attempts and
+    # the backoff between them aren't part of it
+    last_attempt_duration = 0
+    # How many times a step that failed for a reason that usually passes is retried. None uses failures.RETRY_POLICY
+    RETRIES = None
+    # Called as prompt(name, message, secret) when a password turns out to be wrong. See configuration.console_prompt
+    prompt = None
+    # Whether what is typed into our stdin is passed along to the commands we run. Embedded runs have nobody typing,
+    # and a closed stdin would otherwise close the command's stdin before the sudo password can be sent
+    FORWARD_STDIN = True
+    # Makes the connections to servers, called the same way as fabric's Connection. See cassette.py for
+    # factories that record a run, or replay one without any servers
+    connection_factory = None
+    # An ArtifactRelay shared by every server being set up, if they should pass big scripts on to each other
+    relay = None
+
+    def connection_config(self):
+        """
+            The fabric configuration our connections get, or None if fabric's defaults will do
+        """
+        overrides = {}
+        if not self.FORWARD_STDIN:
+            overrides['in_stream'] = False
+        if messages.current():
+            # What the steps print goes wherever the rest of the setup's messages do
+            overrides.update(out_stream=messages.current(), err_stream=messages.current())
+        return fabric.Config(overrides=dict(run=overrides)) if overrides else None
+
+    def ask(self, name, message, secret=False):
+        return (self.prompt if self.prompt else console_prompt)(name, message, secret)
+
+    def wait_for_server(self, hostname, port=22, timeout=None, initial_delay=0.5, max_delay=5, gateway=None):
+        """
+            Polls the server until its ssh daemon answers with a banner, backing off between attempts.
+            If gateway (an open jump host connection) is provided, we poll through it.
+            Returns True as soon as the server is ready, and False if timeout (in seconds) passes first
+        """
+        if getattr(self.connection_factory, 'offline', False):
+            # Replayed servers are always up
+            return True
+        deadline = time.monotonic() + (timeout if timeout is not None else self.CONNECT_TIMEOUT)
+        delay = initial_delay
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            try:
+                if gateway:
+                    probe = gateway.transport.open_channel('direct-tcpip', (hostname, int(port)), ('', 0), timeout=max(1, min(remaining, max_delay)))
+                    probe.settimeout(max(1, min(remaining, max_delay)))
+                else:
+                    probe = socket.create_connection((hostname, port), timeout=max(1, min(remaining, max_delay)))
+                with probe:
+                    # Some daemons send a few lines before the banner, so we just look for it in the first chunk
+                    if b'SSH-' in probe.recv(256):
+                        return True
+            except (OSError, ssh_exception.SSHException):
+                # Refused, unreachable, not resolvable yet, or timed out. All of these mean "not yet"
+                pass
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self.VERBOSE:
+                print(f'{hostname} is not accepting ssh connections yet. Retrying in {min(delay, remaining):.1f} seconds')
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, max_delay)
+
+    def get_boot_id(self, server_connection):
+        return server_connection.run('cat /proc/sys/kernel/random/boot_id', hide=True, warn=True).stdout.strip()
+
+    def reboot_and_wait(self, server_connection, command):
+        hostname = server_connection.host
+        if self.DEBUG:
+            print(f'''rm -rf {TMP_PATH}''')
+            print(f'''{command}''')
+            print(f'Waiting for {hostname} to come back up')
+            return True
+
+        try:
+            boot_id = self.get_boot_id(server_connection)
+            server_connection.sudo(f'''rm -rf {TMP_PATH}''', hide=not self.VERBOSE, watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)])
+            print(f'Rebooting {hostname}')
+            server_connection.sudo(f'''{command}''', hide=not self.VERBOSE, warn=True, watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)])
+        except Exception as exception:
+            # The server is allowed to drop us while it goes down
+            if self.VERBOSE:
+                print(exception)
+
+        deadline = time.monotonic() + self.REBOOT_TIMEOUT
+        while True:
+            # Only close our own client. The jump host connection (if there is one) is shared with other servers
+            server_connection.client.close()
+            # Fabric holds on to the sftp session of the old transport, make sure put opens a new one
+            server_connection._sftp = None
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not self.wait_for_server(hostname, server_connection.port, timeout=remaining, gateway=server_connection.gateway):
+                print(f'Timed out waiting for {hostname} to come back from reboot')
+                return False
+            try:
+                server_connection.open()
+                if self.get_boot_id(server_connection) != boot_id:
+                    break
+            except Exception as exception:
+                if self.VERBOSE:
+                    print(exception)
+            # Still the same boot (the server hasn't gone down yet) or it isn't fully up. Try again shortly
+            time.sleep(min(1, max(0, deadline - time.monotonic())))
+
+        print(f'{hostname} is back up. Obtaining sudo privileges')
+        try:
+            server_connection.sudo('cat /dev/null', hide=not self.VERBOSE, watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)])
+        except Exception as exception:
+            print(exception)
+            return False
+        return True
+
+    def get_gateway(self, jump_host):
+        """
+            Returns an open connection to jump_host. Every server behind the same jump host shares it,
+            so we log into the jump host once and each server just gets its own forwarded channel
+        """
+        key = (jump_host['hostname'], jump_host['port'], jump_host['ssh_user'], jump_host['ssh_key'])
+        with _gateways_lock:
+            gateway = _gateways.get(key)
+            if gateway is None:
+                gateway = Connection(
+                    host=jump_host['hostname'],
+                    port=jump_host['port'],
+                    user=jump_host['ssh_user'],
+                    connect_kwargs=make_connect_kwargs(jump_host['ssh_key'], jump_host['ssh_user_password'], jump_host['ssh_key_password'])
+                )
+                _gateways[key] = gateway
+            if not gateway.is_connected:
+                print(f"Connecting to jump host {jump_host['hostname']}")
+                if not self.wait_for_server(gateway.host, gateway.port, timeout=self.CONNECT_TIMEOUT):
+                    raise ConnectionFailed(f"Timed out waiting for jump host \"{jump_host['hostname']}\" to accept ssh connections")
+                gateway.open()
+        return gateway
+
+    def retry_connection(self, config, exception, retry_limit, current_retry_count):
+        delay = failures.retry_delay(failures.NETWORK, current_retry_count - 1, retry_limit - 1)
+        if delay is None:
+            raise ConnectionFailed(f'Unable to connect to "{config.hostname}": {exception}')
+        print(f'Lost the connection to {config.hostname} ({exception}). Trying again in {delay:.1f} seconds')
+        time.sleep(delay)
+        return self.connect_to_server(config, retry_limit=retry_limit, current_retry_count=current_retry_count + 1)
+
+    def reconnect(self, server_connection):
+        """
+            Replaces a dropped connection to the server with a new one. Returns False if the server doesn't come back
+        """
+        server_connection.client.close()
+        server_connection._sftp = None
+        if not self.wait_for_server(server_connection.host, server_connection.port, timeout=self.CONNECT_TIMEOUT, gateway=server_connection.gateway):
+            print(f'Timed out waiting for {server_connection.host} to accept ssh connections again')
+            return False
+        try:
+            server_connection.open()
+        except Exception as exception:
+            print(f'Unable to reconnect to {server_connection.host}: {exception}')
+            return False
+        return True
 
     def connect_to_server(self, config, retry_limit=4, current_retry_count=1):
         hostname = config.hostname
@@ -98,12 +456,28 @@ class Driver:
         password = config.ssh_user_password
         ssh_key = config.ssh_key
         try:
-            # We should be creating the connect_kwargs before hand and adding the key if it was provided
-            server_connection = Connection(host=hostname, user=user, connect_kwargs=dict(key_filename=ssh_key, password=password, passphrase=ssh_key_password))
+            offline = getattr(self.connection_factory, 'offline', False)
+            gateway = self.get_gateway(config.jump_host) if config.jump_host and not offline else None
+            server_connection = (self.connection_factory if self.connection_factory else Connection)(
+                host=hostname,
+                user=user,
+                gateway=gateway,
+                connect_kwargs=make_connect_kwargs(ssh_key, password, ssh_key_password),
+                config=self.connection_config()
+            )
             # Yes, we are saving the elevation password to an object and passing it around. Fight me
             server_connection.sudopass = elevation_password
+            # The session daemon (see --keep-sessions) may still have this server logged in and checked from an earlier run
+            warm_distro = server_connection.attach_session() if hasattr(server_connection, 'attach_session') else None
+            if warm_distro:
+                print(f'Reusing the open session to {hostname}')
+                server_connection.distro = DistroAbstractionLayer(server_connection, distro=warm_distro)
+                return server_connection
             # Checking to make sure we can actually get connected to the server.
             if current_retry_count == 1:
+                print(f'Waiting for {hostname} to accept ssh connections')
+                if not self.wait_for_server(server_connection.host, server_connection.port, timeout=self.CONNECT_TIMEOUT, gateway=gateway):
+                    raise ConnectionFailed(f'Timed out waiting for "{hostname}" to accept ssh connections')
                 print(f'Attempting to connect to {hostname}')
             else:
                 print(f'Attempting to connect to {hostname}. Attempt #{current_retry_count}')
@@ -113,19 +487,21 @@ class Driver:
             server_connection.sudo('cat /dev/null', hide=not self.VERBOSE, watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)])
             print(f'Establishing OS Type')
             server_connection.distro = DistroAbstractionLayer(server_connection)
+            if hasattr(server_connection, 'session_ready'):
+                server_connection.session_ready(server_connection.distro.distro)
 
             return server_connection
         except socket.gaierror:
-            print(f'Unable to reach host "{hostname}"')
-            sys.exit(1)
+            raise ConnectionFailed(f'Unable to reach host "{hostname}"')
         except ssh_exception.PasswordRequiredException:
             if current_retry_count >= retry_limit:
-                print(f'Failed to connect to host "{hostname}" due to some issue other password')
-                sys.exit(1)
+                raise ConnectionFailed(f'Failed to connect to host "{hostname}" due to some issue other password')
 
-            config.ssh_key_pass = None
-            return connect_to_server(
+            # The key is encrypted and we weren't given a password for it
+            config.ssh_key_password = self.ask('ssh_key_password', f'Please enter the password for {config.ssh_key}: ', secret=True)
+            return self.connect_to_server(
                 config,
+                retry_limit=retry_limit,
                 current_retry_count=current_retry_count+1
             )
         except ssh_exception.AuthenticationException as exception:
@@ -133,55 +509,167 @@ class Driver:
             if error == 'No authentication methods available':
                 raise invoke_exceptions.AuthFailure()
             if current_retry_count >= retry_limit:
-                print(f'Failed to connect to host "{hostname}" due to incorrect ssh key password"')
-                sys.exit(1)
+                raise ConnectionFailed(f'Failed to connect to host "{hostname}" due to incorrect ssh key password"')
             
             print('Missing User Password')
-            config.ssh_user_password = getpass(f"Please Enter {config.ssh_user}'s password: ")
-            return connect_to_server(
+            config.ssh_user_password = self.ask('ssh_user_password', f"Please Enter {config.ssh_user}'s password: ", secret=True)
+            return self.connect_to_server(
                 config,
+                retry_limit=retry_limit,
                 current_retry_count=current_retry_count+1
             )
+        except (EOFError, ConnectionError, socket.timeout, ssh_exception.NoValidConnectionsError) as exception:
+            return self.retry_connection(config, exception, retry_limit, current_retry_count)
         except ssh_exception.SSHException as exception:
+            # Garbled or cut off handshakes are the network (or a daemon that is still starting), not a bad password
+            if 'banner' in f'{exception}' or failures.classify_output(f'{exception}') == failures.NETWORK:
+                return self.retry_connection(config, exception, retry_limit, current_retry_count)
             if current_retry_count >= retry_limit:
-                print(f'Failed to connect to host "{hostname}" due to incorrect ssh key password"')
-                sys.exit(1)
+                raise ConnectionFailed(f'Failed to connect to host "{hostname}" due to incorrect ssh key password"')
             
             if config.ssh_user_password:
                 print('Invalid SSH User Password')
             else:
                 print('No User SSH Password Provided')
-            config.ssh_user_password = getpass(f"Please {config.ssh_user}'s SSH Password: ")
-            return connect_to_server(
+            config.ssh_user_password = self.ask('ssh_user_password', f"Please {config.ssh_user}'s SSH Password: ", secret=True)
+            return self.connect_to_server(
                 config,
+                retry_limit=retry_limit,
                 current_retry_count=current_retry_count+1
             )
         except invoke_exceptions.AuthFailure:
             if current_retry_count >= retry_limit:
-                print(f'Failed to obtain administrator permissions on "{hostname}" due to bad sudo password')
-                sys.exit(1)
+                raise ConnectionFailed(f'Failed to obtain administrator permissions on "{hostname}" due to bad sudo password')
 
-            config.elevation_pass = getpass('Incorrect sudo password. Please re-enter sudo password: ')
-            return connect_to_server(
+            config.elevation_pass = self.ask('elevation_password', 'Incorrect sudo password. Please re-enter sudo password: ', secret=True)
+            return self.connect_to_server(
                 config,
+                retry_limit=retry_limit,
                 current_retry_count=current_retry_count+1
             )
 
-    def run_remotely(self, server_connection, command, extra_params, extra_info):
+    def run_step_remotely(self, server_connection, command, timeout=None, stall_timeout=None):
+        """
+            Runs a step with sudo. If a timeout or stall_timeout (seconds without any output) is provided, the step
+            is run under timeout(1) in its own process group, so the whole process tree can be killed when it hangs.
+            Raises StepTimeout if that happens
+        """
+        if not timeout and not stall_timeout:
+            return server_connection.sudo(f'''{command}''', watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)], hide=False)
+
+        pidfile = f'/tmp/serverautomation-step-{randint(0, 1 << 30)}.pid'
+        # timeout(1) puts itself and the step in a new process group and relays any signal it gets to that group,
+        # so we keep its pid around for the watchdog
+        wrapped_command = f'echo $$ > {pidfile}; exec timeout -k {self.KILL_GRACE} {int(timeout or 0)} sh -c {shlex.quote(command)}'
+        activity = ActivityWatcher()
+        if stall_timeout:
+            threading.Thread(target=messages.inherit(self._watch_for_stall), args=(server_connection, activity, stall_timeout, pidfile), daemon=True).start()
+        try:
+            return server_connection.sudo(
+                f'''sh -c {shlex.quote(wrapped_command)}''',
+                watchers=[SUDOPASS_LAMBDA(server_connection.sudopass), activity],
+                hide=False,
+                # Only here in case the server stops talking to us altogether. timeout(1) should always beat it
+                timeout=timeout + 3 * self.KILL_GRACE if timeout else None
+            )
+        except invoke_exceptions.CommandTimedOut:
+            self._kill_remote_step(server_connection, pidfile)
+            raise StepTimeout(f'timed out after {int(timeout)} seconds')
+        except invoke_exceptions.UnexpectedExit as exception:
+            if activity.stalled:
+                raise StepTimeout(f'no output for {int(stall_timeout)} seconds')
+            if timeout and exception.result.return_code == 124:
+                raise StepTimeout(f'timed out after {int(timeout)} seconds')
+            raise
+        finally:
+            activity.finished.set()
+            try:
+                server_connection.sudo(f'''rm -f {pidfile}''', hide=True, warn=True, watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)])
+            except Exception as exception:
+                # Usually the connection is what died. Whatever the step raised matters more than a stray pidfile in /tmp
+                if self.VERBOSE:
+                    print(f'Unable to remove {pidfile}: {exception}')
+
+    def _watch_for_stall(self, server_connection, activity, stall_timeout, pidfile):
+        while not activity.finished.wait(1):
+            if time.monotonic() - activity.last_output > stall_timeout:
+                print(f'No output for {int(stall_timeout)} seconds. Stopping the step')
+                activity.stalled = True
+                self._kill_remote_step(server_connection, pidfile)
+                return
+
+    def _kill_remote_step(self, server_connection, pidfile):
+        try:
+            server_connection.sudo(f'''sh -c 'kill -TERM $(cat {pidfile})' ''', hide=True, warn=True, watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)])
+        except Exception as exception:
+            print(f'Unable to stop the step: {exception}')
+
+    def run_remotely(self, server_connection, command, extra_params, extra_info, timeout=None, stall_timeout=None, step_type=None, hold=None):
+        """
+            Runs a step on the server. If it fails for a reason that usually passes (see failures.py), it is tried
+            again after a backoff, over a new connection if the old one dropped. Returns whether it succeeded.
+            hold (e.g. a ResourceLimits.hold) is entered for every attempt, so the backoff doesn't keep anyone else waiting
+        """
+        self.last_retries = 0
+        self.last_attempt_duration = 0
+        while True:
+            with hold() if hold else contextlib.nullcontext():
+                started = time.monotonic()
+                successful = self._run_remotely_once(server_connection, command, extra_params, extra_info, timeout, stall_timeout, step_type)
+                self.last_attempt_duration = time.monotonic() - started
+            if successful or self.DEBUG:
+                return successful
+            delay = failures.retry_delay(self.last_failure_class, self.last_retries, self.RETRIES)
+            if delay is None:
+                if self.last_retries and self.last_failure_reason is None:
+                    self.last_failure_reason = f'still failing ({self.last_failure_class}) after {self.last_retries} retries'
+                return successful
+            self.last_retries += 1
+            print(f'[{server_connection.host}] Step failed ({self.last_failure_class}). Trying again in {delay:.1f} seconds (retry {self.last_retries})')
+            time.sleep(delay)
+            if not server_connection.is_connected and not self.reconnect(server_connection):
+                return successful
+
+    def _step_failed(self, server_connection, exception, step_type):
+        distro = getattr(getattr(server_connection, 'distro', None), 'distro', None)
+        family = DistroAbstractionLayer.distro_map.get(distro.lower()) if distro else None
+        self.last_failure_class = failures.NETWORK if isinstance(exception, UploadFailed) else failures.classify(exception, family, step_type)
+
+    def _run_remotely_once(self, server_connection, command, extra_params, extra_info, timeout=None, stall_timeout=None, step_type=None):
         successful = False
+        self.last_failure_reason = None
+        self.last_failure_class = None
+        if extra_params == 'reboot_and_wait':
+            return self.reboot_and_wait(server_connection, command)
+        if extra_params == 'deploy_ssh_keys':
+            return self.deploy_ssh_keys(server_connection, extra_info)
         if extra_params and extra_params == 'copy':
             if not self.DEBUG:
                 try:
                     server_connection.sudo(f'''mkdir -p {TMP_PATH}''', hide=not self.VERBOSE, watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)])
                     server_connection.sudo(f'''chown {server_connection.user}:{server_connection.user} {TMP_PATH}''', hide=not self.VERBOSE, watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)])
-                    server_connection.put(extra_info, TMP_PATH)
+                    # Big installer bundles go up in chunks that survive a dropped connection, and nothing runs until it matches our copy
+                    if self.relay:
+                        self.relay.deliver(server_connection, extra_info, TMP_PATH, lambda: upload_file(server_connection, extra_info, TMP_PATH, verbose=self.VERBOSE), verbose=self.VERBOSE)
+                    else:
+                        upload_file(server_connection, extra_info, TMP_PATH, verbose=self.VERBOSE)
                     
-                    server_connection.sudo(f'''{command.replace('$PATH$', TMP_PATH)}''', watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)])
+                    self.run_step_remotely(server_connection, command.replace('$PATH$', TMP_PATH), timeout, stall_timeout)
                     successful = True
+                except StepTimeout as exception:
+                    print(f'Step {exception}')
+                    self.last_failure_reason = f'{exception}'
+                    self._step_failed(server_connection, exception, step_type)
+                except UploadFailed as exception:
+                    print(exception)
+                    self.last_failure_reason = f'{exception}'
+                    self._step_failed(server_connection, exception, step_type)
                 except Exception as exception:
                     print(exception)
-                    if 'already' in exception[0]:
+                    if 'already' in f'{exception}':
                         successful = True
+                    else:
+                        self._step_failed(server_connection, exception, step_type)
             else:
                 print(f'''mkdir -p {TMP_PATH}''')
                 print(f'Copying {extra_info} to {TMP_PATH}')
@@ -192,90 +680,163 @@ class Driver:
                 try:
                     if 'reboot' in command:
                         server_connection.sudo(f'''rm -rf {TMP_PATH}''', hide=not self.VERBOSE, watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)])
-                    server_connection.sudo(f'''{command}''', watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)], hide=False)
+                    self.run_step_remotely(server_connection, command, timeout, stall_timeout)
                     successful = True
+                except StepTimeout as exception:
+                    print(f'Step {exception}')
+                    self.last_failure_reason = f'{exception}'
+                    self._step_failed(server_connection, exception, step_type)
                 except Exception as exception:
-                    if 'already' in exception.result.stderr:
+                    if 'already' in getattr(getattr(exception, 'result', None), 'stderr', ''):
                         successful = True
                     else:
                         print(exception)
+                        self._step_failed(server_connection, exception, step_type)
             else:
                 if 'reboot' in command:
                     print(f'''rm -rf {TMP_PATH}''')
                 print(f'''{command}''')
                 successful = True
-        if extra_params == 'copy_ssh_key':
-            try:
-                user = extra_info
-                print(f'Copying ssh key over to {user.username}')
-                tmp_path = f'/tmp/{user.username}/'
-                output = server_connection.sudo(f'''python3 -c "from os.path import expanduser; print(expanduser('~{user.username}'))"''', hide=not self.VERBOSE, watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)])
-                final_path = f'{output.stdout.rstrip()}/.ssh'
-                path = os.path.normpath(user.ssh_key)
-                ssh_key = path.split(os.sep)[-1]
-
-                if not self.DEBUG:
-                    server_connection.sudo(f'''mkdir -p {tmp_path}''', hide=not self.VERBOSE, watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)])
-                    server_connection.sudo(f'''chown {server_connection.user}:{server_connection.user} {tmp_path}''', hide=not self.VERBOSE, watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)])
-                    server_connection.sudo(f'''mkdir -p {final_path}''', hide=not self.VERBOSE, watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)])
-                    server_connection.put(user.ssh_key, tmp_path)
-                    server_connection.sudo(f'''cp {tmp_path}{ssh_key} {final_path}/authorized_keys''', hide=not self.VERBOSE, watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)])
-                    server_connection.sudo(f'''chmod 700 {final_path}''', hide=not self.VERBOSE, watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)])
-                    server_connection.sudo(f'''chmod 600 {final_path}/authorized_keys''', hide=not self.VERBOSE, watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)])
-                    server_connection.sudo(f'''chown {user.username}:{user.username} {final_path}''', hide=not self.VERBOSE, watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)])
-                    server_connection.sudo(f'''chown {user.username}:{user.username} -R {final_path}''', hide=not self.VERBOSE, watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)])
-                    server_connection.sudo(f'''rm -rf {tmp_path}''', hide=not self.VERBOSE, watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)])
-                else:
-                    print(f'''mkdir -p {tmp_path}''')
-                    print(f'''chown {server_connection.user}:{server_connection.user} {tmp_path}''')
-                    print(f'''mkdir -p {final_path}''')
-                    print(f'''Copying {user.ssh_key} over to server''')
-                    print(f'''cp {tmp_path}{ssh_key} {final_path}/authorized_keys''')
-                    print(f'''chmod 700 {final_path}''')
-                    print(f'''chmod 600 {final_path}/authorized_keys''')
-                    print(f'''chown {user.username}:{user.username} {final_path}''')
-                    print(f'''chown {user.username}:{user.username} -R {final_path}''')
-                    print(f'''rm -rf {tmp_path}''')
-                successful = True
-            except invoke_exceptions.UnexpectedExit as exception:
-                print(f'Unable to copy {user.ssh_key} over to {user.username}')
-                print(exception)
-                if 'already' in exception.result.stderr:
-                    successful = True
-            except Exception as exception:
-                print(f'Unable to copy {user.ssh_key} over to {user.username}')
-                print(exception)
-                successful = False
-
         return successful
 
-    def run_locally(self, server_connection, command, extra_params, extra_info):
+    def run_locally(self, server_connection, command, extra_params, extra_info, timeout=None, stall_timeout=None):
         successful = False
+        self.last_failure_reason = None
+        self.last_failure_class = None
+        self.last_retries = 0
         if not self.DEBUG:
             try:
-                child = subprocess.Popen(command.split(' '), stdout=subprocess.PIPE, shell=True)
-                child.communicate(input=server_connection.sudopass),
-                wait_limit = 10000
-                wait = 0
-                while wait < wait_limit and child.wait() != 0:
-                    wait += 1
-                
-                if wait >= wait_limit:
+                # The script gets its own session so that if it hangs, we can kill everything it started along with it
+                child = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, start_new_session=platform.system() != 'Windows')
+                activity = ActivityWatcher()
+                readers = [
+                    threading.Thread(target=self._read_local_output, args=(child.stdout, messages.stdout() if self.VERBOSE else None, activity), daemon=True),
+                    threading.Thread(target=self._read_local_output, args=(child.stderr, messages.stderr(), activity), daemon=True),
+                ]
+                [reader.start() for reader in readers]
+                deadline = time.monotonic() + timeout if timeout else None
+                while child.poll() is None:
+                    if deadline and time.monotonic() > deadline:
+                        self.last_failure_reason = f'timed out after {int(timeout)} seconds'
+                    elif stall_timeout and time.monotonic() - activity.last_output > stall_timeout:
+                        self.last_failure_reason = f'no output for {int(stall_timeout)} seconds'
+                    if self.last_failure_reason:
+                        print(f'Step {self.last_failure_reason}')
+                        self._kill_local_step(child)
+                        break
+                    time.sleep(0.1)
+                [reader.join(self.KILL_GRACE) for reader in readers]
+
+                if self.last_failure_reason:
+                    successful = False
+                elif child.returncode != 0:
                     print(f'Something happened and we were unable to process {command}')
-                    print(child.stdout)
                     successful = False
                 else:
                     successful = True
             except Exception as exception:
                 print(exception)
                 successful = False
-                if 'already' in exception.stderr.decode('utf-8'):
-                    successful = True
         else:
             print(f'''{command}''')
             successful = True
         return successful
 
+    def _read_local_output(self, stream, echo_to, activity):
+        for line in iter(stream.readline, b''):
+            activity.submit(line)
+            if echo_to:
+                echo_to.write(line.decode('utf-8', errors='replace'))
+                echo_to.flush()
+        stream.close()
+
+    def _kill_local_step(self, child):
+        try:
+            if platform.system() == 'Windows':
+                child.kill()
+            else:
+                os.killpg(child.pid, signal.SIGTERM)
+            child.wait(self.KILL_GRACE)
+        except subprocess.TimeoutExpired:
+            os.killpg(child.pid, signal.SIGKILL)
+            child.wait()
+        except ProcessLookupError:
+            pass
+
+    def read_applied_state(self, server_connection):
+        result = server_connection.sudo(f'''cat {APPLIED_STATE_FILE}''', hide=True, warn=True, watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)])
+        if result.return_code != 0:
+            return {}
+        try:
+            return json.loads(result.stdout)
+        except ValueError:
+            print(f'Unable to read {APPLIED_STATE_FILE} on the server. Treating it as a fresh server')
+            return {}
+
+    def write_applied_state(self, server_connection, applied_state):
+        if self.DEBUG:
+            print(f'Recording {len(applied_state)} applied step(s) in {APPLIED_STATE_FILE}')
+            return
+        # Encoded so we don't have to worry about quoting, and so it all happens in one command
+        encoded_state = base64.b64encode(json.dumps(applied_state).encode('utf-8')).decode('ascii')
+        state_directory = os.path.dirname(APPLIED_STATE_FILE)
+        try:
+            server_connection.sudo(
+                f'''sh -c 'mkdir -p {state_directory} && echo {encoded_state} | base64 -d > {APPLIED_STATE_FILE}.tmp && mv {APPLIED_STATE_FILE}.tmp {APPLIED_STATE_FILE}' ''',
+                hide=True, watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)]
+            )
+        except Exception as exception:
+            print(f'Unable to record applied steps on the server: {exception}')
+
+    def deploy_ssh_keys(self, server_connection, key_bundle):
+        """
+            Merges key_bundle (username to key lines) into every user's authorized_keys. The keys and the script that
+            merges them go over as one file, and run as one command
+        """
+        if self.DEBUG:
+            for username, keys in key_bundle.items():
+                print(f'Merging {len(keys)} ssh key(s) into authorized_keys for {username}')
+            return True
+
+        encoded_keys = base64.b64encode(json.dumps(key_bundle).encode('utf-8')).decode('ascii')
+        successful = True
+        remote_script = None
+        try:
+            # Made by the server, so nobody can have put anything there first
+            remote_script = server_connection.run('mktemp /tmp/serverautomation-keys.XXXXXXXXXX', hide=True).stdout.strip()
+            if not remote_script:
+                raise Exception('mktemp did not make a file for the keys')
+            server_connection.put(io.BytesIO(KEY_MERGE_SCRIPT.replace('$KEYS$', encoded_keys).encode('utf-8')), remote_script)
+            output = server_connection.sudo(f'''python3 {remote_script}''', hide=True, watchers=[SUDOPASS_LAMBDA(server_connection.sudopass)])
+            report = json.loads(output.stdout.strip().splitlines()[-1])
+        except Exception as exception:
+            print(f'Unable to deploy ssh keys: {exception}')
+            if remote_script:
+                server_connection.run(f'''rm -f {remote_script}''', hide=True, warn=True)
+            return False
+
+        for username, result in report.items():
+            if 'error' in result.keys():
+                print(f"Unable to deploy ssh keys for {username}: {result['error']}")
+                successful = False
+            elif result['added']:
+                print(f"Added {result['added']} ssh key(s) for {username} ({result['present']} already present)")
+            elif self.VERBOSE:
+                print(f"All {result['present']} ssh key(s) already present for {username}")
+        return successful
+
+    def share_session(self, server_connection):
+        """
+            Exposes the connection to local scripts over a unix socket, so they don't have to open
+            their own. Returns None if this platform can't do that, in which case local scripts get
+            the connection details on their command line instead
+        """
+        if not SESSION_PROXY_SUPPORTED:
+            return None
+        session_proxy = SessionProxy(server_connection, sudo_watchers=lambda: [SUDOPASS_LAMBDA(server_connection.sudopass)], verbose=self.VERBOSE)
+        server_connection.session_socket = session_proxy.start()
+        return session_proxy
+
 def parse_file(input_file):
     if not input_file:
         raise FileNotFoundError('Input File Not Provided')
@@ -287,51 +848,154 @@ def parse_file(input_file):
         raise FileNotFoundError(f'Input File: {input_file} Not Found')
     return input_file, False
 
-def main():
-    input_args = parser.parse_args()
-    driver = Driver()
-    driver.DEBUG = input_args.debug
-    file, resume = parse_file(input_args.file)
-    driver.VERBOSE = input_args.verbose
-    if input_args.onfail == 'die':
-        die_on_fail = True
-    else:
-        die_on_fail = False
-
+def load_server_setup(input_file, verbose):
+    file, resume = parse_file(input_file)
     if resume:
         with open(file, 'rb') as resume_data:
             server_setup = pickle.load(resume_data)
             server_setup.reset_failures()
         os.remove(file)
     else:
-        server_setup = Configuration(file, driver.VERBOSE)
+        server_setup = Configuration(file, verbose)
+    return server_setup
+
+def make_driver(input_args, connection_factory=None, relay=None):
+    driver = Driver()
+    driver.DEBUG = input_args.debug
+    driver.VERBOSE = input_args.verbose
+    driver.CONNECT_TIMEOUT = input_args.connect_timeout
+    driver.REBOOT_TIMEOUT = input_args.reboot_timeout
+    driver.connection_factory = connection_factory
+    driver.relay = relay
+    driver.RETRIES = input_args.retries
+    return driver
+
+def estimate_remaining(history, connection_info, distro, server_configs):
+    """
+        Returns the expected seconds left, how many steps we had no history for, and how many steps are left
+    """
+    remaining = server_configs.remaining_configs()
+    eta, unknown = history.estimate_all(connection_info.host_class, distro, remaining)
+    # Users still sitting in user sources aren't loaded yet, so they are estimated as a group
+    pending = server_configs.pending_streamed_users()
+    if pending:
+        user_estimate = history.estimate(connection_info.host_class, distro, Configuration.UserConfig.STEP_TYPE)
+        if user_estimate is None:
+            unknown += pending
+        else:
+            eta += pending * user_estimate
+    return eta, unknown, len(remaining) + pending
+
+def expected_duration(history, server_setup):
+    connection_info = server_setup.connection()
+    expected, _, _ = estimate_remaining(history, connection_info, history.known_distro(connection_info.hostname), server_setup.configs())
+    return expected
+
+def report_progress(history, connection_info, dal, server_configs, completed):
+    current = server_configs.current_command
+    # The current command hasn't been marked as running yet, so it is still part of the remaining commands
+    eta, unknown, remaining = estimate_remaining(history, connection_info, dal.distro, server_configs)
+    expected = history.estimate(connection_info.host_class, dal.distro, current.step_type, current.step_name)
+    step = f'{current.step_type} {current.step_name}' if current.step_name else f'{current.step_type}'
+    progress = f'[{connection_info.hostname}] Step {completed + 1}/{completed + remaining}: {step}'
+    if expected is not None:
+        progress += f' (expected {format_duration(expected)})'
+    progress += f'. ETA {format_duration(eta)}'
+    if unknown:
+        progress += f' plus {unknown} step(s) we have no history for'
+    print(progress)
+
+def setup_server(driver, server_setup, die_on_fail, history, incremental=False, prune=False, on_step=None, save_resume=True, resource_limits=None):
+    """
+        Runs every step of server_setup, and returns a SetupResult. on_step, if provided, is called with
+        (hostname, StepResult) as each step finishes. resource_limits (shared by every server being set up)
+        holds steps back while the resource they use is busy. Raises ConnectionFailed if we never got connected
+    """
+    resource_limits = resource_limits if resource_limits else ResourceLimits()
     connection_info = server_setup.connection()
     server_configs = server_setup.configs()
     server_connection = driver.connect_to_server(connection_info)
     dal = server_connection.distro
     print(f'Distro: {dal.distro}')
+    result = SetupResult(connection_info.hostname, distro=dal.distro)
+    history.remember_distro(connection_info.hostname, dal.distro)
+    session_proxy = driver.share_session(server_connection)
+    applied_state = driver.read_applied_state(server_connection)
+    if incremental:
+        skipped, dropped = server_configs.skip_applied(dal, applied_state)
+        result.skipped = skipped
+        print(f'{skipped} step(s) already applied and unchanged. Skipping them')
+        for key in dropped:
+            undo = applied_state[key].get('undo')
+            if prune and undo:
+                print(f'{key} is no longer configured. Undoing it')
+                if driver.run_remotely(server_connection, undo, None, None):
+                    del applied_state[key]
+            elif prune:
+                print(f'{key} is no longer configured, but we have no way to undo it')
+                del applied_state[key]
+    completed = 0
     running = True
-    while running:
-        info = server_configs.get_next_command_info(dal)
-        if info:
-
-            if info.location == 'remote':
-                success = driver.run_remotely(server_connection, info.command, info.extra_params, info.extra_info)
-            else:
-                success = driver.run_locally(server_connection, info.command, info.extra_params, info.extra_info)
-            if success:
-                server_configs.current_command_success()
-            else:
-                server_configs.current_command_failed()
-                if die_on_fail:
+    try:
+        while running:
+            info = server_configs.get_next_command_info(dal)
+            if info:
+                current = server_configs.current_command
+                report_progress(history, connection_info, dal, server_configs, completed)
+                hold = functools.partial(resource_limits.hold, info.resource, f'[{connection_info.hostname}] Waiting for {info.resource}')
+                # Time spent waiting for the resource (or on attempts that failed) isn't the step's fault, so it isn't part of its history
+                if info.location == 'remote':
+                    success = driver.run_remotely(server_connection, info.command, info.extra_params, info.extra_info, info.timeout, info.stall_timeout, current.step_type, hold=hold)
+                    duration = driver.last_attempt_duration
+                else:
+                    with hold():
+                        started = time.monotonic()
+                        success = driver.run_locally(server_connection, info.command, info.extra_params, info.extra_info, info.timeout, info.stall_timeout)
+                    duration = time.monotonic() - started
+                completed += 1
+                if success:
+                    server_configs.current_command_success()
+                    if not driver.DEBUG:
+                        history.record(connection_info.host_class, dal.distro, current.step_type, current.step_name, duration)
+                else:
+                    server_configs.current_command_failed(driver.last_failure_reason)
+                step_result = StepResult(
+                    current.step_type, current.step_name, current.status, duration, current.failure_reason,
+                    failure_class=None if success else driver.last_failure_class, retries=driver.last_retries
+                )
+                result.steps.append(step_result)
+                if on_step:
+                    on_step(connection_info.hostname, step_result)
+                if not success and die_on_fail:
                     break
-            running = True
-        else:
-            running = False
+                running = True
+            else:
+                running = False
+    finally:
+        # A faster mirror is only for this run, unless server_configuration.keep_mirror says otherwise
+        restore_mirror = server_configs.mirror_restore_command(dal)
+        if restore_mirror:
+            print(f'[{connection_info.hostname}] Putting the original package mirror back')
+            try:
+                restored = driver.run_remotely(server_connection, restore_mirror, None, None)
+            except Exception as exception:
+                print(exception)
+                restored = False
+            if not restored:
+                print(f'[{connection_info.hostname}] Unable to put the original package mirror back. It is in {MIRROR_BACKUP_DIRECTORY}')
+        if session_proxy:
+            session_proxy.stop()
+        history.save()
+        # Anything dropped that we didn't undo above is still on the server, so it stays recorded
+        driver.write_applied_state(server_connection, server_configs.applied_state(dal, applied_state, keep_dropped=True))
 
+    result.status = server_configs.status
     if server_configs.status == Configuration.Config.STATUS_FAILURE:
+        if not save_resume:
+            return result
         output_file_name = f'{connection_info.ip_address}-{datetime.datetime.now().strftime("%Y%m%d-%H%M%S")}'
-        output_file = open(os.path.join(CACHE_DIR, f'{output_file_name}.sacfg'), 'wb')
+        result.resume_file = os.path.join(CACHE_DIR, f'{output_file_name}.sacfg')
+        output_file = open(result.resume_file, 'wb')
         pickle.dump(server_setup, output_file)
         output_file.close()
         if platform.system() == 'Windows':
@@ -343,7 +1007,81 @@ def main():
         else:
             print(f'Server Setup completed with errors. To rerun failed scripts, execute the following command. {command}')
     else:
-        print('Server Setup complete!')
+        print(f'Server Setup complete for {connection_info.hostname}!')
+    return result
+
+def main():
+    input_args = parser.parse_args()
+    if not input_args.file:
+        raise FileNotFoundError('Input File Not Provided')
+    if input_args.validate:
+        summary = validate_files(input_args.file, input_args.parallel)
+        print(json.dumps(summary, indent=4))
+        sys.exit(1 if summary['invalid'] else 0)
+    parallel = input_args.parallel if input_args.parallel else 1
+    if input_args.onfail == 'die':
+        die_on_fail = True
+    else:
+        die_on_fail = False
+
+    try:
+        resource_limits = ResourceLimits(parse_limits(input_args.limit))
+    except ValueError as exception:
+        parser.error(f'{exception}')
+    replayer = Replayer(Cassette.load(input_args.replay), speed=input_args.replay_speed) if input_args.replay else None
+    sessions = None
+    if input_args.keep_sessions is not None and not replayer:
+        if not SESSION_PROXY_SUPPORTED:
+            parser.error('--keep-sessions needs unix sockets, which this platform does not have')
+        sessions = SessionDaemonClient(ensure_session_daemon(idle_timeout=input_args.keep_sessions))
+    # Recording a replay gives a cassette to diff against the original
+    recorder = Recorder(factory=replayer if replayer else sessions) if input_args.record else None
+    connection_factory = recorder if recorder else replayer if replayer else sessions
+    try:
+        relay = ArtifactRelay(seeds=input_args.relay_seeds, port=input_args.relay_port) if input_args.relay else None
+    except ValueError as exception:
+        parser.error(f'{exception}')
+    # Replayed timings say nothing about the real servers, so they are kept out of the real history
+    history = StepHistory(os.path.join(CACHE_DIR, 'replay-history.json' if input_args.replay else 'history.json'))
+    # Anything interactive (missing passwords and such) happens here, before we start running things side by side
+    server_setups = [load_server_setup(input_file, input_args.verbose) for input_file in input_args.file]
+    for server_setup in server_setups:
+        server_setup.configs().set_timeouts(dict(default=input_args.timeout, stall=input_args.stall_timeout), override=False)
+
+    try:
+        if len(server_setups) == 1 or parallel <= 1:
+            for server_setup in server_setups:
+                try:
+                    setup_server(make_driver(input_args, connection_factory, relay), server_setup, die_on_fail, history, input_args.incremental, input_args.prune, resource_limits=resource_limits)
+                except ConnectionFailed as exception:
+                    print(exception)
+                    sys.exit(1)
+            return
+
+        # Longest expected work first, so the batch isn't left waiting on one slow server that started last
+        server_setups.sort(key=lambda server_setup: expected_duration(history, server_setup), reverse=True)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel) as executor:
+            futures = {
+                executor.submit(
+                    setup_server, make_driver(input_args, connection_factory, relay), server_setup, die_on_fail, history, input_args.incremental, input_args.prune, resource_limits=resource_limits
+                ): server_setup
+                for server_setup in server_setups
+            }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    future.result()
+                except Exception as exception:
+                    print(f'Unable to set up {futures[future].connection().hostname}: {exception}')
+    finally:
+        if relay:
+            relay.close()
+        release_artifacts()
+        # Whatever happened, keep what we recorded. A recording of a failed run is still worth replaying
+        if recorder:
+            recorder.cassette.save(input_args.record)
+            print(f'Recorded the session into {input_args.record}')
+        if replayer:
+            replayer.report()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -0,0 +1,158 @@
+"""
+    Runs server setups from inside another python program, without going through the command line.
+
+    Nothing here prompts or exits. Anything missing from the config (passwords and such) can be handed in as
+    credentials, and if it is still missing a MissingCredential is raised (unless you provide your own prompt).
+
+        import logging
+        from serverautomation.api import setup
+
+        result = setup(
+            {'server_connection': {'hostname': 'web1', 'ssh_user': 'admin'}, 'dependencies': ['nginx']},
+            credentials={'ssh_user_password': 'hunter2', 'elevation_password': 'hunter2'},
+            on_step=lambda hostname, step: print(hostname, step.step_type, step.status),
+            output=logging.getLogger('web1').info
+        )
+        if not result.succeeded:
+            print([step.failure_reason for step in result.steps if step.failure_reason])
+
+    Everything run from the same process shares the step history and jump host connections. What a setup would print
+    goes to output if you provide it (every line on its own, False for nowhere), and to stdout if you don't.
+"""
+import os.path
+import threading
+import concurrent.futures
+
+# The driver lives in __main__, so unlike the other modules this one only works as part of the installed package
+from serverautomation.__main__ import (
+    Driver, SetupResult, StepResult, ConnectionFailed, StepHistory, CACHE_DIR, setup_server, expected_duration
+)
+from serverautomation.configuration import Configuration, MissingCredential, console_prompt, no_prompt
+from serverautomation.resources import ResourceLimits
+from serverautomation import messages
+from serverautomation.transfer import artifact_scope
+
+_history = None
+_history_lock = threading.Lock()
+
+
+def shared_history():
+    global _history
+    with _history_lock:
+        if _history is None:
+            _history = StepHistory(os.path.join(CACHE_DIR, 'history.json'))
+        return _history
+
+
+def _messages(output):
+    if output is None:
+        return None
+    return messages.Messages(output if output else None)
+
+
+def load(config, credentials=None, prompt=no_prompt, verbose=False):
+    """
+        Turns config (a path to a json/yaml file, or the config itself as a dictionary) into a Configuration.
+        A Configuration is passed through as is
+    """
+    if isinstance(config, Configuration):
+        return config
+    return Configuration(config, verbose, credentials=credentials, prompt=prompt)
+
+
+def setup(
+        config,
+        credentials=None,
+        prompt=no_prompt,
+        on_step=None,
+        die_on_fail=False,
+        incremental=False,
+        prune=False,
+        debug=False,
+        verbose=False,
+        connect_timeout=Driver.CONNECT_TIMEOUT,
+        reboot_timeout=Driver.REBOOT_TIMEOUT,
+        timeout=0,
+        stall_timeout=0,
+        history=None,
+        save_resume=False,
+        resource_limits=None,
+        connection_factory=None,
+        relay=None,
+        retries=None,
+        output=None
+    ):
+    """
+        Sets up one server and returns its SetupResult. The keyword arguments match the command line options.
+        Raises MissingCredential or ConnectionFailed if we can't get onto the server at all.
+        If save_resume is True, a failed run is saved so the command line can pick up where it left off.
+        resource_limits is a ResourceLimits (or a dictionary like {'mirror': 4}). Share one ResourceLimits
+        between calls running at the same time for the limits to cover all of them.
+        connection_factory replaces fabric's Connection, e.g. a cassette.Recorder, a cassette.Replayer, or
+        sessiond.SessionDaemonClient(sessiond.ensure_running()) to keep the sessions open for the next call.
+        relay is a relay.ArtifactRelay shared by the servers that should pass big scripts on to each other (close it when done).
+        output is called with every line the setup prints (what the steps print included), e.g. a logger's info.
+        False drops them, None prints them to stdout
+    """
+    with messages.redirect(_messages(output)):
+        server_setup = load(config, credentials, prompt, verbose)
+        server_setup.configs().set_timeouts(dict(default=timeout, stall=stall_timeout), override=False)
+        driver = Driver()
+        driver.DEBUG = debug
+        driver.VERBOSE = verbose
+        driver.CONNECT_TIMEOUT = connect_timeout
+        driver.REBOOT_TIMEOUT = reboot_timeout
+        driver.prompt = prompt
+        driver.FORWARD_STDIN = False
+        driver.connection_factory = connection_factory
+        driver.relay = relay
+        driver.RETRIES = retries
+        with artifact_scope():
+            return setup_server(
+                driver,
+                server_setup,
+                die_on_fail,
+                history if history else shared_history(),
+                incremental=incremental,
+                prune=prune,
+                on_step=on_step,
+                save_resume=save_resume,
+                resource_limits=resource_limits if isinstance(resource_limits, ResourceLimits) else ResourceLimits(resource_limits)
+            )
+
+
+def setup_many(configs, parallel=4, credentials=None, prompt=no_prompt, **options):
+    """
+        Sets up every server in configs, parallel at a time, and returns their SetupResults in the same order.
+        A server we couldn't get onto doesn't stop the rest, its result just has error set.
+        credentials can be one dictionary for everything, or a list with one per config.
+        Every setup hands its lines to output (see setup) on its own, so they don't get mixed up mid line
+    """
+    credentials = credentials if isinstance(credentials, list) else [credentials] * len(configs)
+    history = options.pop('history', None) or shared_history()
+    resource_limits = options.pop('resource_limits', None)
+    resource_limits = resource_limits if isinstance(resource_limits, ResourceLimits) else ResourceLimits(resource_limits)
+    results = [None] * len(configs)
+    server_setups = []
+    for index, config in enumerate(configs):
+        try:
+            with messages.redirect(_messages(options.get('output'))):
+                server_setups.append((index, load(config, credentials[index], prompt, options.get('verbose', False))))
+        except Exception as exception:
+            results[index] = SetupResult(config if isinstance(config, str) else None, status=Configuration.Config.STATUS_FAILURE, error=exception)
+
+    # Longest expected work first, same as the command line
+    server_setups.sort(key=lambda indexed_setup: expected_duration(history, indexed_setup[1]), reverse=True)
+    # One scope for the lot, so a script going to every server is only mapped and hashed once
+    with artifact_scope(), concurrent.futures.ThreadPoolExecutor(max_workers=max(1, parallel)) as executor:
+        futures = {
+            executor.submit(setup, server_setup, prompt=prompt, history=history, resource_limits=resource_limits, **options): (index, server_setup)
+            for index, server_setup in server_setups
+        }
+        for future in concurrent.futures.as_completed(futures):
+            index, server_setup = futures[future]
+            try:
+                results[index] = future.result()
+            except Exception as exception:
+                results[index] = SetupResult(server_setup.connection().hostname, status=Configuration.Config.STATUS_FAILURE, error=exception)
+    return results
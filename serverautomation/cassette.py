@@ -0,0 +1,441 @@
+#!/usr/bin/env python3
+"""
+    Records what a run sends to its servers (commands, outputs, exit codes and how long each took) into a
+    cassette, and plays cassettes back without any servers at all.
+
+    Recording wraps the real connections, so nothing about the run changes
+
+        serverautomation --file server.yaml --record server.cassette
+
+    Replaying answers every command from the cassette instead of the network, as fast as it can (or at the
+    recorded pace with --replay-speed 1). Record the replay as well, and diff the two cassettes to see what
+    a change did to the number of round trips and the time they took
+
+        serverautomation --file server.yaml --replay server.cassette --record after.cassette
+        python3 -m serverautomation.cassette diff server.cassette after.cassette
+
+    Anything that changes from run to run (temporary file names, the applied state, passwords) is masked
+    before it is stored, and commands are matched on the masked form.
+"""
+import argparse
+import builtins
+import collections
+import gzip
+import io
+import json
+import re
+import socket
+import sys
+import threading
+import time
+
+import invoke.exceptions as invoke_exceptions
+from invoke.runners import Result
+from paramiko import ssh_exception
+
+try:
+    # We prefer using this, but if we are being called directly, this import fails
+    from serverautomation import messages
+except ImportError:
+    import messages
+
+CASSETTE_VERSION = 1
+
+# Parts of commands that are different every run (or secret), and what they are stored as
+VOLATILE_PATTERNS = [
+    (re.compile(r'/tmp/serverautomation-step-\d+\.pid'), '/tmp/serverautomation-step-<ID>.pid'),
+    (re.compile(r'/tmp/serverautomation-keys\.[A-Za-z0-9]+'), '/tmp/serverautomation-keys.<ID>'),
+    (re.compile(r'echo [A-Za-z0-9+/=]+ \| base64 -d'), 'echo <DATA> | base64 -d'),
+    (re.compile(r"crypt\('[^']*'\)"), "crypt('<PASSWORD>')"),
+    (re.compile(r"--password '[^']*'"), "--password '<PASSWORD>'"),
+    # The relay's key for the run (authorized_keys line and host keys passed to fetching servers), and what it's known by
+    (re.compile(r'((?:ssh|ecdsa|sk)-[A-Za-z0-9@.-]+) AAAA[A-Za-z0-9+/=]+'), r'\1 <KEY>'),
+    (re.compile(r'serverautomation-relay-[0-9a-f]+'), 'serverautomation-relay-<ID>'),
+    # Relayed files go by their sha256
+    (re.compile(r'\b[0-9a-f]{64}\b'), '<SHA256>'),
+]
+
+
+def normalize(command):
+    for pattern, replacement in VOLATILE_PATTERNS:
+        command = pattern.sub(replacement, command)
+    return command
+
+
+class CassetteMiss(Exception):
+    pass
+
+
+class Cassette:
+    """
+        Every interaction with every server, in the order they finished
+    """
+    def __init__(self, hosts=None):
+        self.hosts = hosts if hosts else {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        with gzip.open(path, 'rt', encoding='utf-8') as cassette_file:
+            cassette = json.load(cassette_file)
+        if cassette.get('version') != CASSETTE_VERSION:
+            raise Exception(f"{path} is a version {cassette.get('version')} cassette. We only understand version {CASSETTE_VERSION}")
+        return cls(cassette['hosts'])
+
+    def save(self, path):
+        with self._lock:
+            with gzip.open(path, 'wt', encoding='utf-8') as cassette_file:
+                json.dump(dict(version=CASSETTE_VERSION, hosts=self.hosts), cassette_file, separators=(',', ':'))
+
+    def add(self, host, interaction):
+        with self._lock:
+            self.hosts.setdefault(host, []).append(interaction)
+
+    def interactions(self, host):
+        return self.hosts.get(host, [])
+
+
+def _interaction(kind, command, result, elapsed, exception=None):
+    interaction = dict(kind=kind, command=normalize(command), elapsed=round(elapsed, 4))
+    if result is not None:
+        interaction.update(return_code=result.return_code, stdout=result.stdout, stderr=result.stderr)
+    if exception is not None:
+        interaction.update(raised=type(exception).__name__, message=str(exception))
+    return interaction
+
+
+class _RecordingSftp:
+    """
+        Passes an sftp session through, and writes down every file it puts in place (from when it was opened to
+        when it was renamed into place). That's how transfer.py sends big files, a chunk at a time
+    """
+    def __init__(self, sftp, cassette, host):
+        self._sftp = sftp
+        self._cassette = cassette
+        self._host = host
+        self._opened = {}
+
+    def __getattr__(self, attr):
+        return getattr(self._sftp, attr)
+
+    def open(self, path, mode='r', *args, **kwargs):
+        self._opened[path] = time.monotonic()
+        return self._sftp.open(path, mode, *args, **kwargs)
+
+    def posix_rename(self, old_path, new_path):
+        started = self._opened.pop(old_path, time.monotonic())
+        try:
+            result = self._sftp.posix_rename(old_path, new_path)
+        except Exception as exception:
+            self._cassette.add(self._host, _interaction('sftp', new_path, None, time.monotonic() - started, exception))
+            raise
+        self._cassette.add(self._host, dict(kind='sftp', command=normalize(new_path), elapsed=round(time.monotonic() - started, 4)))
+        return result
+
+
+class _RecordingClient:
+    def __init__(self, client, cassette, host):
+        self._client = client
+        self._cassette = cassette
+        self._host = host
+
+    def __getattr__(self, attr):
+        return getattr(self._client, attr)
+
+    def open_sftp(self):
+        return _RecordingSftp(self._client.open_sftp(), self._cassette, self._host)
+
+
+class RecordingConnection:
+    """
+        Passes everything through to the real connection, and writes down what run, sudo, put and sftp did
+    """
+    def __init__(self, connection, cassette, host):
+        object.__setattr__(self, '_connection', connection)
+        object.__setattr__(self, '_cassette', cassette)
+        object.__setattr__(self, '_host', host)
+
+    def __getattr__(self, attr):
+        return getattr(self._connection, attr)
+
+    def __setattr__(self, attr, value):
+        # The driver hangs things like sudopass off the connection, and resets fabric's sftp session after a reboot
+        setattr(self._connection, attr, value)
+
+    def _call(self, kind, command, method, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            result = method(*args, **kwargs)
+        except Exception as exception:
+            self._cassette.add(self._host, _interaction(kind, command, getattr(exception, 'result', None), time.monotonic() - started, exception))
+            raise
+        if kind == 'put':
+            self._cassette.add(self._host, dict(kind=kind, command=normalize(command), elapsed=round(time.monotonic() - started, 4)))
+        else:
+            self._cassette.add(self._host, _interaction(kind, command, result, time.monotonic() - started))
+        return result
+
+    def run(self, command, **kwargs):
+        return self._call('run', command, self._connection.run, command, **kwargs)
+
+    def sudo(self, command, **kwargs):
+        return self._call('sudo', command, self._connection.sudo, command, **kwargs)
+
+    def put(self, local, remote=None, **kwargs):
+        return self._call('put', f'{remote}', self._connection.put, local, remote, **kwargs)
+
+    @property
+    def client(self):
+        return _RecordingClient(self._connection.client, self._cassette, self._host)
+
+
+class _ReplayFile(io.BytesIO):
+    """
+        Where a chunk sent over a replayed sftp session goes. Nowhere, that is
+    """
+    def write(self, data):
+        return len(data)
+
+    def set_pipelined(self, pipelined=True):
+        pass
+
+
+class _ReplaySftp:
+    """
+        Takes the chunks transfer.py sends, and answers for putting them in place from the cassette
+    """
+    def __init__(self, connection):
+        self._connection = connection
+
+    def open(self, path, mode='r', *args, **kwargs):
+        return _ReplayFile()
+
+    def posix_rename(self, old_path, new_path):
+        self._connection._answer('sftp', new_path, hide=True)
+
+    def close(self):
+        pass
+
+
+class _ReplayClient:
+    def __init__(self, connection):
+        self._connection = connection
+
+    def close(self):
+        pass
+
+    def open_sftp(self):
+        return _ReplaySftp(self._connection)
+
+
+class ReplayConnection:
+    """
+        Stands in for a fabric connection, answering from the cassette
+    """
+    def __init__(self, replayer, host, user=None, connect_kwargs=None):
+        self._replayer = replayer
+        self._queues = replayer.queues(host)
+        self.original_host = host
+        hostname, _, port = host.rpartition(':')
+        self.host = hostname if port.isdigit() else host
+        self.port = int(port) if port.isdigit() else 22
+        self.user = user
+        self.connect_kwargs = connect_kwargs if connect_kwargs else {}
+        self.gateway = None
+        self.transport = None
+        self.client = _ReplayClient(self)
+        self.is_connected = True
+        self._sftp = None
+
+    def open(self):
+        self.is_connected = True
+
+    def close(self):
+        self.is_connected = False
+
+    def _answer(self, kind, command, hide=None, warn=False, **kwargs):
+        key = (kind, normalize(command))
+        interaction = self._replayer.next_interaction(self._queues, key)
+        if interaction is None:
+            return Result(command=command, exited=0)
+        if self._replayer.speed:
+            time.sleep(interaction['elapsed'] * self._replayer.speed)
+        result = Result(stdout=interaction.get('stdout', ''), stderr=interaction.get('stderr', ''), command=command, exited=interaction.get('return_code', 0))
+        if hide not in [True, 'both', 'out', 'stdout']:
+            messages.stdout().write(result.stdout)
+        if hide not in [True, 'both', 'err', 'stderr']:
+            messages.stderr().write(result.stderr)
+        if 'raised' in interaction.keys():
+            raise rebuild_exception(interaction, result, kwargs.get('timeout'))
+        if result.return_code != 0 and not warn:
+            raise invoke_exceptions.UnexpectedExit(result)
+        return result
+
+    def run(self, command, **kwargs):
+        return self._answer('run', command, **kwargs)
+
+    def sudo(self, command, **kwargs):
+        return self._answer('sudo', command, **kwargs)
+
+    def put(self, local, remote=None, **kwargs):
+        self._answer('put', f'{remote}', hide=True)
+
+
+def rebuild_exception(interaction, result, timeout=None):
+    """
+        Turns a recorded exception (its class name under raised, and its message) back into something we can raise
+    """
+    name = interaction['raised']
+    if name == 'UnexpectedExit':
+        return invoke_exceptions.UnexpectedExit(result)
+    if name == 'CommandTimedOut':
+        return invoke_exceptions.CommandTimedOut(result, timeout)
+    if name == 'AuthFailure':
+        return invoke_exceptions.AuthFailure(result, None)
+    exception_class = getattr(ssh_exception, name, None) or getattr(socket, name, None) or getattr(builtins, name, None)
+    if isinstance(exception_class, type) and issubclass(exception_class, Exception):
+        try:
+            return exception_class(interaction.get('message', ''))
+        except TypeError:
+            pass
+    return Exception(interaction.get('message', name))
+
+
+class Recorder:
+    """
+        A connection factory (see Driver.connection_factory) that records every connection it makes.
+        factory is what actually makes the connections (fabric's Connection unless told otherwise)
+    """
+    def __init__(self, cassette=None, factory=None):
+        self.cassette = cassette if cassette else Cassette()
+        self._factory = factory
+
+    @property
+    def offline(self):
+        return getattr(self._factory, 'offline', False)
+
+    def __call__(self, host, **kwargs):
+        if self._factory is None:
+            from fabric import Connection
+            self._factory = Connection
+        return RecordingConnection(self._factory(host=host, **kwargs), self.cassette, host)
+
+
+class Replayer:
+    """
+        A connection factory (see Driver.connection_factory) that never touches the network.
+        speed scales the recorded timings (0 answers immediately, 1 takes as long as the recording did).
+        Commands that aren't in the cassette succeed with no output, unless strict is set
+    """
+    offline = True
+
+    def __init__(self, cassette, speed=0, strict=False):
+        self.cassette = cassette
+        self.speed = speed
+        self.strict = strict
+        self.misses = collections.Counter()
+        self._lock = threading.Lock()
+        self._queues = {}
+
+    def queues(self, host):
+        with self._lock:
+            if host not in self._queues.keys():
+                # Commands can run side by side, so they are matched by what they are, in the order they were recorded
+                queues = collections.defaultdict(collections.deque)
+                for interaction in self.cassette.interactions(host):
+                    queues[(interaction['kind'], interaction['command'])].append(interaction)
+                self._queues[host] = queues
+            return self._queues[host]
+
+    def next_interaction(self, queues, key):
+        with self._lock:
+            if queues[key]:
+                return queues[key].popleft()
+            self.misses[key] += 1
+        if self.strict:
+            raise CassetteMiss(f'{key[0]} {key[1]} is not in the cassette')
+        return None
+
+    def unused(self):
+        with self._lock:
+            return sum(len(queue) for queues in self._queues.values() for queue in queues.values())
+
+    def report(self):
+        if self.misses:
+            print(f'{sum(self.misses.values())} command(s) were not in the cassette (answered with success and no output)')
+            for (kind, command), count in self.misses.most_common(10):
+                print(f'    {count} x {kind} {command}')
+        if self.unused():
+            print(f'{self.unused()} recorded command(s) were never sent')
+
+    def __call__(self, host, user=None, connect_kwargs=None, **kwargs):
+        return ReplayConnection(self, host, user, connect_kwargs)
+
+
+def summarize(cassette):
+    """
+        Per host: how many round trips of each kind, and how long they took in total
+    """
+    summary = {}
+    for host, interactions in cassette.hosts.items():
+        summary[host] = dict(
+            round_trips=len(interactions),
+            seconds=sum(interaction['elapsed'] for interaction in interactions),
+            kinds=dict(collections.Counter(interaction['kind'] for interaction in interactions)),
+        )
+    return summary
+
+
+def diff(before, after):
+    """
+        Returns what changed between two cassettes, per host: round trips and time, and which commands were
+        sent more or less often
+    """
+    changes = {}
+    for host in sorted(set(before.hosts.keys()) | set(after.hosts.keys())):
+        before_commands = collections.Counter((interaction['kind'], interaction['command']) for interaction in before.interactions(host))
+        after_commands = collections.Counter((interaction['kind'], interaction['command']) for interaction in after.interactions(host))
+        commands = {
+            f'{kind} {command}': after_commands[(kind, command)] - before_commands[(kind, command)]
+            for kind, command in set(before_commands.keys()) | set(after_commands.keys())
+            if after_commands[(kind, command)] != before_commands[(kind, command)]
+        }
+        changes[host] = dict(
+            round_trips=(len(before.interactions(host)), len(after.interactions(host))),
+            seconds=(
+                sum(interaction['elapsed'] for interaction in before.interactions(host)),
+                sum(interaction['elapsed'] for interaction in after.interactions(host))
+            ),
+            commands=commands,
+        )
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Look at and compare recorded cassettes')
+    subparsers = parser.add_subparsers(dest='action', required=True)
+    summary_parser = subparsers.add_parser('summary', help='Round trips and time per server')
+    summary_parser.add_argument('cassette')
+    diff_parser = subparsers.add_parser('diff', help='What changed between two cassettes')
+    diff_parser.add_argument('before')
+    diff_parser.add_argument('after')
+    input_args = parser.parse_args()
+
+    if input_args.action == 'summary':
+        for host, summary in summarize(Cassette.load(input_args.cassette)).items():
+            kinds = ', '.join(f'{count} {kind}' for kind, count in sorted(summary['kinds'].items()))
+            print(f"{host}: {summary['round_trips']} round trips ({kinds}) taking {summary['seconds']:.2f} seconds")
+        return
+
+    changed = False
+    for host, changes in diff(Cassette.load(input_args.before), Cassette.load(input_args.after)).items():
+        (round_trips_before, round_trips_after), (seconds_before, seconds_after) = changes['round_trips'], changes['seconds']
+        print(f'{host}: {round_trips_before} -> {round_trips_after} round trips, {seconds_before:.2f} -> {seconds_after:.2f} seconds')
+        for command, change in sorted(changes['commands'].items(), key=lambda item: item[1]):
+            print(f'    {change:+d} {command}')
+        changed = changed or round_trips_before != round_trips_after
+    sys.exit(1 if changed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,6 +5,8 @@ import sys
 import getpass
 import invoke
 import platform
+import hashlib
+import itertools
 
 try:
     import yaml
@@ -14,13 +16,48 @@ except ImportError:
 from invoke import Responder
 from getpass import getuser
 
+try:
+    # We prefer using this, but if we are being called directly, this import fails
+    from serverautomation import usersources, mirrors, rules
+    from serverautomation.transfer import get_artifact
+    from serverautomation.messages import print
+except ImportError:
+    import usersources
+    import mirrors
+    import rules
+    from transfer import get_artifact
+    from messages import print
+
 JSON = ['json',]
 YAML = ['yaml' ,'yml']
 
 
+class MissingCredential(Exception):
+    """
+        Raised (by no_prompt) when something we need to connect wasn't provided, and we aren't allowed to ask for it
+    """
+    def __init__(self, name):
+        super().__init__(f'{name} was not provided')
+        self.name = name
+
+
+def console_prompt(name, message, secret=False):
+    """
+        Asks whoever is at the terminal. name is what we are asking for (auth_method, ssh_user, ssh_user_password,
+        ssh_key or elevation_password), so other prompts can answer without parsing message
+    """
+    return getpass.getpass(message) if secret else input(message)
+
+
+def no_prompt(name, message, secret=False):
+    raise MissingCredential(name)
+
+
 class Configuration:
-    VERBOSE = False
     class User:
+        # How a public key (rather than a path to one) starts
+        KEY_TYPES = rules.KEY_TYPES
+
         def __init__(self, username, password=None, user_shell=None, system_user=None, user_groups=None, ssh_key=None, home_directory=None, install_shell_if_missing=True):
             self.username = username
             self.password = password
@@ -32,49 +69,97 @@ class Configuration:
             if isinstance(self.groups, str):
                 self.groups = self.groups.split(',')
 
-            self.ssh_key = ssh_key if (ssh_key is not None and not ssh_key.isspace() and len(ssh_key) > 0) else None
-            
-            if self.ssh_key:
-                if 'default' == self.ssh_key.lower():
-                    current_user = getuser()
-                    if platform.system() == 'Windows':
-                        ssh_key = os.path.join('C:\\', 'Users', current_user, '.ssh', 'id_rsa.pub')
-                    else:
-                        ssh_key = os.path.join('/home', current_user, '.ssh', 'id_rsa.pub')
-                    if os.path.exists(ssh_key):
-                        self.ssh_key = ssh_key
-                    else:
-                        print(f'Unable to default ssh key for user: {current_user}')
-                        self.ssh_key = None
-                elif "/" not in self.ssh_key and "\\" not in self.ssh_key:
-                    current_user = getuser()
-                    if platform.system() == 'Windows':
-                        ssh_key = os.path.join('C:\\', 'Users', current_user, '.ssh', f'{self.ssh_key}.pub')
-                    else:
-                        ssh_key = os.path.join('/home', current_user, '.ssh', f'{self.ssh_key}.pub')
+            # ssh_key can be a single key or a list of them. Each one is either a path/key name, or the public key itself
+            ssh_keys = ssh_key if isinstance(ssh_key, list) else [ssh_key]
+            self.ssh_keys = [
+                resolved_key for resolved_key in (
+                    self.__resolve_ssh_key(key) for key in ssh_keys if key is not None and not key.isspace() and len(key) > 0
+                ) if resolved_key
+            ]
+            # The first key, for anything that only cares about one
+            self.ssh_key = self.ssh_keys[0] if self.ssh_keys else None
+
+        def __resolve_ssh_key(self, ssh_key):
+            if ssh_key.strip().startswith(Configuration.User.KEY_TYPES):
+                return ssh_key.strip()
+            current_user = getuser()
+            if platform.system() == 'Windows':
+                ssh_directory = os.path.join('C:\\', 'Users', current_user, '.ssh')
+            else:
+                ssh_directory = os.path.join('/home', current_user, '.ssh')
+            if 'default' == ssh_key.lower():
+                ssh_key_path = os.path.join(ssh_directory, 'id_rsa.pub')
+                if os.path.exists(ssh_key_path):
+                    return ssh_key_path
+                print(f'Unable to default ssh key for user: {current_user}')
+                return None
+            if "/" not in ssh_key and "\\" not in ssh_key:
+                ssh_key_path = os.path.join(ssh_directory, f'{ssh_key}.pub')
+                if os.path.exists(ssh_key_path):
+                    return ssh_key_path
+                print(f'Unable to ssh key {ssh_key}')
+                return None
+            return ssh_key
+
+        def authorized_keys(self):
+            """
+                Every public key line for this user, read out of key files where needed
+            """
+            key_lines = []
+            for ssh_key in self.ssh_keys:
+                if ssh_key.startswith(Configuration.User.KEY_TYPES):
+                    key_lines.append(ssh_key)
+                    continue
+                with open(ssh_key) as key_file:
+                    key_lines.extend(line.strip() for line in key_file if line.strip() and not line.startswith('#'))
+            return key_lines
 
-                    if os.path.exists(ssh_key):
-                        self.ssh_key = ssh_key
-                    else:
-                        print(f'Unable to ssh key {self.ssh_key}')
-                        self.ssh_key = None
-                if not self.ssh_key.endswith('.pub'):
-                    ssh_key += '.pub'
     class Config:
         STATUS_SUCCESS = 'success'
         STATUS_FAILURE = 'failure'
         STATUS_UNATTEMPTED = 'unattempted'
         STATUS_RUNNING = 'running'
+        # Already applied to the server by a previous run, and unchanged since
+        STATUS_SKIPPED = 'skipped'
+        # What kind of step this is. Used to look up things like timeouts for all steps of a kind
+        STEP_TYPE = None
     
         def __init__(self):
             super().__init__()
             self.status = self.STATUS_UNATTEMPTED
+            self.failure_reason = None
+
+        @property
+        def step_type(self):
+            return self.STEP_TYPE
+
+        @property
+        def step_name(self):
+            return None
+
+        @property
+        def state_key(self):
+            return f'{self.step_type}:{self.step_name}' if self.step_name else f'{self.step_type}'
+
+        def fingerprint(self, dal):
+            """
+                A hash of everything that makes this step what it is. If it matches what the server says was
+                applied last time, the step doesn't need to run again. Must not need to talk to the server
+            """
+            return hashlib.sha256(self.get_run_command(dal).encode('utf-8')).hexdigest()
+
+        def undo_command(self, dal):
+            """
+                The command that reverses this step, if there is one
+            """
+            return None
 
         def get_run_command(self, dal):
             raise NotImplementedError('Get Run Command Should Be Implemented By The Inheriting Class')
 
-        def failed(self):
+        def failed(self, reason=None):
             self.status = self.STATUS_FAILURE
+            self.failure_reason = reason
 
         def success(self):
             self.status = self.STATUS_SUCCESS
@@ -92,11 +177,18 @@ class Configuration:
                 if config.status == Configuration.Config.STATUS_UNATTEMPTED:
                     return config
 
+        def all(self):
+            return list(self.__configs)
+
+        def unattempted(self):
+            return [config for config in self.__configs if config.status == Configuration.Config.STATUS_UNATTEMPTED]
+
         def is_finished(self):
             unattempted_scripts = [config for config in self.__configs if config.status == Configuration.Config.STATUS_UNATTEMPTED]
             return len(unattempted_scripts) == 0
 
     class UserConfig(Config):
+        STEP_TYPE = 'user'
         __GROUPS_PLACEHOLDER = '$GROUPS$'
         __SHELL_PLACEHOLDER = '$SHELL$'
         __PASSWORD_PLACEHOLDER = '$PASSWORD$'
@@ -106,16 +198,37 @@ class Configuration:
             self._user = user
             self.__parse_user_info()
 
+        @property
+        def step_name(self):
+            return self._user.username
+
+        def fingerprint(self, dal):
+            # The rendered command has a freshly salted password in it, so hash what the user asked for instead
+            # Keys are deployed (and tracked) by KeyDistributionConfig, so they don't count here
+            user_definition = {key: value for key, value in self._user.__dict__.items() if key not in ['ssh_key', 'ssh_keys']}
+            return hashlib.sha256(json.dumps(user_definition, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+        def undo_command(self, dal):
+            return f'userdel {self._user.username}'
+
         def get_run_command(self, dal):
-            shell_path = dal.get_program_path(self._user.shell)
+            # None of these depend on each other, so they all go to the server at the same time
+            queries = [dal.program_path_query(self._user.shell)]
+            if self._user.password:
+                queries.append(dal.encrypt_password_query(self._user.password))
+            if self._user.groups:
+                queries.append(dal.groups_query())
+            answers = dal.run_queries(queries)
+            shell_path = answers.pop(0)
             if not shell_path:
                 raise Exception(f'No Path For User Shell {self._user.shell} Found!')
-            password = dal.encrypt_password(self._user.password)
-            self.user_add_command = self.user_add_command.replace(Configuration.UserConfig.__PASSWORD_PLACEHOLDER, password)
+            if self._user.password:
+                password = answers.pop(0)
+                self.user_add_command = self.user_add_command.replace(Configuration.UserConfig.__PASSWORD_PLACEHOLDER, password)
             self.user_add_command = self.user_add_command.replace(Configuration.UserConfig.__SHELL_PLACEHOLDER, shell_path)
 
             if self._user.groups:
-                groups = dal.get_groups_on_server()
+                groups = answers.pop(0)
                 # If you put the wrong admin group, we will attempt to fix it for you
                 admin_groups = ['sudo', 'wheel', 'admin']
                 missing_groups = []
@@ -157,7 +270,7 @@ class Configuration:
             self.user_add_command += self._user.username
 
     class ConnectionConfig(Config):
-        def __init__(self, input_args=None):
+        def __init__(self, input_args=None, prompt=None, verbose=False):
             super().__init__()
             self.ip_address = None
             self.hostname = None
@@ -166,57 +279,84 @@ class Configuration:
             self.ssh_key = None
             self.ssh_key_password = None
             self.elevation_pass = None
+            self.host_class = 'default'
+            self.jump_host = None
             if input_args:
-                self.__parse_input(input_args)
+                self.__parse_input(input_args, verbose)
             else:
                 raise Exception('No Input Provided')
 
-            self._validate_params()
+            # The prompt isn't kept around, the connection config gets pickled when a run fails
+            self._validate_params(prompt if prompt else console_prompt)
 
-        def _validate_params(self):
+        def _validate_params(self, prompt):
             if not self.ssh_user and not self.ssh_key:
-                auth_method = self._get_auth_method('user', 'key')
-                self._validate_auth_method(auth_method)
+                auth_method = self._get_auth_method(prompt, 'user', 'key')
+                self._validate_auth_method(prompt, auth_method)
             if not self.elevation_pass:
-                self.elevation_pass = getpass('Please enter your elevation (sudo) password: ')
-
-        def _get_auth_method(self, *auth_methods, retry_limit=3, retry_count=0):
-            print('No Authentication Method Found. Please enter either "user" or "key" to provide that authentication method')
-            auth_method = input('? ').lower()
-            if auth_method not in auth_methods:
-                if retry_count >= retry_limit:
-                    raise Exception("Invalid Authentication Method Provided")
-                self._get_auth_method(auth_methods, retry_limit, retry_count + 1)
+                self.elevation_pass = prompt('elevation_password', 'Please enter your elevation (sudo) password: ', secret=True)
+
+        def _get_auth_method(self, prompt, *auth_methods, retry_limit=3):
+            for _ in range(retry_limit + 1):
+                auth_method = prompt('auth_method', 'No Authentication Method Found. Please enter either "user" or "key" to provide that authentication method\n? ').lower()
+                if auth_method in auth_methods:
+                    return auth_method
+            raise Exception("Invalid Authentication Method Provided")
         
-        def _validate_auth_method(self, auth_method):
+        def _validate_auth_method(self, prompt, auth_method):
             if auth_method.lower() == 'user':
-                self.ssh_user = input('Please enter username: ')
-                self.ssh_user_password = getpass(f"Please enter {self.ssh_user}'s password: ")
+                self.ssh_user = prompt('ssh_user', 'Please enter username: ')
+                self.ssh_user_password = prompt('ssh_user_password', f"Please enter {self.ssh_user}'s password: ", secret=True)
             if auth_method.lower() == 'key':
-                self.ssh_key = input('Please enter ssh_key path (or enter default to attempt auto retrieval of key): ')
+                self.ssh_key = prompt('ssh_key', 'Please enter ssh_key path (or enter default to attempt auto retrieval of key): ')
 
         def get_run_command(self, dal):
             raise NotImplementedError('Connection Configuration Is Not Runnable')
 
-        def __parse_input(self, input_args):
+        def __parse_input(self, input_args, verbose=False):
             if 'ip_address' in input_args.keys():
                 self.ip_address = input_args['ip_address']
                 self.hostname = self.ip_address
             if 'hostname' in input_args.keys() and self.ip_address is None:
                 self.hostname = input_args['hostname']
                 self.ip_address = self.hostname
+            if 'host_class' in input_args.keys():
+                self.host_class = input_args['host_class']
             if 'ssh_user' in input_args.keys():
                 self.ssh_user = input_args['ssh_user']
             if 'ssh_user_password' in input_args.keys():
                 self.ssh_user_password = input_args['ssh_user_password']
             if 'ssh_key_password' in input_args.keys():
-                self.ssh_key_pass = input_args['ssh_key_password']
+                self.ssh_key_password = input_args['ssh_key_password']
             if 'elevation_password' in input_args.keys():
                 self.elevation_pass = input_args['elevation_password']
             if 'ssh_key' in input_args.keys() or not self.ssh_user:
-                self.__parse_ssh_key(input_args['ssh_key'] if 'ssh_key' in input_args.keys() else None)
-
-        def __parse_ssh_key(self, ssh_key):
+                self.__parse_ssh_key(input_args['ssh_key'] if 'ssh_key' in input_args.keys() else None, verbose)
+            if 'jump_host' in input_args.keys() and input_args['jump_host']:
+                self.__parse_jump_host(input_args['jump_host'])
+
+        def __parse_jump_host(self, jump_host):
+            """
+                jump_host can be either "user@host:port" (user and port optional), or a dictionary with
+                hostname, port, ssh_user, ssh_key, ssh_key_password and ssh_user_password. Anything not
+                provided is the same as what we use for the server itself
+            """
+            if isinstance(jump_host, str):
+                user, _, host = jump_host.rpartition('@')
+                hostname, _, port = host.partition(':')
+                jump_host = dict(hostname=hostname, ssh_user=user if user else None, port=port if port else None)
+            self.jump_host = dict(
+                hostname = jump_host.get('hostname', jump_host.get('ip_address')),
+                port = int(jump_host['port']) if jump_host.get('port') else 22,
+                ssh_user = jump_host.get('ssh_user') or self.ssh_user,
+                ssh_key = jump_host.get('ssh_key') or self.ssh_key,
+                ssh_key_password = jump_host.get('ssh_key_password'),
+                ssh_user_password = jump_host.get('ssh_user_password'),
+            )
+            if not self.jump_host['hostname']:
+                raise Exception('No Hostname provided for jump_host!')
+
+        def __parse_ssh_key(self, ssh_key, verbose=False):
             if ssh_key is None:
                 current_user = getuser()
                 if platform.system() == 'Windows':
@@ -225,37 +365,85 @@ class Configuration:
                     check_ssh_key = os.path.join('/home', current_user, '.ssh', 'id_rsa')
                 if os.path.exists(check_ssh_key):
                     ssh_key = check_ssh_key
-                    if Configuration.VERBOSE:
+                    if verbose:
                         print(f"No ssh key provided. Utilizing {current_user}'s key at {check_ssh_key}")
                 else:
                     ssh_key = None
-                    if Configuration.VERBOSE:
+                    if verbose:
                         print('Unable to find ssh key. We will prompt for password')
             self.ssh_key = ssh_key
 
+    class KeyDistributionConfig(Config):
+        """
+            Merges the ssh keys of a group of users into their authorized_keys, all in one go
+        """
+        STEP_TYPE = 'ssh_keys'
+
+        def __init__(self, users):
+            super().__init__()
+            self._users = [user for user in users if user.ssh_keys]
+
+        def has_keys(self):
+            return len(self._users) > 0
+
+        @property
+        def step_name(self):
+            return f'{len(self._users)} user(s)'
+
+        @property
+        def state_key(self):
+            usernames = ','.join(user.username for user in self._users)
+            return f'{self.step_type}:{hashlib.sha256(usernames.encode("utf-8")).hexdigest()[:16]}'
+
+        def key_bundle(self):
+            return {user.username: user.authorized_keys() for user in self._users}
+
+        def fingerprint(self, dal):
+            return hashlib.sha256(json.dumps(self.key_bundle(), sort_keys=True).encode('utf-8')).hexdigest()
+
+        def get_run_command(self, dal):
+            return f'merge ssh keys into authorized_keys for {", ".join(user.username for user in self._users)}'
+
     class ScriptConfig(Config):
+        STEP_TYPE = 'script'
         PARAMS = [
             'runas',
-            'local'
+            'local',
+            'timeout',
+            'stall_timeout',
+            'resource',
         ]
 
         class Param:
             def __init__(self, param):
                 self.str_param = param
-                self.name = param.split('-')[-1].split('=')[0].lower()
-                try:
-                    self.value = self.str_param.split('=')[1]
-                except IndexError:
-                    self.value = True
+                self.name, self.value = rules.parse_script_param(param)
 
         def __init__(self, script):
             super().__init__()
+            self.definition = script
+            self.params = []
             split_script = script.split(' ')
             self.script = split_script[0]
             if len(split_script) > 1:
                 params = [self.Param(param) for param in split_script if param != self.script and len(param) > 0 and not param.isspace()]
                 self.check_params(params)
 
+        @property
+        def step_name(self):
+            return os.path.normpath(self.script).split(os.sep)[-1]
+
+        @property
+        def state_key(self):
+            return f'{self.step_type}:{self.definition}'
+
+        def fingerprint(self, dal):
+            # The run command for local scripts changes every run (session socket), so hash the definition and the script itself.
+            # Every server with the same definition shares the answer, so the script is only hashed once
+            if os.path.isfile(self.script):
+                return get_artifact(self.script).digest(self.definition.encode('utf-8'))
+            return hashlib.sha256(self.definition.encode('utf-8')).hexdigest()
+
         def check_params(self, params):
             self.params = [param for param in params if param.name not in self.PARAMS]
             for param in params:
@@ -272,7 +460,12 @@ class Configuration:
         def get_run_command(self, dal):
             command = ''
             params = self.get_params()
-            if dal._connection:
+            session_socket = getattr(dal._connection, 'session_socket', None) if dal._connection else None
+            if self.local and session_socket:
+                # The driver shares its connection, so there is no need to hand out credentials
+                params += f' --host={dal._connection.host}'
+                params += f' --session_socket={session_socket}'
+            elif self.local and dal._connection:
                 params += f' --host={dal._connection.host}'
                 params += f' --user={dal._connection.user}'
                 try:
@@ -305,12 +498,31 @@ class Configuration:
             else:
                 return super().__getattr__(attr)
 
+    class RebootConfig(Config):
+        """
+            A reboot in the middle of the run. The driver waits for the server to come back
+            and then carries on with whatever is left
+        """
+        KEYWORD = 'reboot'
+        STEP_TYPE = 'reboot'
+
+        def get_run_command(self, dal):
+            return dal.reboot()
+
     class OptionalConfig(Config):
         def __init__(self, command, param):
             super().__init__()
             self.__command = command
             self.__param = param
 
+        @property
+        def step_type(self):
+            return self.__command.lower()
+
+        @property
+        def step_name(self):
+            return self.__param if isinstance(self.__param, str) else None
+
         def get_run_command(self, dal):
             try:
                 return dal.custom_command(self.__command, self.__param)
@@ -318,26 +530,160 @@ class Configuration:
                 # TODO Implement logging
                 return ''
 
+    class MirrorConfig(Config):
+        """
+            Points the package manager at the fastest of the given mirrors, as measured from the server (see mirrors.py).
+            Runs before anything else that uses the package manager
+        """
+        KEYWORD = 'mirrors'
+        # Set to True to stay on the faster mirror after the run, instead of going back to the original
+        KEEP_KEYWORD = 'keep_mirror'
+        STEP_TYPE = 'mirror'
+
+        def __init__(self, candidates):
+            super().__init__()
+            self.__candidates = candidates
+
+        def fingerprint(self, dal):
+            return hashlib.sha256(json.dumps(self.__candidates, sort_keys=True).encode('utf-8')).hexdigest()
+
+        def undo_command(self, dal):
+            return mirrors.restore_command(dal.distro_map.get(dal.distro.lower()) if dal else None)
+
+        def get_run_command(self, dal):
+            family = dal.distro_map.get(dal.distro.lower())
+            return mirrors.select_command(family, mirrors.candidates_for(self.__candidates, family))
+
     class DependencyConfig(Config):
+        STEP_TYPE = 'install'
+
         def __init__(self, dependency):
             super().__init__()
             self.__dependency = dependency
 
+        @property
+        def step_name(self):
+            return self.__dependency
+
+        def undo_command(self, dal):
+            try:
+                return dal.remove(self.__dependency)
+            except NotImplementedError:
+                return None
+
         def get_run_command(self, dal):
             return dal.install(self.__dependency)
 
+    class UserSource:
+        """
+            Users that live in an external csv or ldif file. They are read as a stream and handed out in
+            chunks of chunk_size, so we never hold more than one chunk of them in memory
+        """
+        DEFAULT_CHUNK_SIZE = 500
+
+        def __init__(self, source, file_format=None, chunk_size=None, defaults=None):
+            self.source = source
+            self.format = usersources.source_format(source, file_format)
+            self.chunk_size = int(chunk_size) if chunk_size else Configuration.UserSource.DEFAULT_CHUNK_SIZE
+            self.defaults = dict(defaults) if defaults else {}
+            if not os.path.exists(self.source):
+                raise Exception(f'Unable to find user source {self.source}')
+            # How many rows (good or bad) we have handed out so far. This is what lets us pick up where we left off
+            self.consumed = 0
+            self.__total = None
+            self.__rows = None
+
+        def __getstate__(self):
+            # Open files don't pickle, we reopen the source at self.consumed when we need it again
+            state = dict(self.__dict__)
+            state['_UserSource__rows'] = None
+            return state
+
+        def rows(self):
+            return usersources.iter_user_rows(self.source, self.format, self.defaults)
+
+        def valid_users(self):
+            for line_number, user, errors in self.rows():
+                if not errors:
+                    yield user
+
+        def chunks(self):
+            """
+                The chunks next_chunk hands out, read from the top of the source. One at a time, like next_chunk
+            """
+            chunk = []
+            for user in self.valid_users():
+                user_info, _ = Configuration.create_user(user)
+                chunk.append(Configuration.UserConfig(user_info))
+                if len(chunk) >= self.chunk_size:
+                    yield chunk
+                    chunk = []
+            if chunk:
+                yield chunk
+
+        def shells(self):
+            shells = set()
+            for user in self.valid_users():
+                _, shell = Configuration.create_user(user)
+                if shell:
+                    shells.add(shell)
+            return shells
+
+        def next_chunk(self):
+            if self.__rows is None:
+                self.__rows = itertools.islice(self.rows(), self.consumed, None)
+            chunk = []
+            for line_number, user, errors in self.__rows:
+                self.consumed += 1
+                if errors:
+                    print(f'Skipping {self.source} line {line_number}: {", ".join(errors)}')
+                    continue
+                user_info, _ = Configuration.create_user(user)
+                chunk.append(Configuration.UserConfig(user_info))
+                if len(chunk) >= self.chunk_size:
+                    break
+            return chunk
+
+        def remaining_count(self):
+            if self.__total is None:
+                self.__total = usersources.count_user_rows(self.source, self.format)
+            return max(0, self.__total - self.consumed)
+
     class ServerConfig(Config):
+        # What users from user sources are recorded as in the applied state, a chunk at a time
+        USER_CHUNK_STEP_TYPE = 'users'
+        # Step types that lean on something every server shares, unless a script says otherwise with --resource
+        DEFAULT_RESOURCES = {
+            'install': 'mirror',
+            'update': 'mirror',
+            'upgrade': 'mirror',
+        }
+
         def __init__(self):
             super().__init__()
             self.__dependency_configs = Configuration.Configs()
             self.__dependency_configs.add_config(Configuration.DependencyConfig('python3'))
             self.__user_configs = Configuration.Configs()
+            self.__user_sources = []
+            # The chunk of users from __user_sources we are working through
+            self.__user_chunk = Configuration.Configs()
+            # What we applied for earlier chunks of users (one entry a chunk), since those chunks are long gone
+            self.__streamed_state = {}
+            # state key: hash of the chunks skip_applied found unchanged
+            self.__applied_chunks = {}
+            # Entries of the applied state for single streamed users (recorded before users were recorded by the chunk,
+            # or after failing and being retried on their own), and the ones of those a recorded chunk now covers
+            self.__streamed_member_keys = set()
+            self.__superseded_keys = set()
             self.__optional_configs = Configuration.Configs()
             self.__external_scripts = Configuration.Configs()
+            self.__mirror_selection = None
+            self.__keep_mirror = False
             self.__update_server = None
             self.__reboot_server = None
             self.__upgrade_server = None
             self.__failed_commands = []
+            self.__timeouts = {}
             self.__current_command_string_form = ''
             self.last_command = None
             self.current_command = None
@@ -345,12 +691,104 @@ class Configuration:
         def add_new_user(self, new_user):
             self.__user_configs.add_config(Configuration.UserConfig(new_user))
 
+        def add_user_key_distribution(self):
+            """
+                Every user's keys go over in one step, once the users exist. Call this after the last add_new_user
+            """
+            key_distribution = Configuration.KeyDistributionConfig([config._user for config in self.__user_configs.all() if isinstance(config, Configuration.UserConfig)])
+            if key_distribution.has_keys():
+                self.__user_configs.add_config(key_distribution)
+
+        def add_user_source(self, user_source):
+            self.__user_sources.append(user_source)
+
+        def __next_streamed_user_config(self):
+            while True:
+                if not self.__user_chunk.is_finished():
+                    return self.__user_chunk.get_next_config()
+                self.__retire_user_chunk()
+                chunk = []
+                for user_source in self.__user_sources:
+                    chunk = user_source.next_chunk()
+                    if chunk:
+                        break
+                if not chunk:
+                    return None
+                chunk = self.__with_key_distribution(chunk)
+                applied = self.__chunk_key(chunk) in self.__applied_chunks.keys()
+                for config in chunk:
+                    if applied:
+                        config.status = self.STATUS_SKIPPED
+                    self.__user_chunk.add_config(config)
+
+        def __next_user_config(self):
+            if not self.__user_configs.is_finished():
+                return self.__user_configs.get_next_config()
+            return self.__next_streamed_user_config()
+
+        def __retire_user_chunk(self):
+            chunk = self.__user_chunk.all()
+            # Only a chunk that went through completely is recorded. Anything else runs again next time
+            if chunk and all(config.status in [self.STATUS_SUCCESS, self.STATUS_SKIPPED] for config in chunk):
+                key = self.__chunk_key(chunk)
+                fingerprint = self.__applied_chunks.pop(key, None) or self.__chunk_fingerprint(chunk)
+                # No undo. Which of its users to take away if the chunk is dropped depends on where the rest went (see skip_applied)
+                self.__streamed_state[key] = dict(hash=fingerprint, users=self.__chunk_usernames(chunk))
+                self.__superseded_keys.update(config.state_key for config in chunk if config.state_key in self.__streamed_member_keys)
+            for config in chunk:
+                if config.status == self.STATUS_FAILURE:
+                    # Failures are kept with the rest of the users, so they can be reset and retried
+                    self.__user_configs.add_config(config)
+            self.__user_chunk = Configuration.Configs()
+
+        @staticmethod
+        def __with_key_distribution(chunk):
+            key_distribution = Configuration.KeyDistributionConfig([config._user for config in chunk])
+            if key_distribution.has_keys():
+                chunk.append(key_distribution)
+            return chunk
+
+        @staticmethod
+        def __chunk_usernames(chunk):
+            return [config._user.username for config in chunk if isinstance(config, Configuration.UserConfig)]
+
+        @staticmethod
+        def __chunk_key(chunk):
+            usernames = ','.join(Configuration.ServerConfig.__chunk_usernames(chunk))
+            return f'{Configuration.ServerConfig.USER_CHUNK_STEP_TYPE}:{hashlib.sha256(usernames.encode("utf-8")).hexdigest()[:16]}'
+
+        @staticmethod
+        def __chunk_fingerprint(chunk):
+            # Rolled up a user at a time, so a chunk costs the same however big its users' definitions are
+            fingerprint = hashlib.sha256()
+            for config in chunk:
+                fingerprint.update(config.fingerprint(None).encode('utf-8'))
+            return fingerprint.hexdigest()
+
+        @staticmethod
+        def __users_undo(usernames):
+            # Users already gone (removed by hand, or by an earlier undo) don't count as a failure
+            return f'''sh -c 'for user in {' '.join(usernames)}; do if id -u "$user" >/dev/null 2>&1; then userdel "$user" || exit 1; fi; done' '''
+
+        def pending_streamed_users(self):
+            """
+                How many users are still waiting in user sources (not counting the current chunk)
+            """
+            return sum(user_source.remaining_count() for user_source in self.__user_sources)
+
         def add_dependency(self, dependency):
             # Excluding this as we are already using it
             if dependency != 'python3':
                 self.__dependency_configs.add_config(Configuration.DependencyConfig(dependency))
 
         def add_optional_configuration(self, additional_configuration_command, additional_configuration_param):
+            if additional_configuration_command.lower() == Configuration.MirrorConfig.KEYWORD:
+                # A list (or mapping of lists) of candidates, all for the one step
+                self.__mirror_selection = Configuration.MirrorConfig(additional_configuration_param)
+                return
+            if additional_configuration_command.lower() == Configuration.MirrorConfig.KEEP_KEYWORD:
+                self.__keep_mirror = rules.parse_boolean(additional_configuration_param, False)
+                return
             if isinstance(additional_configuration_param, list):
                 [self.add_optional_configuration(additional_configuration_command, param) for param in additional_configuration_param]
             optional_config = Configuration.OptionalConfig(additional_configuration_command, additional_configuration_param)
@@ -365,9 +803,171 @@ class Configuration:
                 return
             self.__optional_configs.add_config(optional_config)
 
+        def set_timeouts(self, timeouts, override=True):
+            """
+                timeouts is a dictionary of step type (or 'default'/'stall') to seconds. 0 means no limit.
+                If override is False, only step types that don't have a timeout yet are set
+            """
+            for step_type, seconds in timeouts.items():
+                if seconds is None or (not override and step_type.lower() in self.__timeouts.keys()):
+                    continue
+                self.__timeouts[step_type.lower()] = float(seconds)
+
+        def get_timeouts(self, config):
+            """
+                Returns the (timeout, stall_timeout) for config. Params on the step itself win over the
+                timeout for its step type, which wins over the default
+            """
+            timeout = self.__timeouts.get(config.step_type, self.__timeouts.get('default'))
+            stall_timeout = self.__timeouts.get(f'{config.step_type}_stall', self.__timeouts.get('stall'))
+            if isinstance(config, Configuration.ScriptConfig):
+                if config.timeout:
+                    timeout = float(config.timeout)
+                if config.stall_timeout:
+                    stall_timeout = float(config.stall_timeout)
+            return timeout or None, stall_timeout or None
+
+        def get_resource(self, config):
+            """
+                Returns the name of the shared resource config uses, if any
+            """
+            if isinstance(config, Configuration.ScriptConfig) and config.resource and config.resource is not True:
+                return config.resource
+            return self.DEFAULT_RESOURCES.get(config.step_type)
+
         def add_external_script(self, external_script):
+            if external_script.strip().lower() == Configuration.RebootConfig.KEYWORD:
+                self.__external_scripts.add_config(Configuration.RebootConfig())
+                return
             self.__external_scripts.add_config(Configuration.ScriptConfig(external_script))
 
+        def all_configs(self):
+            configs = [single_config for single_config in [self.__mirror_selection, self.__update_server, self.__upgrade_server] if single_config]
+            for configs_group in [self.__dependency_configs, self.__user_configs, self.__user_chunk, self.__optional_configs, self.__external_scripts]:
+                configs.extend(configs_group.all())
+            if self.__reboot_server:
+                configs.append(self.__reboot_server)
+            return configs
+
+        def _keyed_configs(self):
+            keyed_configs = {}
+            for config in self.all_configs():
+                if config is self.__mirror_selection and not self.__keep_mirror:
+                    # Only for this run (see mirror_restore_command), so there is nothing to record on the server
+                    continue
+                key = config.state_key
+                # The same step can show up more than once (the same script twice, for example)
+                count = 2
+                while key in keyed_configs.keys():
+                    key = f'{config.state_key}#{count}'
+                    count += 1
+                keyed_configs[key] = config
+            return keyed_configs
+
+        def mirror_restore_command(self, dal):
+            """
+                The command that puts the original mirror back at the end of the run, if we switched it and aren't keeping it
+            """
+            if not self.__mirror_selection or self.__keep_mirror or self.__mirror_selection.status != self.STATUS_SUCCESS:
+                return None
+            return self.__mirror_selection.undo_command(dal)
+
+        def skip_applied(self, dal, applied_state):
+            """
+                Marks every step that applied_state says is already on the server (unchanged) as skipped.
+                Reboots (and a mirror we aren't keeping) are only skipped if everything else is. Returns how many steps were skipped, and
+                the keys of steps in applied_state that are no longer in this configuration
+            """
+            keyed_configs = self._keyed_configs()
+            skipped = 0
+            # Users in sources are recorded a chunk at a time, and skipped as their chunk is read. We need to know now
+            # whether any chunk changed, and which entries of applied_state are still theirs. The fingerprints of the
+            # unchanged chunks are kept, so the run doesn't have to work them out again
+            self.__applied_chunks = {}
+            self.__streamed_member_keys = set()
+            streamed_keys = set()
+            streamed_changes = 0
+            # Users of recorded chunks, and which of them are still in a source
+            recorded_users = set()
+            for key, entry in applied_state.items():
+                if key.startswith(f'{self.USER_CHUNK_STEP_TYPE}:'):
+                    recorded_users.update(entry.get('users', []))
+            present_users = set()
+            for user_source in self.__user_sources:
+                for chunk in user_source.chunks():
+                    chunk = self.__with_key_distribution(chunk)
+                    key = self.__chunk_key(chunk)
+                    streamed_keys.add(key)
+                    present_users.update(username for username in self.__chunk_usernames(chunk) if username in recorded_users)
+                    self.__streamed_member_keys.update(config.state_key for config in chunk if config.state_key in applied_state.keys())
+                    fingerprint = self.__chunk_fingerprint(chunk)
+                    if key in applied_state.keys() and applied_state[key]['hash'] == fingerprint:
+                        self.__applied_chunks[key] = fingerprint
+                    else:
+                        streamed_changes += 1
+            streamed_keys.update(self.__streamed_member_keys)
+            for key, config in keyed_configs.items():
+                if config.status != self.STATUS_UNATTEMPTED:
+                    continue
+                if config.step_type == 'reboot':
+                    continue
+                if key in applied_state.keys() and applied_state[key]['hash'] == config.fingerprint(dal):
+                    config.status = self.STATUS_SKIPPED
+                    skipped += 1
+            # A mirror that is only for this run is there to speed up the rest of it. With nothing else to do, we don't need it
+            temporary_mirror = self.__mirror_selection if not self.__keep_mirror else None
+            if not streamed_changes and all(config.step_type == 'reboot' or config is temporary_mirror for config in self.remaining_configs()):
+                for config in self.remaining_configs():
+                    config.status = self.STATUS_SKIPPED
+                    skipped += 1
+            dropped = []
+            for key in applied_state.keys():
+                if key in keyed_configs.keys() or key in streamed_keys:
+                    continue
+                if key.startswith(f'{self.USER_CHUNK_STEP_TYPE}:'):
+                    # Chunks are cut as the source is read, so a user added or removed further up moves everyone after
+                    # them into other chunks. Only the users that left the sources altogether are undone
+                    gone = [username for username in applied_state[key].get('users', []) if username not in present_users]
+                    if not gone:
+                        self.__superseded_keys.add(key)
+                        continue
+                    applied_state[key]['undo'] = self.__users_undo(gone)
+                dropped.append(key)
+            return skipped, dropped
+
+        def applied_state(self, dal, previous_state=None, keep_dropped=False):
+            """
+                What should be recorded on the server as applied after this run. Steps that didn't get a
+                chance to run keep whatever was recorded for them before. If keep_dropped is True, so do
+                steps that are no longer in this configuration
+            """
+            previous_state = previous_state if previous_state else {}
+            keyed_configs = self._keyed_configs()
+            state = {}
+            if keep_dropped:
+                state.update({key: previous for key, previous in previous_state.items() if key not in keyed_configs.keys() and key not in self.__superseded_keys})
+            state.update(self.__streamed_state)
+            for key, config in keyed_configs.items():
+                if config.status in [self.STATUS_SUCCESS, self.STATUS_SKIPPED]:
+                    state[key] = dict(hash=config.fingerprint(dal), undo=config.undo_command(dal))
+                elif config.status == self.STATUS_UNATTEMPTED and key in previous_state.keys():
+                    state[key] = previous_state[key]
+            return state
+
+        def remaining_configs(self):
+            """
+                Every config we have yet to run, in the order get_next_command_info will hand them out
+            """
+            remaining = []
+            for single_config in [self.__mirror_selection, self.__update_server, self.__upgrade_server]:
+                if single_config and single_config.status == Configuration.Config.STATUS_UNATTEMPTED:
+                    remaining.append(single_config)
+            for configs in [self.__dependency_configs, self.__user_configs, self.__user_chunk, self.__optional_configs, self.__external_scripts]:
+                remaining.extend(configs.unattempted())
+            if self.__reboot_server and self.__reboot_server.status == Configuration.Config.STATUS_UNATTEMPTED:
+                remaining.append(self.__reboot_server)
+            return remaining
+
         def get_next_command_info(self, dal):
             self.status = self.STATUS_RUNNING
             config = ''
@@ -380,23 +980,32 @@ class Configuration:
             if self.__upgrade_server and self.__upgrade_server.status == Configuration.Config.STATUS_UNATTEMPTED:
                 config = self.__upgrade_server
 
+            if self.__mirror_selection and self.__mirror_selection.status == Configuration.Config.STATUS_UNATTEMPTED:
+                config = self.__mirror_selection
+
             if not config and not self.__dependency_configs.is_finished():
                 config = self.__dependency_configs.get_next_config()
 
-            if not config and not self.__user_configs.is_finished():
-                config = self.__user_configs.get_next_config()
-                if config._user.ssh_key:
-                    extra_params = 'copy_ssh_key'
-                extra_info = config._user
+            if not config:
+                config = self.__next_user_config()
+                if isinstance(config, Configuration.KeyDistributionConfig):
+                    extra_params = 'deploy_ssh_keys'
+                    extra_info = config.key_bundle()
+                elif config:
+                    extra_info = config._user
+                else:
+                    config = ''
 
             if not config and not self.__optional_configs.is_finished():
                 config = self.__optional_configs.get_next_config()
 
             if not config and not self.__external_scripts.is_finished():
                 config = self.__external_scripts.get_next_config()
-                location = 'local' if config.local else 'remote'
+                location = 'local' if isinstance(config, Configuration.ScriptConfig) and config.local else 'remote'
                 extra_params = None
-                if location == 'remote':
+                if isinstance(config, Configuration.RebootConfig):
+                    extra_params = 'reboot_and_wait'
+                elif location == 'remote':
                     extra_params = 'copy'
                     extra_info = config.script
 
@@ -407,11 +1016,15 @@ class Configuration:
             self.current_command = config
             if self.current_command != '':
                 self.__current_command_string_form = self.current_command.get_run_command(dal)
+                timeout, stall_timeout = self.get_timeouts(self.current_command)
                 return Configuration.ReturnInfo(
-                    command      = self.__current_command_string_form,
-                    location     = location,
-                    extra_params = extra_params,
-                    extra_info   = extra_info
+                    command       = self.__current_command_string_form,
+                    location      = location,
+                    extra_params  = extra_params,
+                    extra_info    = extra_info,
+                    timeout       = timeout,
+                    stall_timeout = stall_timeout,
+                    resource      = self.get_resource(self.current_command)
                 )
             else:
                 if len(self.__failed_commands) > 0:
@@ -420,10 +1033,15 @@ class Configuration:
                     self.status = self.STATUS_SUCCESS
                 return None
 
-        def current_command_failed(self):
-            self.current_command.failed()
+        def current_command_failed(self, reason=None):
+            self.current_command.failed(reason)
             self.__failed_commands.append(self.current_command)
-            print(f'Command Failed: {self.__current_command_string_form}')
+            # In case this is the last step we get to (--onfail die)
+            self.status = self.STATUS_FAILURE
+            if reason:
+                print(f'Command Failed ({reason}): {self.__current_command_string_form}')
+            else:
+                print(f'Command Failed: {self.__current_command_string_form}')
 
         def current_command_success(self):
             self.current_command.success()
@@ -433,17 +1051,24 @@ class Configuration:
                 command.status = self.STATUS_UNATTEMPTED
 
     class ReturnInfo:
-        def __init__(self, command, location, extra_params=None, extra_info=None):
+        def __init__(self, command, location, extra_params=None, extra_info=None, timeout=None, stall_timeout=None, resource=None):
             self.command = command
             self.location = location
+            self.resource = resource
             self.extra_params=extra_params
             self.extra_info=extra_info
-
-    def __init__(self, input_file, verbose=False):
+            self.timeout=timeout
+            self.stall_timeout=stall_timeout
+
+    def __init__(self, input_file, verbose=False, credentials=None, prompt=None):
+        """
+            input_file is either the path to a json/yaml config, or the already loaded config as a dictionary.
+            credentials (a dictionary of server_connection keys, like elevation_password) override whatever the
+            config has, and prompt is called for anything still missing (see console_prompt)
+        """
         self.connection_config = None
         self.server_config = Configuration.ServerConfig()
-        Configuration.VERBOSE = verbose
-        self.__parse_input(input_file)
+        self.__parse_input(input_file, credentials, prompt, verbose)
 
     def connection(self):
         return self.connection_config
@@ -454,10 +1079,9 @@ class Configuration:
     def reset_failures(self):
         self.server_config.reset_failed_commands()
 
-    def __parse_input(self, input_file):
+    def __load(self, input_file):
         if not os.path.exists(input_file):
-            print(f'Unable to open input config {input_file}. Cannot locate file')
-            sys.exit(1)
+            raise FileNotFoundError(f'Unable to open input config {input_file}. Cannot locate file')
 
         connection_setup = None
         extension = input_file.split('.')[-1]
@@ -467,12 +1091,18 @@ class Configuration:
         if extension in YAML:
             with open(input_file) as yaml_data:
                 connection_setup = yaml.safe_load(yaml_data)
+        return connection_setup
+
+    def __parse_input(self, input_file, credentials=None, prompt=None, verbose=False):
+        connection_setup = input_file if isinstance(input_file, dict) else self.__load(input_file)
 
         if not connection_setup:
             raise Exception(f'Unable to load configuration file {input_file}')
 
-        if 'server_connection' in connection_setup.keys():
-            self.connection_config = Configuration.ConnectionConfig(connection_setup['server_connection'])
+        if 'server_connection' in connection_setup.keys() or credentials:
+            server_connection = dict(connection_setup.get('server_connection') or {})
+            server_connection.update(credentials if credentials else {})
+            self.connection_config = Configuration.ConnectionConfig(server_connection, prompt, verbose)
         else:
             self.connection_config = Configuration.ConnectionConfig()
 
@@ -498,46 +1128,59 @@ class Configuration:
                 if 'enable_service' in c.keys():
                     [self.server_config.add_optional_configuration('enable_service', service) for service in c['enable_service']]
                 [self.server_config.add_optional_configuration(command, param) for command, param in c.items() if command != 'enable_service']
+        if 'timeouts' in connection_setup.keys() and connection_setup['timeouts']:
+            self.server_config.set_timeouts(connection_setup['timeouts'])
         if 'configurations' in connection_setup.keys():
             [self.server_config.add_external_script(script) for script in connection_setup['configurations']]
 
+    @staticmethod
+    def create_user(u):
+        """
+            Turns a user definition (from the config, or a user source) into a User. Returns the
+            user, and the shell we should make sure is installed for them (if any)
+        """
+        errors = rules.validate_user(u)
+        if errors:
+            raise Exception(f"Invalid user {u.get('username')}: {', '.join(errors)}")
+        username = u['username']
+        password = u['password'] if 'password' in u.keys() else None
+        shell = u['shell'] if 'shell' in u.keys() else None
+        groups = u['groups'] if 'groups' in u.keys() else None
+        system_user = rules.parse_boolean(u.get('system_user'), False)
+
+        ssh_key = u['ssh_key'] if 'ssh_key' in u.keys() and not system_user else None
+        home_directory = u['home_directory'] if 'home_directory' in u.keys() and not system_user else None
+        # System users don't log in, so they don't need their shell
+        install_shell_if_missing = rules.parse_boolean(u.get('install_shell_if_missing'), True) if not system_user else False
+        user_info = Configuration.User(
+                username=username,
+                password=password,
+                user_shell = shell,
+                system_user = system_user,
+                user_groups = groups,
+                ssh_key = ssh_key,
+                home_directory = home_directory,
+                install_shell_if_missing = install_shell_if_missing,
+            )
+        return user_info, shell if install_shell_if_missing and shell else None
+
     def __create_users(self, users):
         shells = set()
         for u in users:
-            username = u['username']
-            password = u['password'] if 'password' in u.keys() else None
-            shell = u['shell'] if 'shell' in u.keys() else None
-            groups = u['groups'] if 'groups' in u.keys() else None
-            system_user = u['system_user'] if 'system_user' in u.keys() else None
-
-            try:
-                if system_user.lower() == 'false':
-                    system_user = False
-            except Exception:
-                pass
-
-            ssh_key = u['ssh_key'] if 'ssh_key' in u.keys() and not system_user else None
-            home_directory = u['home_directory'] if 'home_directory' in u.keys() and not system_user else None
-            install_shell_if_missing = True if not system_user else False
-            if (
-                    'install_shell_if_missing' in u.keys() and 
-                    not system_user and 
-                    u['install_shell_if_missing'].lower() != 'false' and 
-                    u['install_shell_if_missing'] != '' and 
-                    u['install_shell_if_missing'].isspace()
-                ):
-                install_shell_if_missing = True
-            user_info = Configuration.User(
-                    username=username,
-                    password=password,
-                    user_shell = shell,
-                    system_user = system_user,
-                    user_groups = groups,
-                    ssh_key = ssh_key,
-                    home_directory = home_directory,
-                    install_shell_if_missing = install_shell_if_missing,
+            if 'source' in u.keys():
+                user_source = Configuration.UserSource(
+                    u['source'],
+                    file_format=u.get('format'),
+                    chunk_size=u.get('chunk_size'),
+                    defaults=u.get('defaults')
                 )
-            if install_shell_if_missing and shell:
+                # One pass over the source just for the shells, since dependencies are installed before any user is created
+                shells.update(user_source.shells())
+                self.server_config.add_user_source(user_source)
+                continue
+            user_info, shell = Configuration.create_user(u)
+            if shell:
                 shells.add(shell)
             self.server_config.add_new_user(user_info)
-        return shells
\ No newline at end of file
+        self.server_config.add_user_key_distribution()
+        return shells
@@ -1,10 +1,17 @@
 import subprocess
 import sys
 import invoke
+import concurrent.futures
 
 from subprocess import run as Run
 from invoke.exceptions import UnexpectedExit
 
+try:
+    # We prefer using this, but if we are being called directly, this import fails
+    from serverautomation.messages import print
+except ImportError:
+    from messages import print
+
 class DistroAbstractionLayer:
     _knowndistros = ['ubuntu', 'debian', 'manjaro', 'arch', 'centos', 'raspbian', 'red hat', 'fedora']
     # Maps the known distributions to parent distributions so we dont need to handle
@@ -29,6 +36,7 @@ class DistroAbstractionLayer:
     _command_map = {
         'debian': {
             "install": "apt-get install $INSTALL$ -y",
+            "remove": "apt-get remove $REMOVE$ -y",
             "upgrade": "apt-get upgrade -y",
             "update": "apt-get update -y",
             "hostname": "hostnamectl set-hostname $HOSTNAME$",
@@ -38,6 +46,7 @@ class DistroAbstractionLayer:
 
         'arch': {
             "install": "pacman -Sy $INSTALL$ --noconfirm",
+            "remove": "pacman -R $REMOVE$ --noconfirm",
             "update": "pacman -Syy",
             "upgrade": None,
             "hostname": "hostnamectl set-hostname $HOSTNAME$",
@@ -47,6 +56,7 @@ class DistroAbstractionLayer:
 
         'red hat': {
             "install": "yum install $INSTALL$ -y",
+            "remove": "yum remove $REMOVE$ -y",
             "update": "yum update -y",
             "upgrade": None,
             "hostname": "hostnamectl set-hostname $HOSTNAME$",
@@ -63,7 +73,7 @@ class DistroAbstractionLayer:
 
     _custom_commands = {}
 
-    def __init__(self, remote_connection=None, custom_command_map=None):
+    def __init__(self, remote_connection=None, custom_command_map=None, distro=None):
         """
             we expect if you pass a remote_connection, it is an already connected paramiko connection.
             custom_command_map needs to be a dictionary with the key being the command, and the value being a string
@@ -73,33 +83,28 @@ class DistroAbstractionLayer:
             dict(install="some command $INSTALL$).
 
             Currently, we only allow for single param custom commands. If you need more, you will have to build it yourself.
+
+            If you already know the distro (say, from an earlier look at the same server), pass it as distro and we won't ask the server again.
         """
         self._connection = remote_connection
-        self.distro = self.__get_distro__()
+        self.distro = distro if distro else self.__get_distro__()
         if custom_command_map:
             self._custom_commands = dict(custom_command_map)
 
     def __get_distro__(self):
-        command = None
-        if self._connection:
-            command = lambda command_input: self._connection.run(command_input, hide=True).stdout
-        else:
-            command = lambda command_input: Run(command_input.split(' '), stdout=subprocess.PIPE).stdout.decode('utf-8')
-        success = False
+        # All of the probes go out at once, but we still prefer them in the order they are listed
+        queries = [
+            self._query(command, lambda return_code, output, function=function: function(output) if return_code == 0 else None)
+            for command, function in self.distro_map_commands.items()
+        ]
         distro = None
-        for key, function in self.distro_map_commands.items():
-            if success:
-                break
-            try:
-                distro = function(command(key))
-                if distro.lower() in self._redhat_dumb_map.keys():
-                    distro = self._redhat_dumb_map[distro.lower()]
-                if distro:
-                    success = True
-            except FileNotFoundError:
-                success = False
-            except UnexpectedExit:
-                success = False
+        for probed_distro in self.run_queries(queries):
+            if not probed_distro:
+                continue
+            distro = probed_distro
+            if distro.lower() in self._redhat_dumb_map.keys():
+                distro = self._redhat_dumb_map[distro.lower()]
+            break
 
         if not distro:
             raise Exception('Unknown Distribution Of Linux')
@@ -107,9 +112,60 @@ class DistroAbstractionLayer:
             print(f"We aren't exactly sure how to handle {distro}. We will try out best")
         return distro
 
+    def _query(self, command, parse):
+        """
+            A read only command, and how to turn its (return code, stdout) into an answer
+        """
+        return (command, parse)
+
+    def _run_command(self, command):
+        if self._connection:
+            result = self._connection.run(command, hide=True, warn=True)
+            return result.return_code, result.stdout
+        try:
+            result = Run(command.split(' '), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            return result.returncode, result.stdout.decode('utf-8')
+        except FileNotFoundError:
+            return 127, ''
+
+    def run_queries(self, queries):
+        """
+            Runs independent read only queries at the same time, each on its own channel of the existing
+            connection, so they cost one round trip instead of one each. Returns the parsed answers in order
+        """
+        if not queries:
+            return []
+        if len(queries) == 1:
+            command, parse = queries[0]
+            return [parse(*self._run_command(command))]
+        if self._connection:
+            # Make sure we are connected before the threads race to do it
+            self._connection.open()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(queries)) as executor:
+            outputs = list(executor.map(self._run_command, [command for command, _ in queries]))
+        return [parse(*output) for (_, parse), output in zip(queries, outputs)]
+
+    def groups_query(self):
+        return self._query('cat /etc/group', lambda return_code, output: [group.split(':')[0] for group in output.split('\n')])
+
+    def encrypt_password_query(self, password):
+        input_command = f'''python3 -c "from crypt import crypt; import re; print(crypt('{password}').replace('$',r'$'))"'''
+        return self._query(input_command, lambda return_code, output: output.rstrip())
+
+    def program_path_query(self, program):
+        def parse(return_code, output):
+            if return_code != 0 or output.startswith('which:'):
+                return None
+            output = output.rstrip()
+            return output if output != '' else None
+        return self._query(f'which {program}', parse)
+
     def install(self, package):
         return self._create_command('install', param=package)
 
+    def remove(self, package):
+        return self._create_command('remove', param=package)
+
     def update(self):
         return self._create_command('update')
 
@@ -126,38 +182,13 @@ class DistroAbstractionLayer:
         return self._create_command(command, param)
 
     def get_groups_on_server(self):
-        command = 'cat /etc/group'
-        output = None
-        if self._connection:
-            output = self._connection.run(command, hide=True).stdout
-        else:
-            output = Run(command.split(' '), stdout=subprocess.PIPE).stdout.decode('utf-8')
-        return [group.split(':')[0] for group in output.split('\n')]
+        return self.run_queries([self.groups_query()])[0]
 
     def encrypt_password(self, password):
-        input_command = f'''python3 -c "from crypt import crypt; import re; print(crypt('{password}').replace('$',r'$'))"'''
-        if self._connection:
-            return self._connection.run(input_command, hide=True).stdout.rstrip()
-        else:
-            return lambda: Run(input_command.split(' '), stdout=subprocess.PIPE).stdout.decode('utf-8').rstrip()
+        return self.run_queries([self.encrypt_password_query(password)])[0]
 
     def get_program_path(self, program):
-        input_command = f'which {program}'
-        if self._connection:
-            command = lambda input_command: self._connection.run(input_command, hide=True).stdout
-        else:
-            command = lambda input_command: Run(input_command.split(' '), stdout=subprocess.PIPE).stdout.decode('utf-8')
-        try:
-            output = command(input_command)
-            if output.startswith('which:'):
-                output = ''
-            else:
-                output = output.rstrip()
-        except UnexpectedExit as exception:
-            result = exception.result
-            if result.return_code == 1:
-                output = result.stdout
-        return output if output != '' else None
+        return self.run_queries([self.program_path_query(program)])[0]
 
     def _create_command(self, command, param=None):
         d_map = self.distro_map[self.distro.lower()]
@@ -0,0 +1,158 @@
+"""
+    Works out why a step failed, and whether trying it again is likely to help.
+
+        lock        something else holds the package manager (or /etc/passwd). Waiting usually fixes it
+        network     the mirror timed out, a name didn't resolve, the ssh connection dropped. Also usually passes
+        auth        a password or key was refused. Trying again won't change that
+        permanent   anything else (a package that doesn't exist, a script that exits 1). Trying again won't help
+
+    Only lock and network failures are retried, with exponential backoff and jitter (see retry_delay)
+"""
+import random
+import re
+import socket
+
+from invoke import exceptions as invoke_exceptions
+from paramiko import ssh_exception
+
+LOCK = 'lock'
+NETWORK = 'network'
+AUTH = 'auth'
+PERMANENT = 'permanent'
+TRANSIENT = (LOCK, NETWORK)
+
+# Step types that run the package manager. None is an undo (removing a package)
+PACKAGE_STEPS = ('install', 'update', 'upgrade', None)
+
+# What each package manager prints when it is the problem, by distro family
+PACKAGE_MANAGER_PATTERNS = {
+    'debian': {
+        LOCK: [
+            r'Could not get lock',
+            r'Unable to acquire the dpkg frontend lock',
+            r'Unable to lock the administration directory',
+            r'is another process using it\?',
+        ],
+        NETWORK: [
+            r'Temporary failure resolving',
+            r'Failed to fetch',
+            r'Could not connect to',
+            r'Unable to connect to',
+            r'Some index files failed to download',
+            r'Hash Sum mismatch',
+        ],
+    },
+    'red hat': {
+        LOCK: [
+            r'Another app is currently holding the yum lock',
+            r'Waiting for process with pid \d+ to finish',
+            r'Existing lock /var/run/yum\.pid',
+        ],
+        NETWORK: [
+            r'Cannot find a valid baseurl',
+            r'Curl error',
+            r'Failed to download metadata',
+            r'Cannot download repomd\.xml',
+            r'Timeout was reached',
+            r'No more mirrors to try',
+        ],
+    },
+    'arch': {
+        LOCK: [
+            r'unable to lock database',
+            r'could not lock database',
+        ],
+        NETWORK: [
+            r'failed retrieving file',
+            r'failed to synchronize',
+            r'download library error',
+        ],
+    },
+}
+
+# What can go wrong on any step
+STEP_PATTERNS = {
+    'user': {
+        LOCK: [r'cannot lock /etc/(passwd|group|shadow|gshadow)', r'try again later'],
+    },
+}
+COMMON_PATTERNS = {
+    NETWORK: [
+        r'Could not resolve host',
+        r'Temporary failure in name resolution',
+        r'Connection timed out',
+        r'Connection reset by peer',
+        r'Network is unreachable',
+    ],
+    AUTH: [
+        r'Sorry, try again',
+        r'incorrect password attempt',
+        r'is not in the sudoers file',
+    ],
+}
+
+# failure class: (how many times to try again, first delay, longest delay) in seconds.
+# unattended-upgrades can sit on the dpkg lock for several minutes, so locks get more patience than the network
+RETRY_POLICY = {
+    LOCK: (6, 5, 60),
+    NETWORK: (4, 2, 30),
+}
+
+
+def _patterns(family, step_type):
+    patterns = {}
+    sources = [STEP_PATTERNS.get(step_type, {}), COMMON_PATTERNS]
+    if step_type in PACKAGE_STEPS:
+        sources.insert(0, PACKAGE_MANAGER_PATTERNS.get(family, {}))
+    for source in sources:
+        for failure_class, expressions in source.items():
+            patterns.setdefault(failure_class, []).extend(expressions)
+    return patterns
+
+
+def classify_output(output, family=None, step_type=None):
+    """
+        Returns the failure class that output (what a failed command printed) points to
+    """
+    # Locks first. A package manager waiting on a lock can time out on the network as well
+    patterns = _patterns(family, step_type)
+    for failure_class in (LOCK, AUTH, NETWORK):
+        for expression in patterns.get(failure_class, []):
+            if re.search(expression, output, re.IGNORECASE):
+                return failure_class
+    return PERMANENT
+
+
+def classify(exception, family=None, step_type=None):
+    """
+        Returns the failure class of exception, raised while running a step_type step on a family
+        (debian, red hat, arch) server
+    """
+    if isinstance(exception, (invoke_exceptions.AuthFailure, ssh_exception.AuthenticationException, ssh_exception.BadHostKeyException)):
+        return AUTH
+    if isinstance(exception, invoke_exceptions.CommandTimedOut):
+        # Timeouts are a limit somebody chose, not something to work around
+        return PERMANENT
+    result = getattr(exception, 'result', None)
+    if result is not None:
+        return classify_output(f'{result.stdout}\n{result.stderr}', family, step_type)
+    if isinstance(exception, (socket.gaierror, socket.timeout, EOFError, ConnectionError, ssh_exception.SSHException, ssh_exception.NoValidConnectionsError)):
+        return NETWORK
+    if isinstance(exception, OSError) and 'Socket is closed' in f'{exception}':
+        return NETWORK
+    return classify_output(f'{exception}', family, step_type)
+
+
+def retry_delay(failure_class, attempt, retries=None):
+    """
+        Returns how long to wait before trying again after attempt (0 for the first retry) failed with
+        failure_class, or None if we shouldn't. retries overrides how many times each class is retried
+    """
+    if failure_class not in RETRY_POLICY.keys():
+        return None
+    limit, first_delay, longest_delay = RETRY_POLICY[failure_class]
+    limit = limit if retries is None else retries
+    if attempt >= limit:
+        return None
+    # Full jitter, so a fleet that failed together doesn't come back together
+    return random.uniform(first_delay / 2, min(longest_delay, first_delay * 2 ** attempt))
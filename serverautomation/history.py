@@ -0,0 +1,110 @@
+import json
+import os
+import os.path
+import threading
+import datetime
+
+try:
+    # We prefer using this, but if we are being called directly, this import fails
+    from serverautomation.messages import print
+except ImportError:
+    from messages import print
+
+
+class StepHistory:
+    """
+        Remembers how long steps took, per host class, distro and step type, so we can guess how long
+        the next run will take (and which hosts to start first).
+
+        Durations are kept as an exponentially weighted average, so a few slow mirrors don't haunt us forever
+    """
+    # How much weight the newest duration gets
+    SMOOTHING = 0.3
+    UNKNOWN_DISTRO = 'unknown'
+
+    def __init__(self, history_file):
+        self._history_file = history_file
+        self._lock = threading.Lock()
+        self._durations = {}
+        self._hosts = {}
+        self.__load()
+
+    def __load(self):
+        if not os.path.exists(self._history_file):
+            return
+        try:
+            with open(self._history_file) as history_data:
+                history = json.load(history_data)
+            self._durations = history.get('durations', {})
+            self._hosts = history.get('hosts', {})
+        except (ValueError, OSError) as exception:
+            print(f'Unable to read step history {self._history_file}. Starting fresh ({exception})')
+
+    def save(self):
+        with self._lock:
+            history = dict(durations=self._durations, hosts=self._hosts)
+            # Write then rename so a crash (or another run) never leaves us with half a file
+            tmp_file = f'{self._history_file}.{os.getpid()}.tmp'
+            with open(tmp_file, 'w') as history_data:
+                json.dump(history, history_data)
+            os.replace(tmp_file, self._history_file)
+
+    def _average(self, previous, seconds):
+        if previous is None:
+            return seconds
+        return (1 - self.SMOOTHING) * previous + self.SMOOTHING * seconds
+
+    def remember_distro(self, hostname, distro):
+        with self._lock:
+            self._hosts[hostname] = distro.lower()
+
+    def known_distro(self, hostname):
+        return self._hosts.get(hostname, self.UNKNOWN_DISTRO)
+
+    def record(self, host_class, distro, step_type, step_name, seconds):
+        with self._lock:
+            step_types = self._durations.setdefault(host_class, {}).setdefault(distro.lower(), {})
+            entry = step_types.setdefault(step_type, dict(average=None, count=0, steps={}))
+            entry['average'] = self._average(entry['average'], seconds)
+            entry['count'] += 1
+            if step_name:
+                entry['steps'][step_name] = self._average(entry['steps'].get(step_name), seconds)
+
+    def estimate(self, host_class, distro, step_type, step_name=None):
+        """
+            Returns how long we expect the step to take in seconds, or None if we have never seen anything like it.
+            We fall back from the exact step, to its step type on this host class and distro, to its step type anywhere
+        """
+        with self._lock:
+            entry = self._durations.get(host_class, {}).get(distro.lower(), {}).get(step_type)
+            if entry:
+                if step_name and step_name in entry['steps'].keys():
+                    return entry['steps'][step_name]
+                return entry['average']
+            averages = [
+                step_types[step_type]['average']
+                for distros in self._durations.values()
+                for step_types in distros.values()
+                if step_type in step_types.keys()
+            ]
+            if averages:
+                return sum(averages) / len(averages)
+            return None
+
+    def estimate_all(self, host_class, distro, configs):
+        """
+            Returns the total expected seconds for configs, and how many of them we had nothing to go on for
+        """
+        total = 0
+        unknown = 0
+        for config in configs:
+            expected = self.estimate(host_class, distro, config.step_type, config.step_name)
+            if expected is None:
+                unknown += 1
+            else:
+                total += expected
+        return total, unknown
+
+
+def format_duration(seconds):
+    return str(datetime.timedelta(seconds=int(seconds)))
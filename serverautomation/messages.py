@@ -0,0 +1,96 @@
+"""
+    Where the messages of a setup go. The command line prints them, but api.setup can give every setup somewhere
+    of its own to send them (a logger, or nowhere at all), even with several running side by side.
+
+    Every module that says something during a setup prints through print from here instead of the builtin one.
+    It is the builtin print, unless the thread printing belongs to a setup that was given its own Messages.
+    Threads a setup starts take that along if they are started with inherit
+"""
+import builtins
+import contextlib
+import functools
+import sys
+import threading
+
+_current = threading.local()
+
+
+class Messages:
+    """
+        A file like object that hands every line written to it (without the newline) to write_line.
+        A write_line of None drops them all
+    """
+    def __init__(self, write_line=None):
+        self._write_line = write_line
+        self._buffer = ''
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        with self._lock:
+            lines = (self._buffer + text).split('\n')
+            self._buffer = lines.pop()
+        if self._write_line:
+            for line in lines:
+                self._write_line(line)
+        return len(text)
+
+    def flush(self):
+        with self._lock:
+            line, self._buffer = self._buffer, ''
+        if line and self._write_line:
+            self._write_line(line)
+
+    def isatty(self):
+        return False
+
+
+def current():
+    """
+        The Messages this thread's setup was given, or None if it prints like anything else
+    """
+    return getattr(_current, 'messages', None)
+
+
+def stdout():
+    return current() or sys.stdout
+
+
+def stderr():
+    return current() or sys.stderr
+
+
+@contextlib.contextmanager
+def redirect(messages):
+    """
+        Sends what this thread prints (through print here, stdout and stderr) to messages until we leave.
+        None leaves things as they are
+    """
+    previous = current()
+    _current.messages = messages if messages else previous
+    try:
+        yield
+    finally:
+        _current.messages = previous
+        if messages:
+            messages.flush()
+
+
+def inherit(target):
+    """
+        Wraps the target of a thread about to be started, so it prints wherever the thread starting it does
+    """
+    messages = current()
+    if messages is None:
+        return target
+
+    @functools.wraps(target)
+    def run(*args, **kwargs):
+        with redirect(messages):
+            return target(*args, **kwargs)
+    return run
+
+
+def print(*args, **kwargs):
+    if kwargs.get('file') is None and current() is not None:
+        kwargs['file'] = current()
+    builtins.print(*args, **kwargs)
@@ -0,0 +1,239 @@
+"""
+    Picks the fastest package mirror for a server, from the server itself.
+
+    Give a server a list of candidate mirrors (server_configuration.mirrors) and, before anything touches the package
+    manager, it downloads the same small piece of repository metadata from every candidate (and from the mirror it
+    already uses) at once. How long the first byte took and how fast the rest came in tell us how long a typical
+    install would take from each of them, and the package manager is pointed at the fastest.
+
+        debian      the primary apt source (sources.list, sources.list.d/*.list and *.sources) is swapped out
+        red hat     the baseurl of the distro's own yum/dnf repos is swapped out (and their mirrorlist/metalink turned off)
+        arch        the mirror is put at the top of /etc/pacman.d/mirrorlist
+
+    Candidates are the mirror's equivalent of the part of the current url before the release specific bits
+    (http://mirror.example.com/ubuntu, http://mirror.example.com/archlinux, http://mirror.example.com/ for
+    http://mirror.centos.org/$contentdir/...). Whatever we change is backed up first, and restore_command puts it back
+    (at the end of the run, unless keep_mirror says to stay on the faster mirror)
+"""
+import base64
+import json
+import shlex
+
+# Where the original package manager configuration is kept, under its own path, while we have it swapped out
+BACKUP_DIRECTORY = '/var/lib/serverautomation/mirror-backup'
+# How much of each candidate we download, and for how long (in seconds), at most
+PROBE_BYTES = 1 << 20
+PROBE_SECONDS = 5
+# What we expect a run to fetch from the mirror (files, bytes). A mirror is as good as how long that would take from it
+EXPECTED_FILES = 100
+EXPECTED_BYTES = 64 << 20
+FAMILIES = ('debian', 'red hat', 'arch')
+# What makes the package manager forget the metadata it got from the other mirror
+REFRESH_COMMANDS = {'debian': 'apt-get update -qq', 'red hat': 'yum clean metadata -q'}
+
+# Runs on the server as: python3 - family candidates(json) probe_bytes probe_seconds expected_files expected_bytes backup_directory etc
+SELECT_SCRIPT = r'''
+import concurrent.futures, glob, json, os, platform, re, shutil, subprocess, sys, time, urllib.request
+family, candidates = sys.argv[1], json.loads(sys.argv[2])
+probe_bytes, probe_seconds, expected_files, expected_bytes = int(sys.argv[3]), float(sys.argv[4]), int(sys.argv[5]), int(sys.argv[6])
+backup_directory, etc = sys.argv[7], sys.argv[8]
+
+def read(path):
+    with open(path) as source:
+        return source.read()
+
+def debian():
+    entries = []
+    for path in [etc + '/apt/sources.list'] + sorted(glob.glob(etc + '/apt/sources.list.d/*.list')):
+        if os.path.exists(path):
+            for match in re.finditer(r'^[ \t]*deb[ \t]+(?:\[[^\]]*\][ \t]+)?(\S+)[ \t]+(\S+)', read(path), re.M):
+                entries.append((match.group(1), match.group(2)))
+    for path in sorted(glob.glob(etc + '/apt/sources.list.d/*.sources')):
+        for stanza in re.split(r'\n[ \t]*\n', read(path)):
+            uris, suites = re.search(r'^URIs:(.*)$', stanza, re.M), re.search(r'^Suites:(.*)$', stanza, re.M)
+            types = re.search(r'^Types:(.*)$', stanza, re.M)
+            if uris and suites and (not types or 'deb' in types.group(1).split()):
+                entries.extend((uri, suite) for uri in uris.group(1).split() for suite in suites.group(1).split())
+    # The release itself, not its -updates or -security pockets
+    primary = [(uri, suite) for uri, suite in entries if '-' not in suite and '/' not in suite]
+    if not primary:
+        return None
+    current, suite = primary[0][0].rstrip('/'), primary[0][1]
+    files = [path for path in [etc + '/apt/sources.list'] + glob.glob(etc + '/apt/sources.list.d/*.list') + glob.glob(etc + '/apt/sources.list.d/*.sources') if os.path.exists(path)]
+
+    def rewrite(content, mirror):
+        return re.sub(r'(?<!\S)' + re.escape(current) + r'/?(?!\S)', mirror, content)
+    return dict(current=current, probe=lambda mirror: f'{mirror}/dists/{suite}/InRelease', files=files, rewrite=rewrite, refresh=['apt-get', 'update', '-qq'])
+
+def red_hat():
+    variables = dict(basearch=platform.machine(), arch=platform.machine())
+    if os.path.exists(etc + '/os-release'):
+        version = re.search(r'^VERSION_ID="?([^"\n]*)', read(etc + '/os-release'), re.M)
+        variables['releasever'] = version.group(1) if version else ''
+    for path in glob.glob(etc + '/yum/vars/*') + glob.glob(etc + '/dnf/vars/*'):
+        variables[os.path.basename(path)] = read(path).strip()
+    repos = {}
+    for path in sorted(glob.glob(etc + '/yum.repos.d/*.repo')):
+        enabled, baseurl = True, None
+        for line in read(path).splitlines() + ['[end]']:
+            if line.startswith('['):
+                if enabled and baseurl:
+                    repos.setdefault(re.match(r'\w+://[^/]+', baseurl).group(0), []).append((path, baseurl))
+                enabled, baseurl = True, None
+            elif re.match(r'enabled\s*=\s*0', line):
+                enabled = False
+            elif re.match(r'#?baseurl\s*=\s*\w+://', line) and baseurl is None:
+                baseurl = line.split('=', 1)[1].split()[0]
+    if not repos:
+        return None
+    # The distro's own repos are the ones most of them point at
+    group = max(repos.values(), key=len)
+    prefix = os.path.commonprefix([baseurl for _, baseurl in group]).split('$')[0]
+    prefix = prefix[:prefix.rindex('/') + 1]
+    template = group[0][1]
+    for name, value in variables.items():
+        template = template.replace('${' + name + '}', value).replace('$' + name, value)
+    template = template.rstrip('/') + '/repodata/repomd.xml'
+
+    def rewrite(content, mirror):
+        sections = re.split(r'(?m)^(?=\[)', content)
+        for index, section in enumerate(sections):
+            baseurl = re.search(r'(?m)^#?baseurl\s*=\s*(\S+)', section)
+            if not baseurl or not baseurl.group(1).startswith(prefix):
+                continue
+            section = section[:baseurl.start()] + 'baseurl=' + mirror.rstrip('/') + '/' + baseurl.group(1)[len(prefix):] + section[baseurl.end():]
+            # mirrorlist and metalink win over baseurl
+            sections[index] = re.sub(r'(?m)^(mirrorlist|metalink)(\s*=)', r'#\1\2', section)
+        return ''.join(sections)
+
+    def probe(mirror):
+        return template.replace(prefix, mirror.rstrip('/') + '/', 1)
+    return dict(current=prefix.rstrip('/'), probe=probe, files=sorted(set(path for path, _ in group)), rewrite=rewrite, refresh=['yum', 'clean', 'metadata', '-q'], follow=True)
+
+def arch():
+    path = etc + '/pacman.d/mirrorlist'
+    if not os.path.exists(path):
+        return None
+    server = re.search(r'^[ \t]*Server[ \t]*=[ \t]*(\S+)', read(path), re.M)
+    if not server or '/$repo' not in server.group(1):
+        return None
+    template = server.group(1)
+    current = template.split('/$repo')[0]
+
+    def rewrite(content, mirror):
+        return f'# Chosen by serverautomation\nServer = {template.replace(current, mirror, 1)}\n' + content
+    return dict(
+        current=current,
+        probe=lambda mirror: template.replace(current, mirror, 1).replace('$repo', 'core').replace('$arch', platform.machine()) + '/core.db',
+        files=[path], rewrite=rewrite, refresh=None
+    )
+
+def fetch(url, limit, deadline):
+    with urllib.request.urlopen(url, timeout=probe_seconds) as response:
+        first_byte = time.monotonic()
+        content = b''
+        while len(content) < limit and time.monotonic() < deadline:
+            block = response.read(min(1 << 16, limit - len(content)))
+            if not block:
+                break
+            content += block
+        return first_byte, content, time.monotonic()
+
+def measure(mirror):
+    started = time.monotonic()
+    deadline = started + probe_seconds
+    url = layout['probe'](mirror)
+    first_byte, content, finished = fetch(url, probe_bytes, deadline)
+    latency = first_byte - started
+    received, receiving = len(content), finished - first_byte
+    if layout.get('follow'):
+        # repomd.xml is tiny. The package list it points to says a lot more about throughput
+        primary = re.search(rb'<data type="primary">.*?<location href="([^"]+)"', content, re.S)
+        if primary:
+            second_started = time.monotonic()
+            second_first_byte, content, finished = fetch(url.rsplit('repodata/', 1)[0] + primary.group(1).decode(), probe_bytes, deadline)
+            latency = min(latency, second_first_byte - second_started)
+            received, receiving = len(content), finished - second_first_byte
+    throughput = received / max(receiving, 1e-3)
+    return dict(mirror=mirror, latency=latency, throughput=throughput, expected=expected_files * latency + expected_bytes / max(throughput, 1))
+
+layout = {'debian': debian, 'red hat': red_hat, 'arch': arch}[family]()
+if layout is None:
+    print(f'Unable to find the mirror {family} is using. Keeping it')
+    sys.exit(0)
+mirrors = [layout['current']] + [candidate.rstrip('/') for candidate in candidates if candidate.rstrip('/') != layout['current']]
+results = []
+with concurrent.futures.ThreadPoolExecutor(max_workers=len(mirrors)) as executor:
+    for mirror, future in [(mirror, executor.submit(measure, mirror)) for mirror in mirrors]:
+        try:
+            results.append(future.result())
+        except Exception as exception:
+            print(f'{mirror}: unusable ({exception})')
+for result in sorted(results, key=lambda result: result['expected']):
+    print(f"{result['mirror']}: {result['latency'] * 1000:.0f}ms to first byte, {result['throughput'] / (1 << 20):.2f}MB/s")
+if not results:
+    print('No mirror answered. Keeping the current one')
+    sys.exit(0)
+best = min(results, key=lambda result: result['expected'])['mirror']
+if best == layout['current']:
+    print(f'{best} is already the fastest mirror')
+    sys.exit(0)
+previous = {}
+for path in layout['files']:
+    content = read(path)
+    changed = layout['rewrite'](content, best)
+    if changed == content:
+        continue
+    previous[path] = content
+    backup = backup_directory + path
+    if not os.path.exists(backup):
+        os.makedirs(os.path.dirname(backup), exist_ok=True)
+        shutil.copy2(path, backup)
+    with open(path + '.tmp', 'w') as output:
+        output.write(changed)
+    shutil.copymode(path, path + '.tmp')
+    os.replace(path + '.tmp', path)
+if layout['refresh'] and subprocess.run(layout['refresh']).returncode != 0:
+    # Better the slow mirror we had than one the package manager can't use
+    for path, content in previous.items():
+        with open(path, 'w') as output:
+            output.write(content)
+    print(f'The package manager could not use {best}. Keeping {layout["current"]}')
+    sys.exit(0)
+print(f'Switched from {layout["current"]} to {best}')
+'''
+
+
+def candidates_for(mirrors, family):
+    """
+        mirrors is a list of candidates, or a mapping of distro family (debian, red hat, arch) to a list of them
+    """
+    if isinstance(mirrors, dict):
+        mirrors = mirrors.get(family, [])
+    if isinstance(mirrors, str):
+        mirrors = [mirrors]
+    return [mirror for mirror in mirrors if mirror]
+
+
+def select_command(family, candidates, backup_directory=BACKUP_DIRECTORY, etc='/etc'):
+    """
+        The command (to run as root on the server) that points its package manager at the fastest of candidates.
+        etc is where to find the package manager's configuration (mirrorsim points it somewhere else)
+    """
+    if family not in FAMILIES or not candidates:
+        return f'''echo {shlex.quote(f'No mirrors to choose from for {family}')}'''
+    encoded_script = base64.b64encode(SELECT_SCRIPT.encode('utf-8')).decode('ascii')
+    arguments = ' '.join(shlex.quote(f'{argument}') for argument in [
+        family, json.dumps(candidates), PROBE_BYTES, PROBE_SECONDS, EXPECTED_FILES, EXPECTED_BYTES, backup_directory, etc
+    ])
+    # Before the first update there may not be a python3 yet. Then the mirror stays what it was
+    return f'''sh -c {shlex.quote(f'if command -v python3 >/dev/null 2>&1; then echo {encoded_script} | base64 -d | python3 - {arguments}; else echo "python3 is not installed, keeping the current mirror"; fi')}'''
+
+
+def restore_command(family=None, backup_directory=BACKUP_DIRECTORY):
+    """
+        The command (to run as root on the server) that puts back the mirrors select_command replaced. With family,
+        the package manager is refreshed afterwards, so it isn't left with metadata for a mirror it no longer uses
+    """
+    refresh = f' && {REFRESH_COMMANDS[family]}' if family in REFRESH_COMMANDS.keys() else ''
+    return f'''sh -c 'if [ -d {backup_directory} ]; then cp -a {backup_directory}/. / && rm -rf {backup_directory}{refresh}; fi' '''
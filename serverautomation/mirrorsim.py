@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+    Tries out mirror picking (see mirrors.py) on this box, without touching its package manager or the internet.
+
+    A few stand in mirrors are started on 127.0.0.1: the one the "server" is using now (far away, slow to answer), one
+    that is close but has a slow link, one that is close and fast, and one that doesn't answer at all. Then, for every
+    distro family, we make a throwaway /etc with that family's package manager configuration pointing at the current
+    mirror, run the same command a real server would get (select_command) against it, check that the fast mirror won
+    and nothing else was touched, and put the original back with restore_command, the way the end of a run does.
+    The package manager's refresh is a stand in too, so we can also check what happens when it fails.
+    Last, the driver sets up a simulated server (see simulator.py) with mirrors and a reboot, twice, to check that an
+    --incremental rerun with nothing changed doesn't pick a mirror again or reboot.
+
+        python3 -m serverautomation.mirrorsim
+
+    Needs python3, sh and the driver's own dependencies. Prints a line per check, and exits with 1 if any of them failed
+"""
+import argparse
+import http.server
+import logging
+import os
+import shutil
+import socket
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from serverautomation import api, mirrors, simulator
+from serverautomation.history import StepHistory
+
+# What the stand in mirrors send for each kind of metadata, by how the path ends
+PRIMARY = 'repodata/simulated-primary.xml.gz'
+METADATA = {
+    'InRelease': 300 << 10,
+    'repomd.xml': f'<repomd><data type="primary"><location href="{PRIMARY}"/></data></repomd>'.encode('utf-8'),
+    'primary.xml.gz': 1 << 20,
+    'core.db': 200 << 10,
+}
+
+# Stands in for apt-get and yum. Records how it was called, and fails if MIRRORSIM_REFRESH says so
+REFRESH_STAND_IN = '''#!/bin/sh
+echo "$(basename "$0") $*" >> "$MIRRORSIM_LOG"
+[ "$MIRRORSIM_REFRESH" != fail ]
+'''
+
+
+class StandInMirror:
+    """
+        Serves the metadata mirror picking asks for, after delay seconds, at rate bytes a second (0 is unlimited)
+    """
+    def __init__(self, delay, rate):
+        mirror = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                time.sleep(mirror.delay)
+                content = next((content for suffix, content in METADATA.items() if self.path.endswith(suffix)), None)
+                if content is None:
+                    self.send_error(404)
+                    return
+                content = content if isinstance(content, bytes) else os.urandom(content)
+                self.send_response(200)
+                self.send_header('Content-Length', f'{len(content)}')
+                self.end_headers()
+                for start in range(0, len(content), 16 << 10):
+                    self.wfile.write(content[start:start + (16 << 10)])
+                    if mirror.rate:
+                        time.sleep((16 << 10) / mirror.rate)
+
+        self.delay = delay
+        self.rate = rate
+        self._server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        self.url = f'http://127.0.0.1:{self._server.server_address[1]}'
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def unreachable_url():
+    # A port nothing listens on (we just had it, and let it go)
+    with socket.socket() as unused:
+        unused.bind(('127.0.0.1', 0))
+        return f'http://127.0.0.1:{unused.getsockname()[1]}'
+
+
+class Box:
+    """
+        A throwaway /etc (and backup directory) to point mirror picking at
+    """
+    def __init__(self, directory, family):
+        self.family = family
+        self.etc = os.path.join(directory, family.replace(' ', '-'), 'etc')
+        self.backup_directory = os.path.join(directory, family.replace(' ', '-'), 'backup')
+        self.log = os.path.join(directory, family.replace(' ', '-'), 'refresh.log')
+        self.bin = os.path.join(directory, 'bin')
+        self.original = {}
+
+    def write(self, path, content):
+        full_path = os.path.join(self.etc, path)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        with open(full_path, 'w') as output:
+            output.write(content)
+        self.original[path] = content
+
+    def read(self, path):
+        with open(os.path.join(self.etc, path)) as source:
+            return source.read()
+
+    def run(self, command, refresh_fails=False):
+        environment = dict(
+            os.environ,
+            PATH=f'{self.bin}{os.pathsep}{os.environ.get("PATH", "")}',
+            MIRRORSIM_LOG=self.log,
+            MIRRORSIM_REFRESH='fail' if refresh_fails else 'ok'
+        )
+        return subprocess.run(['sh', '-c', command], capture_output=True, text=True, env=environment)
+
+    def select(self, candidates, refresh_fails=False):
+        return self.run(mirrors.select_command(self.family, candidates, self.backup_directory, self.etc), refresh_fails)
+
+    def restore(self):
+        return self.run(mirrors.restore_command(self.family, self.backup_directory))
+
+    def refreshes(self):
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as log:
+            return log.read().splitlines()
+
+    def is_original(self):
+        return all(self.read(path) == content for path, content in self.original.items())
+
+
+class Report:
+    def __init__(self, verbose=False):
+        self.verbose = verbose
+        self.failures = 0
+
+    def output(self, result):
+        if self.verbose:
+            print(result.stdout + result.stderr)
+
+    def check(self, name, passed):
+        print(f'{"ok" if passed else "FAILED"}  {name}')
+        if not passed:
+            self.failures += 1
+
+
+def debian(directory, current, candidates, fast, report):
+    box = Box(directory, 'debian')
+    box.write('apt/sources.list', f'deb {current}/ubuntu jammy main restricted\ndeb {current}/ubuntu/ jammy-updates main\ndeb http://security.ubuntu.com/ubuntu jammy-security main\n')
+    box.write('apt/sources.list.d/ubuntu.sources', f'Types: deb\nURIs: {current}/ubuntu\nSuites: jammy jammy-updates\nComponents: main\n\nTypes: deb\nURIs: http://security.ubuntu.com/ubuntu\nSuites: jammy-security\n')
+    result = box.select(candidates)
+    report.output(result)
+    sources = box.read('apt/sources.list')
+    report.check('debian: switched sources.list to the fast mirror', f'deb {fast}/ubuntu jammy main' in sources and f'deb {fast}/ubuntu jammy-updates main' in sources and current not in sources)
+    report.check('debian: switched the deb822 .sources file too', f'URIs: {fast}/ubuntu\n' in box.read('apt/sources.list.d/ubuntu.sources'))
+    report.check('debian: left the security source alone', 'deb http://security.ubuntu.com/ubuntu jammy-security main' in sources and 'URIs: http://security.ubuntu.com/ubuntu' in box.read('apt/sources.list.d/ubuntu.sources'))
+    report.check('debian: refreshed apt', box.refreshes() == ['apt-get update -qq'])
+    report.check('debian: kept a backup of the originals', os.path.isfile(box.backup_directory + os.path.join(box.etc, 'apt/sources.list')))
+    result = box.restore()
+    report.output(result)
+    report.check('debian: put the originals back (and refreshed apt) at the end of the run', box.is_original() and not os.path.exists(box.backup_directory) and box.refreshes()[-1:] == ['apt-get update -qq'])
+    return box
+
+
+def red_hat(directory, current, candidates, fast, report):
+    box = Box(directory, 'red hat')
+    box.write('os-release', 'NAME="CentOS Stream"\nVERSION_ID="8"\n')
+    box.write('dnf/vars/contentdir', 'centos\n')
+    box.write('yum.repos.d/CentOS-Stream-BaseOS.repo', (
+        f'[baseos]\nname=BaseOS\nmirrorlist=http://mirrorlist.centos.org/?release=$stream&repo=BaseOS\n#baseurl={current}/$contentdir/$releasever-stream/BaseOS/$basearch/os/\nenabled=1\n\n'
+        f'[appstream]\nname=AppStream\nmirrorlist=http://mirrorlist.centos.org/?release=$stream&repo=AppStream\n#baseurl={current}/$contentdir/$releasever-stream/AppStream/$basearch/os/\n'
+    ))
+    box.write('yum.repos.d/epel.repo', '[epel]\nmetalink=https://mirrors.fedoraproject.org/metalink?repo=epel-8\n#baseurl=https://download.example/pub/epel/8/Everything/$basearch\n')
+    result = box.select(candidates)
+    report.output(result)
+    repo = box.read('yum.repos.d/CentOS-Stream-BaseOS.repo')
+    report.check('red hat: switched the baseurl of the distro repos to the fast mirror', repo.count(f'\nbaseurl={fast}/$contentdir/$releasever-stream/') == 2)
+    report.check('red hat: turned their mirrorlist off', repo.count('\n#mirrorlist=') == 2)
+    report.check('red hat: left epel alone', box.read('yum.repos.d/epel.repo') == box.original['yum.repos.d/epel.repo'])
+    report.check('red hat: cleared the yum metadata', box.refreshes() == ['yum clean metadata -q'])
+    result = box.restore()
+    report.output(result)
+    report.check('red hat: put the originals back at the end of the run', box.is_original() and not os.path.exists(box.backup_directory))
+    return box
+
+
+def arch(directory, current, candidates, fast, report):
+    box = Box(directory, 'arch')
+    box.write('pacman.d/mirrorlist', f'## Worldwide\nServer = {current}/archlinux/$repo/os/$arch\n')
+    result = box.select(candidates)
+    report.output(result)
+    mirrorlist = box.read('pacman.d/mirrorlist')
+    report.check('arch: put the fast mirror at the top of the mirrorlist', mirrorlist.split('Server = ')[1].startswith(f'{fast}/archlinux/$repo/os/$arch'))
+    report.check('arch: kept the old mirror below it', f'Server = {current}/archlinux/$repo/os/$arch' in mirrorlist)
+    result = box.restore()
+    report.output(result)
+    report.check('arch: put the original mirrorlist back at the end of the run', box.is_original() and not os.path.exists(box.backup_directory))
+    return box
+
+
+def incremental_rerun(directory, candidates, report):
+    # Rebooting the server drops our connection, which paramiko would complain about
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    profile = simulator.FleetProfile(package_latency=0, reboot_time=0.5)
+    with simulator.Fleet(1, profile) as fleet:
+        config = simulator.host_config(0, fleet.ports[0], users=1, packages=1, reboot=True)
+        config['server_configuration']['mirrors'] = candidates
+        history = StepHistory(os.path.join(directory, 'history.json'))
+        runs = []
+        for incremental in [False, True]:
+            runs.append(api.setup(config, incremental=incremental, history=history, connect_timeout=10, reboot_timeout=30, output=False))
+    first, rerun = runs
+    report.check('the first run picked a mirror and rebooted', first.succeeded and {'mirror', 'reboot'} <= {step.step_type for step in first.steps})
+    report.check('an --incremental rerun with nothing changed does nothing (no mirror picking, no reboot)', rerun.succeeded and not rerun.steps and rerun.skipped)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Try out mirror picking against stand in mirrors on this box')
+    parser.add_argument('-v', '--verbose', help='Print what mirror picking printed', action='store_true')
+    input_args = parser.parse_args()
+    report = Report(input_args.verbose)
+
+    current = StandInMirror(delay=0.3, rate=0)
+    throttled = StandInMirror(delay=0, rate=200 << 10)
+    fast = StandInMirror(delay=0.005, rate=0)
+    unreachable = unreachable_url()
+    print(f'Current mirror {current.url} (slow to answer), candidates {throttled.url} (slow link), {fast.url} (fast), {unreachable} (not answering)')
+    directory = tempfile.mkdtemp(prefix='mirrorsim-')
+    try:
+        os.makedirs(os.path.join(directory, 'bin'))
+        for program in ['apt-get', 'yum']:
+            path = os.path.join(directory, 'bin', program)
+            with open(path, 'w') as stand_in:
+                stand_in.write(REFRESH_STAND_IN)
+            os.chmod(path, 0o755)
+        # The command runs whatever python3 is first on the PATH. Make it this one
+        os.symlink(sys.executable, os.path.join(directory, 'bin', 'python3'))
+
+        box = debian(directory, current.url, [f'{throttled.url}/ubuntu', f'{fast.url}/ubuntu/', f'{unreachable}/ubuntu'], fast.url, report)
+        red_hat(directory, current.url, [f'{throttled.url}/', f'{fast.url}/', f'{unreachable}/'], fast.url, report)
+        arch(directory, current.url, [f'{throttled.url}/archlinux', f'{fast.url}/archlinux', f'{unreachable}/archlinux'], fast.url, report)
+
+        result = box.select([f'{unreachable}/ubuntu'])
+        report.output(result)
+        report.check('a mirror that does not answer is left out, and the current one kept', f'{unreachable}/ubuntu: unusable' in result.stdout and box.is_original() and not os.path.exists(box.backup_directory))
+        result = box.select([f'{fast.url}/ubuntu'], refresh_fails=True)
+        report.output(result)
+        report.check('if apt can not use the fast mirror, the current one is put back', 'could not use' in result.stdout and box.is_original())
+        result = box.run(mirrors.select_command('debian', []))
+        report.check('no candidates leaves the server alone', result.returncode == 0 and box.is_original())
+        incremental_rerun(directory, [f'{fast.url}/ubuntu'], report)
+    finally:
+        for mirror in [current, throttled, fast]:
+            mirror.stop()
+        shutil.rmtree(directory, ignore_errors=True)
+    print(f'{report.failures} check(s) failed' if report.failures else 'Every check passed')
+    sys.exit(1 if report.failures else 0)
+
+
+if __name__ == '__main__':
+    main()
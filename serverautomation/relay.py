@@ -0,0 +1,252 @@
+"""
+    Spreads big scripts across a fleet by having the servers pass them to each other, instead of the controller
+    uploading a copy to every one of them.
+
+    The first few servers (the seeds) get the file from us as usual. Every server that has a verified copy then
+    passes it on to the others, each to a few at a time. Servers that are waiting for the file fetch it from whichever
+    server has a free slot, check it against our hash, and start passing it on themselves, so the number of copies
+    doubles every round. We only ever send about one copy per seed.
+
+    The file goes from server to server over ssh. Each run makes its own key, and a server passing files on lets that
+    key in to its ssh user only to read the files of this run (a forced command, no shell, no forwarding). Fetching
+    servers get the private half, and only trust the host keys we read off the server they fetch from. Everything is
+    started and checked through the ssh connections we already have, and close takes the keys and the copies away again.
+    If a server can't be fetched from, we move on to another one (or, if nobody has the file, upload it ourselves)
+"""
+import collections
+import io
+import os.path
+import posixpath
+import secrets
+import shlex
+import threading
+
+import paramiko
+
+try:
+    # We prefer using this, but if we are being called directly, this import fails
+    from serverautomation.transfer import get_artifact, CHUNK_THRESHOLD
+    from serverautomation.messages import print
+except ImportError:
+    from transfer import get_artifact, CHUNK_THRESHOLD
+    from messages import print
+
+# Under the ssh user's home. Only the ssh user can get into it
+RELAY_DIRECTORY = '.serverautomation-relay'
+# The private half of this run's key, on every server that fetches
+RELAY_KEY = f'{RELAY_DIRECTORY}/relay_key'
+
+# Runs on the server passing files on, for whoever logs in with this run's key. All they get to ask for is a hash
+SERVE_COMMAND = f'exec cat -- {RELAY_DIRECTORY}/${{SSH_ORIGINAL_COMMAND%%[!0-9a-f]*}}'
+KEY_OPTIONS = f'no-port-forwarding,no-X11-forwarding,no-agent-forwarding,no-pty,command="{SERVE_COMMAND}"'
+
+# Runs on the server passing files on as: sh -c AUTHORIZE_SCRIPT relay authorized_key. Prints its host keys
+AUTHORIZE_SCRIPT = '''
+umask 077
+mkdir -p .ssh || exit 1
+# Whatever was last in there shouldn't run into our line
+if [ -s .ssh/authorized_keys ] && [ -n "$(tail -c 1 .ssh/authorized_keys)" ]; then
+    echo >> .ssh/authorized_keys
+fi
+printf '%s\\n' "$1" >> .ssh/authorized_keys && cat /etc/ssh/ssh_host_*_key.pub
+'''
+
+# Runs on the fetching server as: sh -c FETCH_SCRIPT relay known_hosts port user@host sha256 destination
+FETCH_SCRIPT = f'''
+chmod 600 "$HOME/{RELAY_KEY}" || exit 1
+known_hosts="$HOME/{RELAY_DIRECTORY}/known_hosts.$$"
+trap 'rm -f "$known_hosts"' EXIT
+printf '%s\\n' "$1" > "$known_hosts"
+if ssh -i "$HOME/{RELAY_KEY}" -o IdentitiesOnly=yes -o BatchMode=yes -o StrictHostKeyChecking=yes -o UserKnownHostsFile="$known_hosts" \\
+        -o ConnectTimeout=30 -p "$2" "$3" "$4" > "$5.tmp" && printf '%s  %s\\n' "$4" "$5.tmp" | sha256sum -c --status; then
+    mv -f "$5.tmp" "$5"
+else
+    rm -f "$5.tmp"
+    echo "$3 did not send a copy matching $4" >&2
+    exit 1
+fi
+'''
+
+
+class _Source:
+    def __init__(self, host, port, user, known_hosts):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.known_hosts = known_hosts
+        self.active = 0
+        self.failed = False
+
+
+class ArtifactRelay:
+    """
+        Share one of these between every server being set up. seeds is how many copies of each file we upload
+        ourselves, fanout is how many servers each server sends to at once. Files smaller than threshold are
+        just uploaded. port is the ssh port the servers reach each other on, if not the one we use.
+        Call close when everything is done, to take this run's key and copies off the servers
+    """
+    def __init__(self, seeds=2, fanout=2, port=None, threshold=CHUNK_THRESHOLD):
+        if seeds < 1 or fanout < 1:
+            raise ValueError('The relay needs at least 1 seed and a fanout of at least 1')
+        self.seeds = seeds
+        self.fanout = fanout
+        self.port = port
+        self.threshold = threshold
+        key = paramiko.ECDSAKey.generate()
+        private_key = io.StringIO()
+        key.write_private_key(private_key)
+        self._private_key = private_key.getvalue().encode('utf-8')
+        # The comment is how close finds this run's key among everything else in authorized_keys
+        self._comment = f'serverautomation-relay-{secrets.token_hex(8)}'
+        self._authorized_key = f'{KEY_OPTIONS} {key.get_name()} {key.get_base64()} {self._comment}'
+        self._condition = threading.Condition()
+        self._sources = collections.defaultdict(list)
+        self._seeded = collections.defaultdict(int)
+        # Servers getting the file (from anywhere) that will serve it once they have it
+        self._pending = collections.defaultdict(int)
+        # (host, ssh port): connection, for every server we put anything on
+        self._touched = {}
+        # (host, ssh port) of every server that has the private half of this run's key
+        self._keyed = set()
+        # (host, ssh port): known_hosts lines, for every server that lets this run's key in
+        self._servers = {}
+
+    def _claim(self, file_hash):
+        """
+            Returns a source with a free slot, or None if we should upload it ourselves. Waits if neither.
+            Until _done is called, we count as someone who will have the file soon
+        """
+        with self._condition:
+            while True:
+                sources = [source for source in self._sources[file_hash] if not source.failed]
+                available = [source for source in sources if source.active < self.fanout]
+                if available:
+                    source = min(available, key=lambda source: source.active)
+                    source.active += 1
+                    self._pending[file_hash] += 1
+                    return source
+                # Nobody left to fetch from (and nobody about to be) means we have to send another copy after all
+                if self._seeded[file_hash] < self.seeds or (not sources and not self._pending[file_hash]):
+                    self._seeded[file_hash] += 1
+                    self._pending[file_hash] += 1
+                    return None
+                self._condition.wait()
+
+    def _done(self, file_hash):
+        with self._condition:
+            self._pending[file_hash] -= 1
+            self._condition.notify_all()
+
+    def _release(self, file_hash, source, failed=False):
+        with self._condition:
+            source.active -= 1
+            source.failed = source.failed or failed
+            self._condition.notify_all()
+
+    def _prepare(self, server_connection):
+        """
+            Makes the relay directory (only the ssh user can get into it) and remembers to clean up after ourselves
+        """
+        key = (server_connection.host, server_connection.port)
+        with self._condition:
+            if key in self._touched.keys():
+                return
+            self._touched[key] = server_connection
+        server_connection.run(f'''sh -c 'umask 077 && mkdir -p {RELAY_DIRECTORY} && chmod 700 {RELAY_DIRECTORY}' ''', hide=True)
+
+    def _fetch(self, server_connection, source, file_hash, remote_path):
+        self._prepare(server_connection)
+        key = (server_connection.host, server_connection.port)
+        with self._condition:
+            has_key = key in self._keyed
+        if not has_key:
+            server_connection.put(io.BytesIO(self._private_key), RELAY_KEY)
+            with self._condition:
+                self._keyed.add(key)
+        server_connection.run(
+            f'''sh -c {shlex.quote(FETCH_SCRIPT)} relay {shlex.quote(source.known_hosts)} {source.port} {shlex.quote(f'{source.user}@{source.host}')} {file_hash} {shlex.quote(remote_path)}''',
+            hide=True
+        )
+
+    def deliver(self, server_connection, local_path, remote_directory, upload, verbose=False):
+        """
+            Gets local_path into remote_directory on the server, from another server if one has it.
+            upload() is how we send it ourselves (it should raise if that fails). Returns the remote path
+        """
+        artifact = get_artifact(local_path)
+        if artifact.size < self.threshold:
+            return upload()
+        file_hash, _ = artifact.hashes()
+        remote_path = posixpath.join(remote_directory, os.path.basename(local_path))
+        source = self._claim(file_hash)
+        try:
+            while source is not None:
+                try:
+                    if verbose:
+                        print(f'Fetching {local_path} on {server_connection.host} from {source.host}')
+                    self._fetch(server_connection, source, file_hash, remote_path)
+                    self._release(file_hash, source)
+                    break
+                except Exception as exception:
+                    print(f'Unable to fetch {local_path} from {source.host}. Trying somewhere else. {exception}')
+                    self._release(file_hash, source, failed=True)
+                    # Not counting ourselves while we look again, or we could end up waiting on ourselves
+                    self._done(file_hash)
+                    source = self._claim(file_hash)
+            if source is None:
+                if verbose:
+                    print(f'Uploading {local_path} to {server_connection.host}')
+                remote_path = upload()
+            self._serve(server_connection, file_hash, remote_path, verbose)
+        finally:
+            self._done(file_hash)
+        return remote_path
+
+    def _serve(self, server_connection, file_hash, remote_path, verbose=False):
+        host = server_connection.host
+        port = self.port if self.port else server_connection.port
+        with self._condition:
+            known_hosts = self._servers.get((host, server_connection.port))
+        try:
+            self._prepare(server_connection)
+            if known_hosts is None:
+                # Let this run's key in (to read the relay directory and nothing else), and find out what the server's
+                # host keys are, so the servers fetching from it can tell it's really the server we meant
+                host_keys = server_connection.run(f'''sh -c {shlex.quote(AUTHORIZE_SCRIPT)} relay {shlex.quote(self._authorized_key)}''', hide=True).stdout
+                pattern = host if port == 22 else f'[{host}]:{port}'
+                known_hosts = '\n'.join(f'{pattern} {" ".join(line.split()[:2])}' for line in host_keys.splitlines() if len(line.split()) >= 2)
+                if not known_hosts:
+                    raise Exception('Unable to read its host keys')
+            server_connection.run(
+                f'''sh -c {shlex.quote(f'umask 077 && (ln -f {shlex.quote(remote_path)} {RELAY_DIRECTORY}/{file_hash} || cp {shlex.quote(remote_path)} {RELAY_DIRECTORY}/{file_hash})')}''',
+                hide=True
+            )
+        except Exception as exception:
+            # Not being able to pass it on only makes things slower
+            if verbose:
+                print(f'Unable to relay from {host}. {exception}')
+            return
+        with self._condition:
+            self._servers[(host, server_connection.port)] = known_hosts
+            self._sources[file_hash].append(_Source(host, port, server_connection.user, known_hosts))
+            self._condition.notify_all()
+
+    def close(self):
+        """
+            Takes this run's key out of authorized_keys and removes the relay directory (copies and key) everywhere
+        """
+        with self._condition:
+            touched = list(self._touched.values())
+            self._touched.clear()
+            self._keyed.clear()
+            self._servers.clear()
+            self._sources.clear()
+        for server_connection in touched:
+            try:
+                server_connection.run(
+                    f'''sh -c 'rm -rf {RELAY_DIRECTORY}; if [ -f .ssh/authorized_keys ]; then sed -i "/ {self._comment}$/d" .ssh/authorized_keys; fi' ''',
+                    hide=True, warn=True
+                )
+            except Exception:
+                # Gone already (rebooted, or disconnected)
+                print(f'Unable to remove the relay key and copies from {server_connection.host}. Remove ~/{RELAY_DIRECTORY} and the {self._comment} line of ~/.ssh/authorized_keys by hand')
@@ -0,0 +1,59 @@
+import threading
+import contextlib
+
+try:
+    # We prefer using this, but if we are being called directly, this import fails
+    from serverautomation.messages import print
+except ImportError:
+    from messages import print
+
+
+class ResourceLimits:
+    """
+        Caps how many steps may use a named resource (the package mirror, an nfs server, some internal api)
+        at the same time, across every server being set up. A server waiting on a busy resource only holds up
+        itself, everything else keeps going. Resources without a limit are never waited on
+    """
+    def __init__(self, limits=None):
+        self._limits = {}
+        self._semaphores = {}
+        for name, count in (limits if limits else {}).items():
+            self.set_limit(name, count)
+
+    def set_limit(self, name, count):
+        count = int(count)
+        if count < 1:
+            raise ValueError(f'The limit for {name} must be at least 1, not {count}')
+        self._limits[name] = count
+        self._semaphores[name] = threading.BoundedSemaphore(count)
+
+    def limit(self, name):
+        return self._limits.get(name)
+
+    @contextlib.contextmanager
+    def hold(self, resource, waiting_message=None):
+        semaphore = self._semaphores.get(resource) if resource else None
+        if semaphore is None:
+            yield
+            return
+        if not semaphore.acquire(blocking=False):
+            if waiting_message:
+                print(waiting_message)
+            semaphore.acquire()
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+
+def parse_limits(limits):
+    """
+        Turns ['mirror=4', 'nfs=2'] into {'mirror': 4, 'nfs': 2}
+    """
+    parsed = {}
+    for limit in limits if limits else []:
+        name, _, count = limit.partition('=')
+        if not name.strip() or not count.strip().isdigit():
+            raise ValueError(f'Resource limits look like name=count, not {limit}')
+        parsed[name.strip()] = int(count)
+    return parsed
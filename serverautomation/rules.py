@@ -0,0 +1,55 @@
+"""
+    What a configuration has to look like. Configuration (when it parses a file), usersources (for every row) and
+    validation (for --validate) all go by these, so a file --validate passes is a file a run can parse
+"""
+import re
+
+USERNAME_PATTERN = re.compile(r'^[a-z_][a-z0-9_-]*\$?$')
+# What a yes/no setting may be written as, besides an actual boolean. Empty means "use the default"
+BOOLEAN_STRINGS = ['true', 'false', '']
+# How a public key (rather than a path to one) starts
+KEY_TYPES = ('ssh-', 'ecdsa-', 'sk-')
+# User settings that are yes/no
+USER_BOOLEANS = ['system_user', 'install_shell_if_missing']
+
+
+def is_boolean(value):
+    return isinstance(value, bool) or str(value).strip().lower() in BOOLEAN_STRINGS
+
+
+def parse_boolean(value, default=None):
+    """
+        Turns True/False (or 'True'/'false'/'' as strings) into a bool. None and '' give default.
+        Raises ValueError for anything else
+    """
+    if isinstance(value, bool):
+        return value
+    if value is None or str(value).strip() == '':
+        return default
+    if not is_boolean(value):
+        raise ValueError(f'Must be True or False, not {value}')
+    return str(value).strip().lower() == 'true'
+
+
+def parse_script_param(param):
+    """
+        Splits a script parameter (--name=value, -name=value, or --flag) into its name and value. A flag's value is True
+    """
+    name, _, value = param.lstrip('-').partition('=')
+    return name.lower(), value if '=' in param else True
+
+
+def validate_user(user):
+    """
+        Returns a list of problems with a user definition (from the config, or a user source)
+    """
+    errors = []
+    username = user.get('username')
+    if not isinstance(username, str) or not username.strip():
+        errors.append('Missing username')
+    elif not USERNAME_PATTERN.match(username):
+        errors.append(f'{username} is not a valid username')
+    for key in USER_BOOLEANS:
+        if key in user.keys() and user[key] is not None and not is_boolean(user[key]):
+            errors.append(f'{key} must be True or False, not {user[key]}')
+    return errors
@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+"""
+    Keeps logged in, sudo checked ssh sessions open between runs, so the next run against the same server
+    starts on its steps straight away instead of logging in, checking sudo and working out the distro again.
+
+        serverautomation --file server.yaml --keep-sessions
+
+    starts the daemon (if it isn't running already) and runs everything through it. Sessions nobody has used
+    for a while (15 minutes unless --keep-sessions says otherwise) are closed, and the daemon stops itself once
+    it has none left. It only listens on a unix socket in your ~/.serverautomation, readable by you alone.
+
+        python3 -m serverautomation.sessiond --status
+        python3 -m serverautomation.sessiond --stop
+
+    Servers behind a jump host are connected to directly by each run, as before
+"""
+import argparse
+import base64
+import hashlib
+import io
+import json
+import os
+import os.path
+import socket
+import socketserver
+import subprocess
+import sys
+import threading
+import time
+from getpass import getuser
+
+import fabric
+from fabric import Connection
+from invoke import Responder
+from invoke.runners import Result
+import invoke.exceptions as invoke_exceptions
+
+try:
+    # We prefer using this, but if we are being called directly, this import fails
+    from serverautomation.sessionproxy import SUPPORTED
+    from serverautomation.cassette import rebuild_exception
+    from serverautomation import messages
+except ImportError:
+    from sessionproxy import SUPPORTED
+    from cassette import rebuild_exception
+    import messages
+
+SOCKET_PATH = os.path.join('/home', getuser(), '.serverautomation', 'sessiond.sock')
+IDLE_TIMEOUT = 900
+START_TIMEOUT = 10
+
+
+class _Session:
+    def __init__(self, host, user, connect_kwargs, sudopass, fingerprint):
+        # Nobody is typing into the daemon, see Driver.FORWARD_STDIN
+        self.connection = Connection(host=host, user=user, connect_kwargs=connect_kwargs, config=fabric.Config(overrides=dict(run=dict(in_stream=False))))
+        self.sudopass = sudopass
+        self.fingerprint = fingerprint
+        # Set by the driver once it has checked sudo and worked out the distro over this session
+        self.distro = None
+        self.last_used = time.monotonic()
+        self.busy = 0
+        self.lock = threading.Lock()
+
+    def ensure_open(self):
+        with self.lock:
+            if not self.connection.is_connected:
+                self.connection.open()
+
+
+class _StreamForwarder:
+    """
+        Stands in for stdout/stderr of a command, and passes whatever it prints on to the client as it happens
+    """
+    def __init__(self, send, name):
+        self._send = send
+        self._name = name
+
+    def write(self, data):
+        if data:
+            self._send({self._name: data})
+
+    def flush(self):
+        pass
+
+
+class SessionDaemon:
+    class _RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            lock = threading.Lock()
+
+            def send(message):
+                with lock:
+                    self.wfile.write(json.dumps(message).encode('utf-8') + b'\n')
+                    self.wfile.flush()
+
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                message = json.loads(line)
+                try:
+                    send(self.server.daemon.handle(message, send))
+                except Exception as exception:
+                    send(dict(raised=type(exception).__name__, message=f'{exception}'))
+                if message.get('action') == 'stop':
+                    # Only once they have their answer, shutting down takes this thread with it
+                    threading.Thread(target=self.server.daemon.stop).start()
+
+    class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    def __init__(self, socket_path=SOCKET_PATH, idle_timeout=IDLE_TIMEOUT):
+        self.socket_path = socket_path
+        self.idle_timeout = idle_timeout
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self._last_activity = time.monotonic()
+        self._server = None
+
+    def _session(self, request):
+        with self._lock:
+            session = self._sessions.get((request['host'], request['user']))
+            if session is None:
+                raise Exception(f"No session for {request['user']}@{request['host']}. Attach first")
+            session.last_used = self._last_activity = time.monotonic()
+            return session
+
+    def handle(self, request, send):
+        action = request['action']
+        if action == 'attach':
+            return self.attach(request)
+        if action == 'status':
+            with self._lock:
+                return dict(sessions=[
+                    dict(host=host, user=user, distro=session.distro, connected=session.connection.is_connected, idle=int(time.monotonic() - session.last_used))
+                    for (host, user), session in self._sessions.items()
+                ])
+        if action == 'stop':
+            return dict(stopped=True)
+
+        session = self._session(request)
+        if action == 'ready':
+            session.distro = request['distro']
+            return dict(ok=True)
+        if action == 'is_connected':
+            return dict(connected=session.connection.is_connected)
+        if action == 'open':
+            session.ensure_open()
+            return dict(ok=True)
+        if action == 'close':
+            session.connection.client.close()
+            # Fabric holds on to the sftp session of the old transport, make sure put opens a new one
+            session.connection._sftp = None
+            return dict(ok=True)
+        if action in ['run', 'sudo']:
+            return self.run(session, request, send)
+        if action == 'put':
+            session.ensure_open()
+            local = request['local'] if 'local' in request.keys() else io.BytesIO(base64.b64decode(request['data']))
+            session.connection.put(local, request['remote'])
+            return dict(ok=True)
+        raise Exception(f'Unknown action {action}')
+
+    def attach(self, request):
+        """
+            Hands back the warm session for this server (and its distro) if we have one logged in with the same
+            credentials. Otherwise starts a new one, which the driver checks before telling us it is ready
+        """
+        key = (request['host'], request['user'])
+        fingerprint = hashlib.sha256(json.dumps([request.get('connect_kwargs'), request.get('sudopass')], sort_keys=True).encode('utf-8')).hexdigest()
+        with self._lock:
+            self._last_activity = time.monotonic()
+            session = self._sessions.get(key)
+            if session and session.fingerprint == fingerprint and session.distro and session.connection.is_connected:
+                session.last_used = time.monotonic()
+                return dict(warm=True, distro=session.distro)
+            if session:
+                session.connection.close()
+            self._sessions[key] = _Session(request['host'], request['user'], request.get('connect_kwargs') or {}, request.get('sudopass'), fingerprint)
+        return dict(warm=False, distro=None)
+
+    def run(self, session, request, send):
+        with self._lock:
+            session.busy += 1
+        try:
+            session.ensure_open()
+            kwargs = dict(
+                warn=True,
+                hide=False,
+                out_stream=_StreamForwarder(send, 'out'),
+                err_stream=_StreamForwarder(send, 'err'),
+                timeout=request.get('timeout'),
+            )
+            try:
+                if request['action'] == 'sudo':
+                    result = session.connection.sudo(
+                        request['command'],
+                        watchers=[Responder(pattern=r'\[sudo\] password:', response=f'{session.sudopass}\n')],
+                        **kwargs
+                    )
+                else:
+                    result = session.connection.run(request['command'], **kwargs)
+            except Exception as exception:
+                response = dict(raised=type(exception).__name__, message=f'{exception}')
+                failed_result = getattr(exception, 'result', None)
+                if failed_result is not None:
+                    response.update(return_code=failed_result.return_code, stdout=failed_result.stdout, stderr=failed_result.stderr)
+                return response
+            return dict(return_code=result.return_code, stdout=result.stdout, stderr=result.stderr)
+        finally:
+            with self._lock:
+                session.busy -= 1
+                session.last_used = self._last_activity = time.monotonic()
+
+    def _reap(self):
+        while self._server:
+            time.sleep(max(1, min(30, self.idle_timeout / 4)))
+            with self._lock:
+                now = time.monotonic()
+                for key, session in list(self._sessions.items()):
+                    if not session.busy and now - session.last_used > self.idle_timeout:
+                        session.connection.close()
+                        del self._sessions[key]
+                finished = not self._sessions and now - self._last_activity > self.idle_timeout
+            if finished:
+                self.stop()
+
+    def serve(self):
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        # Anyone who can reach the socket can run things as root on every server in it, so it is ours alone
+        previous_umask = os.umask(0o077)
+        try:
+            self._server = SessionDaemon._Server(self.socket_path, SessionDaemon._RequestHandler)
+        finally:
+            os.umask(previous_umask)
+        self._server.daemon = self
+        threading.Thread(target=self._reap, daemon=True).start()
+        self._server.serve_forever()
+
+    def stop(self):
+        server, self._server = self._server, None
+        if server:
+            server.shutdown()
+            server.server_close()
+        with self._lock:
+            for session in self._sessions.values():
+                session.connection.close()
+            self._sessions.clear()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+
+def request(socket_path, message, on_chunk=None):
+    """
+        Sends one request to the daemon and returns its answer. on_chunk(name, data) gets any output along the way
+    """
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        with client.makefile('rwb') as stream:
+            stream.write(json.dumps(message).encode('utf-8') + b'\n')
+            stream.flush()
+            for line in stream:
+                response = json.loads(line)
+                if set(response.keys()) <= {'out', 'err'} and response:
+                    if on_chunk:
+                        for name, data in response.items():
+                            on_chunk(name, data)
+                    continue
+                return response
+    raise ConnectionError('The session daemon hung up')
+
+
+def is_running(socket_path=SOCKET_PATH):
+    try:
+        request(socket_path, dict(action='status'))
+        return True
+    except (OSError, ValueError):
+        return False
+
+
+def ensure_running(socket_path=SOCKET_PATH, idle_timeout=IDLE_TIMEOUT):
+    """
+        Starts the daemon in the background unless it is already running. Returns socket_path
+    """
+    if is_running(socket_path):
+        return socket_path
+    os.makedirs(os.path.dirname(socket_path), exist_ok=True)
+    with open(os.path.join(os.path.dirname(socket_path), 'sessiond.log'), 'a') as log:
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), '--socket', socket_path, '--idle-timeout', f'{int(idle_timeout)}'],
+            stdin=subprocess.DEVNULL, stdout=log, stderr=log, start_new_session=True
+        )
+    deadline = time.monotonic() + START_TIMEOUT
+    while time.monotonic() < deadline:
+        if is_running(socket_path):
+            return socket_path
+        time.sleep(0.1)
+    raise Exception(f'The session daemon did not start. See {os.path.join(os.path.dirname(socket_path), "sessiond.log")}')
+
+
+class _DaemonClient:
+    def __init__(self, connection):
+        self._connection = connection
+
+    def close(self):
+        self._connection._request('close')
+
+    def open_sftp(self):
+        raise NotImplementedError('Sessions held by the session daemon do not hand out sftp channels')
+
+
+class DaemonConnection:
+    """
+        Stands in for a fabric connection, running everything through the session daemon
+    """
+    # Uploads hand the daemon the path, it reads the file itself (see transfer.upload_file)
+    put_by_path = True
+
+    def __init__(self, socket_path, host, user=None, connect_kwargs=None):
+        # Fabric works out the port and the default user the same way the daemon's connection will
+        parsed = Connection(host=host, user=user, connect_kwargs=connect_kwargs)
+        self._socket_path = socket_path
+        self.original_host = host
+        self.host = parsed.host
+        self.port = parsed.port
+        self.user = parsed.user
+        self.connect_kwargs = dict(connect_kwargs) if connect_kwargs else {}
+        self.gateway = None
+        self.transport = None
+        self.client = _DaemonClient(self)
+        self.sudopass = None
+        self._sftp = None
+
+    def _request(self, action, on_chunk=None, **message):
+        response = request(self._socket_path, dict(action=action, host=self.original_host, user=self.user, **message), on_chunk)
+        if 'raised' in response.keys() and 'return_code' not in response.keys():
+            raise rebuild_exception(response, None)
+        return response
+
+    def attach_session(self):
+        """
+            Returns the distro if the daemon already has this server logged in and checked, otherwise None
+        """
+        return self._request('attach', connect_kwargs=self.connect_kwargs, sudopass=self.sudopass).get('distro')
+
+    def session_ready(self, distro):
+        self._request('ready', distro=distro)
+
+    @property
+    def is_connected(self):
+        return self._request('is_connected').get('connected', False)
+
+    def open(self):
+        self._request('open')
+
+    def close(self):
+        self._request('close')
+
+    def _run(self, action, command, hide=None, warn=False, watchers=None, timeout=None, **kwargs):
+        output = dict(out='', err='')
+
+        def on_chunk(name, data):
+            output[name] += data
+            if name == 'out' and hide not in [True, 'both', 'out', 'stdout']:
+                messages.stdout().write(data)
+                messages.stdout().flush()
+            if name == 'err' and hide not in [True, 'both', 'err', 'stderr']:
+                messages.stderr().write(data)
+                messages.stderr().flush()
+            # The sudo prompt is answered by the daemon, the rest (like the stall watchdog) only want to see output
+            for watcher in watchers if watchers else []:
+                watcher.submit(output[name])
+
+        response = self._request(action, on_chunk, command=command, timeout=timeout)
+        result = Result(stdout=response.get('stdout', ''), stderr=response.get('stderr', ''), command=command, exited=response.get('return_code', 0))
+        if 'raised' in response.keys():
+            raise rebuild_exception(response, result, timeout)
+        if result.return_code != 0 and not warn:
+            raise invoke_exceptions.UnexpectedExit(result)
+        return result
+
+    def run(self, command, **kwargs):
+        return self._run('run', command, **kwargs)
+
+    def sudo(self, command, **kwargs):
+        return self._run('sudo', command, **kwargs)
+
+    def put(self, local, remote=None, **kwargs):
+        if isinstance(local, str):
+            self._request('put', local=os.path.abspath(local), remote=remote)
+        else:
+            self._request('put', data=base64.b64encode(local.read()).decode('ascii'), remote=remote)
+
+
+class SessionDaemonClient:
+    """
+        A connection factory (see Driver.connection_factory) handing out sessions held by the daemon
+    """
+    def __init__(self, socket_path=SOCKET_PATH):
+        self.socket_path = socket_path
+
+    def __call__(self, host, user=None, gateway=None, connect_kwargs=None, config=None):
+        if gateway is not None:
+            # The jump host connection lives in this process, so the daemon can't use it
+            return Connection(host=host, user=user, gateway=gateway, connect_kwargs=connect_kwargs, config=config)
+        return DaemonConnection(self.socket_path, host, user, connect_kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Keeps ssh sessions open between serverautomation runs')
+    parser.add_argument('--socket', help=f'Where to listen. Default is {SOCKET_PATH}', default=SOCKET_PATH)
+    parser.add_argument('--idle-timeout', help=f'Close sessions nobody used for this many seconds. Default is {IDLE_TIMEOUT}', type=int, default=IDLE_TIMEOUT)
+    parser.add_argument('--status', help='List the sessions the running daemon holds', action='store_true')
+    parser.add_argument('--stop', help='Stop the running daemon, closing every session', action='store_true')
+    input_args = parser.parse_args()
+    if not SUPPORTED:
+        print('The session daemon needs unix sockets, which this platform does not have')
+        sys.exit(1)
+
+    if input_args.status or input_args.stop:
+        if not is_running(input_args.socket):
+            print('The session daemon is not running')
+            sys.exit(1 if input_args.status else 0)
+        if input_args.stop:
+            request(input_args.socket, dict(action='stop'))
+            print('Stopped the session daemon')
+            return
+        for session in request(input_args.socket, dict(action='status'))['sessions']:
+            state = 'connected' if session['connected'] else 'disconnected'
+            print(f"{session['user']}@{session['host']} ({session['distro'] or 'not checked yet'}, {state}, idle {session['idle']}s)")
+        return
+
+    SessionDaemon(input_args.socket, input_args.idle_timeout).serve()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+    Lets local scripts reuse the driver's already authenticated ssh connection.
+
+    The driver listens on a unix socket (only readable by the current user) and every command a local
+    script sends over it is run on its own channel of the existing connection. No new handshakes, and no
+    passwords on the command line.
+
+    Local scripts receive the socket as --session_socket=/path/to/socket. From python
+
+        from serverautomation.sessionproxy import run_command
+        exit_status, stdout, stderr = run_command(socket_path, 'uname -a')
+
+    or from anything else
+
+        python3 -m serverautomation.sessionproxy --session_socket=/path/to/socket [--sudo] uname -a
+"""
+import argparse
+import json
+import os
+import os.path
+import shutil
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+
+try:
+    # We prefer using this, but if we are being called directly, this import fails
+    from serverautomation import messages
+    from serverautomation.messages import print
+except ImportError:
+    import messages
+    from messages import print
+
+SUPPORTED = hasattr(socket, 'AF_UNIX')
+
+
+class SessionProxy:
+    class _RequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            # A client can send as many commands as it wants over the same socket, one json object per line
+            for line in self.rfile:
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    response = self.server.proxy.run(request['command'], sudo=request.get('sudo', False))
+                except Exception as exception:
+                    response = dict(exit_status=-1, stdout='', stderr=str(exception))
+                self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+                self.wfile.flush()
+
+    class _Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+        daemon_threads = True
+
+    def __init__(self, connection, sudo_watchers=None, verbose=False):
+        """
+            connection needs to be an already connected fabric connection.
+            sudo_watchers is a callable returning fresh watchers that answer the sudo prompt for connection
+        """
+        self._connection = connection
+        self._sudo_watchers = sudo_watchers if sudo_watchers else lambda: []
+        self._verbose = verbose
+        # The handler threads aren't ours to start, so they are told where the setup's messages go
+        self._messages = messages.current()
+        self._directory = None
+        self._server = None
+        self._thread = None
+        self.path = None
+
+    def start(self):
+        self._directory = tempfile.mkdtemp(prefix='serverautomation-')
+        self.path = os.path.join(self._directory, 'session.sock')
+        self._server = SessionProxy._Server(self.path, SessionProxy._RequestHandler)
+        self._server.proxy = self
+        os.chmod(self.path, 0o600)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        if self._verbose:
+            print(f'Sharing ssh session with local scripts over {self.path}')
+        return self.path
+
+    def stop(self):
+        if self._server:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+        if self._directory:
+            shutil.rmtree(self._directory, ignore_errors=True)
+            self._directory = None
+        self.path = None
+
+    def run(self, command, sudo=False):
+        # Fabric opens a new channel on the existing transport for every run/sudo call
+        if self._verbose:
+            with messages.redirect(self._messages):
+                print(f'Running {command} for local script')
+        if sudo:
+            result = self._connection.sudo(command, hide=True, warn=True, watchers=self._sudo_watchers())
+        else:
+            result = self._connection.run(command, hide=True, warn=True)
+        return dict(exit_status=result.return_code, stdout=result.stdout, stderr=result.stderr)
+
+
+class SessionClient:
+    def __init__(self, socket_path):
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.connect(socket_path)
+        self._stream = self._socket.makefile('rwb')
+
+    def run(self, command, sudo=False):
+        self._stream.write(json.dumps(dict(command=command, sudo=sudo)).encode('utf-8') + b'\n')
+        self._stream.flush()
+        response = json.loads(self._stream.readline())
+        return response['exit_status'], response['stdout'], response['stderr']
+
+    def close(self):
+        self._stream.close()
+        self._socket.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def run_command(socket_path, command, sudo=False):
+    with SessionClient(socket_path) as client:
+        return client.run(command, sudo=sudo)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--session_socket', help='The socket the driver passed to your script', required=True)
+    parser.add_argument('--sudo', help='Run the command with sudo', action='store_true')
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    input_args = parser.parse_args()
+    exit_status, stdout, stderr = run_command(input_args.session_socket, ' '.join(input_args.command), sudo=input_args.sudo)
+    sys.stdout.write(stdout)
+    sys.stderr.write(stderr)
+    sys.exit(exit_status)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,625 @@
+#!/usr/bin/env python3
+"""
+    Finds out how the driver holds up against a big fleet, without a big fleet.
+
+    Every simulated server is a paramiko ssh server listening on its own port of 127.0.0.1, running in a
+    separate process so it doesn't muddy the driver's numbers. They answer the commands the driver sends
+    (sudo, which, cat /etc/group, lsb_release, the package managers, reboot, ...) after a configurable delay,
+    through a configurable amount of bandwidth, and fail as often as you tell them to. The driver runs
+    against them exactly as it would against real servers (through serverautomation.api), and once
+    everything is done we report throughput, step and server latency, and what it cost the driver
+
+        python3 -m serverautomation.simulator --hosts 10 100 500 --package-latency 0.5 --failure-rate 0.01
+
+    Simulated servers don't have sftp, so the generated configurations stick to users, dependencies,
+    server configuration and (with --reboot) a reboot. Nothing leaves the box.
+"""
+import argparse
+import base64
+import copy
+import json
+import logging
+import math
+import multiprocessing
+import os
+import random
+import re
+import resource
+import selectors
+import secrets
+import shlex
+import socket
+import sys
+import tempfile
+import threading
+import time
+import uuid
+
+import paramiko
+
+from serverautomation import api
+from serverautomation.history import StepHistory
+from serverautomation.resources import ResourceLimits, parse_limits
+
+SIMULATED_USER = 'simulated'
+SIMULATED_PASSWORD = 'simulated'
+
+SUDO_PATTERN = re.compile(r"^sudo -S -p '([^']*)' (?:-H -u \S+ )?(.*)$", re.DOTALL)
+TIMEOUT_WRAPPER_PATTERN = re.compile(r'^echo \$\$ > \S+; exec timeout -k \d+ \d+ (.*)$', re.DOTALL)
+STATE_WRITE_PATTERN = re.compile(r'echo (\S+) \| base64 -d > (\S+)\.tmp')
+PACKAGE_MANAGERS = ['apt-get', 'yum', 'dnf', 'pacman']
+
+# What each distro answers to the distro layer's probes. None means the probe fails
+DISTROS = {
+    'ubuntu': dict(lsb_release='Ubuntu 22.04.4 LTS', issue='Ubuntu 22.04.4 LTS \\n \\l', redhat_release=None),
+    'debian': dict(lsb_release='Debian GNU/Linux 12 (bookworm)', issue='Debian GNU/Linux 12 \\n \\l', redhat_release=None),
+    'centos': dict(lsb_release=None, issue='\\S', redhat_release='CentOS Linux release 7.9.2009 (Core)'),
+    'fedora': dict(lsb_release=None, issue='\\S', redhat_release='Fedora release 39 (Thirty Nine)'),
+    'arch': dict(lsb_release='Arch Linux', issue='Arch Linux \\r (\\l)', redhat_release=None),
+}
+
+
+class FleetProfile:
+    """
+        How the simulated servers behave. Delays are in seconds and get +/- jitter (a fraction) each time
+    """
+    def __init__(
+            self,
+            latency=0.01,
+            package_latency=0.5,
+            jitter=0.2,
+            bandwidth=0,
+            output_bytes=4096,
+            failure_rate=0.0,
+            connect_failure_rate=0.0,
+            reboot_time=2.0,
+            distros=('ubuntu',),
+            login_key=None
+        ):
+        self.latency = latency
+        self.package_latency = package_latency
+        self.jitter = jitter
+        # Bytes per second each command's output is sent at. 0 means as fast as we can
+        self.bandwidth = bandwidth
+        # How much a package manager prints while it works
+        self.output_bytes = output_bytes
+        # Chance a package manager command fails
+        self.failure_rate = failure_rate
+        # Chance a new connection is dropped before the ssh handshake
+        self.connect_failure_rate = connect_failure_rate
+        self.reboot_time = reboot_time
+        self.distros = list(distros)
+        # The public half (base64) of the only key the servers let in. None means they take SIMULATED_PASSWORD instead
+        self.login_key = login_key
+
+    def delay(self, seconds):
+        if seconds > 0:
+            time.sleep(seconds * random.uniform(1 - self.jitter, 1 + self.jitter))
+
+
+class FleetStats:
+    """
+        Counters the fleet process keeps, and the driver process reads
+    """
+    def __init__(self):
+        self.connections = multiprocessing.Value('i', 0)
+        self.open_connections = multiprocessing.Value('i', 0)
+        self.peak_connections = multiprocessing.Value('i', 0)
+        self.dropped_connections = multiprocessing.Value('i', 0)
+        self.commands = multiprocessing.Value('i', 0)
+
+    def connection_opened(self):
+        with self.connections.get_lock():
+            self.connections.value += 1
+        with self.open_connections.get_lock():
+            self.open_connections.value += 1
+            with self.peak_connections.get_lock():
+                self.peak_connections.value = max(self.peak_connections.value, self.open_connections.value)
+
+    def connection_closed(self):
+        with self.open_connections.get_lock():
+            self.open_connections.value -= 1
+
+    def count(self, counter):
+        with counter.get_lock():
+            counter.value += 1
+
+    def snapshot(self):
+        return dict(
+            connections=self.connections.value,
+            peak_connections=self.peak_connections.value,
+            dropped_connections=self.dropped_connections.value,
+            commands=self.commands.value,
+        )
+
+
+class SimulatedHost:
+    def __init__(self, index, profile, stats):
+        self.index = index
+        self.profile = profile
+        self.stats = stats
+        self.distro = DISTROS[profile.distros[index % len(profile.distros)]]
+        self.down_until = 0
+        self._transports = []
+        self._lock = threading.Lock()
+        self.files = {
+            '/dev/null': '',
+            '/etc/group': 'root:x:0:\nsudo:x:27:\nwheel:x:10:\nusers:x:100:\n',
+            '/etc/issue': self.distro['issue'],
+            '/proc/sys/kernel/random/boot_id': str(uuid.uuid4()),
+        }
+        if self.distro['redhat_release']:
+            self.files['/etc/redhat-release'] = self.distro['redhat_release']
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(128)
+        self.listener.setblocking(False)
+        self.port = self.listener.getsockname()[1]
+
+    @property
+    def is_down(self):
+        return time.monotonic() < self.down_until
+
+    def serve(self, client_socket, host_key):
+        transport = paramiko.Transport(client_socket)
+        transport.add_server_key(host_key)
+        self.stats.connection_opened()
+        with self._lock:
+            self._transports.append(transport)
+        try:
+            transport.start_server(server=_StandIn(self))
+            # The transport runs in its own thread. Wait for it so we know when the connection goes away
+            transport.join()
+        except (paramiko.SSHException, EOFError, OSError):
+            pass
+        finally:
+            transport.close()
+            with self._lock:
+                self._transports.remove(transport)
+            self.stats.connection_closed()
+
+    def reboot(self):
+        # The reboot command gets to answer before the server goes away
+        time.sleep(0.2)
+        self.down_until = time.monotonic() + self.profile.reboot_time
+        self.files['/proc/sys/kernel/random/boot_id'] = str(uuid.uuid4())
+        with self._lock:
+            transports = list(self._transports)
+        for transport in transports:
+            transport.close()
+
+    def execute(self, channel, command):
+        self.stats.count(self.stats.commands)
+        try:
+            channel.settimeout(60)
+            sudo = SUDO_PATTERN.match(command)
+            if sudo:
+                channel.sendall_stderr(sudo.group(1).encode('utf-8'))
+                if self._read_line(channel) != SIMULATED_PASSWORD:
+                    channel.sendall_stderr(b'Sorry, try again.\n')
+                    channel.send_exit_status(1)
+                    return
+                command = sudo.group(2)
+            self.profile.delay(self.profile.latency)
+            return_code, stdout, stderr = self.respond(command)
+            self._send(channel, stdout.encode('utf-8'))
+            if stderr:
+                channel.sendall_stderr(stderr.encode('utf-8'))
+            if sudo:
+                # invoke answers the prompt a second time (with its own sudo.password). On a real server that ends up
+                # in the command's stdin, here we just make sure it arrived before hanging up
+                channel.settimeout(0.5)
+                self._read_line(channel)
+            channel.send_exit_status(return_code)
+        except (OSError, EOFError, paramiko.SSHException):
+            # The driver went away (or we rebooted) mid command
+            pass
+        finally:
+            channel.close()
+
+    def respond(self, command):
+        """
+            Returns (return code, stdout, stderr) for command. Anything we don't know about succeeds quietly
+        """
+        command = command.strip()
+        wrapped = TIMEOUT_WRAPPER_PATTERN.match(command)
+        if wrapped:
+            return self.respond(wrapped.group(1))
+        if command.startswith('sh -c '):
+            return self.respond(shlex.split(command)[2])
+
+        program = command.split(' ')[0]
+        if program in PACKAGE_MANAGERS:
+            self.profile.delay(self.profile.package_latency)
+            output = ''.join(f'Get:{line} http://mirror.simulated/{program} simulated-package [1 kB]\n' for line in range(max(1, self.profile.output_bytes // 64)))
+            if random.random() < self.profile.failure_rate:
+                return 100, output, f'E: Failed to fetch http://mirror.simulated/{program} (simulated failure)\n'
+            return 0, output, ''
+        if program == 'reboot':
+            threading.Thread(target=self.reboot, daemon=True).start()
+            return 0, '', ''
+        if program == 'lsb_release':
+            if self.distro['lsb_release'] is None:
+                return 127, '', 'sh: lsb_release: command not found\n'
+            return 0, f"{self.distro['lsb_release']}\n", ''
+        if program == 'mktemp':
+            template = command.split(' ')[-1]
+            return 0, f"{template.rstrip('X')}{secrets.token_hex(5)}\n", ''
+        if program == 'which':
+            return 0, f"/usr/bin/{command.split(' ')[-1]}\n", ''
+        if program == 'python3' and 'crypt' in command:
+            return 0, '$6$simulated$c2ltdWxhdGVk\n', ''
+        if program == 'cat' and len(command.split(' ')) == 2:
+            path = command.split(' ')[1]
+            if path not in self.files.keys():
+                return 1, '', f'cat: {path}: No such file or directory\n'
+            return 0, self.files[path], ''
+        if program == 'useradd':
+            username = command.split(' ')[-1]
+            self.files['/etc/group'] += f'{username}:x:{1000 + len(self.files["/etc/group"].splitlines())}:\n'
+            return 0, '', ''
+        state_write = STATE_WRITE_PATTERN.search(command)
+        if state_write:
+            self.files[state_write.group(2)] = base64.b64decode(state_write.group(1)).decode('utf-8')
+        return 0, '', ''
+
+    def _read_line(self, channel):
+        line = b''
+        while not line.endswith(b'\n'):
+            try:
+                data = channel.recv(1)
+            except socket.timeout:
+                break
+            if not data:
+                break
+            line += data
+        return line.decode('utf-8').strip()
+
+    def _send(self, channel, data, chunk_size=4096):
+        if not self.profile.bandwidth:
+            channel.sendall(data)
+            return
+        for start in range(0, len(data), chunk_size):
+            chunk = data[start:start + chunk_size]
+            channel.sendall(chunk)
+            time.sleep(len(chunk) / self.profile.bandwidth)
+
+
+class _StandIn(paramiko.ServerInterface):
+    def __init__(self, host):
+        self.host = host
+
+    def get_allowed_auths(self, username):
+        return 'publickey' if self.host.profile.login_key else 'password'
+
+    def check_auth_password(self, username, password):
+        if not self.host.profile.login_key and username == SIMULATED_USER and password == SIMULATED_PASSWORD:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_auth_publickey(self, username, key):
+        if self.host.profile.login_key and username == SIMULATED_USER and key.get_base64() == self.host.profile.login_key:
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+    def check_channel_env_request(self, channel, name, value):
+        return True
+
+    def check_channel_pty_request(self, channel, term, width, height, pixelwidth, pixelheight, modes):
+        return True
+
+    def check_channel_exec_request(self, channel, command):
+        threading.Thread(target=self.host.execute, args=(channel, command.decode('utf-8')), daemon=True).start()
+        return True
+
+
+def _raise_file_limit():
+    # Every server (and every connection to it) is a file descriptor
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def _serve_fleet(host_count, profile, stats, ports, stop):
+    _raise_file_limit()
+    # wait_for_server hangs up as soon as it sees the banner, which paramiko would complain about every time
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    host_key = paramiko.RSAKey.generate(2048)
+    hosts = [SimulatedHost(index, profile, stats) for index in range(host_count)]
+    selector = selectors.DefaultSelector()
+    for host in hosts:
+        selector.register(host.listener, selectors.EVENT_READ, host)
+    ports.send([host.port for host in hosts])
+
+    while not stop.is_set():
+        for key, _ in selector.select(timeout=0.2):
+            host = key.data
+            try:
+                client_socket, _ = host.listener.accept()
+            except BlockingIOError:
+                continue
+            if host.is_down or random.random() < profile.connect_failure_rate:
+                if not host.is_down:
+                    stats.count(stats.dropped_connections)
+                client_socket.close()
+                continue
+            client_socket.setblocking(True)
+            # The handshake is slow, so it can't hold up the accept loop
+            threading.Thread(target=host.serve, args=(client_socket, host_key), daemon=True).start()
+
+
+class Fleet:
+    """
+        Starts host_count simulated servers in their own process. Use it as a context manager
+    """
+    def __init__(self, host_count, profile):
+        self.host_count = host_count
+        self.profile = profile
+        self.stats = FleetStats()
+        self.ports = []
+        self._stop = multiprocessing.Event()
+        self._process = None
+
+    def __enter__(self):
+        receiver, sender = multiprocessing.Pipe(duplex=False)
+        self._process = multiprocessing.Process(
+            target=_serve_fleet,
+            args=(self.host_count, self.profile, self.stats, sender, self._stop),
+            daemon=True
+        )
+        self._process.start()
+        if not receiver.poll(120):
+            self._process.terminate()
+            raise Exception('Simulated fleet did not start')
+        self.ports = receiver.recv()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._process.join(10)
+        if self._process.is_alive():
+            self._process.terminate()
+
+
+class ControllerMonitor:
+    """
+        Samples the driver process while it runs, and keeps the peaks
+    """
+    def __init__(self, interval=0.2):
+        self.interval = interval
+        self.peak_threads = 0
+        self.peak_sockets = 0
+        self.peak_rss = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def sample(self):
+        self.peak_threads = max(self.peak_threads, threading.active_count())
+        sockets = 0
+        for fd in os.listdir('/proc/self/fd'):
+            try:
+                if os.readlink(os.path.join('/proc/self/fd', fd)).startswith('socket:'):
+                    sockets += 1
+            except OSError:
+                pass
+        self.peak_sockets = max(self.peak_sockets, sockets)
+        with open('/proc/self/statm') as statm:
+            self.peak_rss = max(self.peak_rss, int(statm.read().split()[1]) * resource.getpagesize())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def __enter__(self):
+        self.sample()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self.sample()
+
+
+def host_config(index, port, users=5, packages=5, reboot=False, ssh_key=None):
+    """
+        With ssh_key (a path) we log in with that key rather than SIMULATED_PASSWORD. Its password is left to the credentials
+    """
+    server_connection = dict(
+        hostname=f'127.0.0.1:{port}',
+        ssh_user=SIMULATED_USER,
+        elevation_password=SIMULATED_PASSWORD,
+        host_class='simulated'
+    )
+    if ssh_key:
+        server_connection['ssh_key'] = ssh_key
+    else:
+        server_connection['ssh_user_password'] = SIMULATED_PASSWORD
+    return dict(
+        server_connection=server_connection,
+        users=[dict(username=f'simulated{user}', groups=['users'], shell='bash') for user in range(users)],
+        dependencies=[f'package{package}' for package in range(packages)],
+        server_configuration=dict(hostname=f'simulated{index}', update='True', enable_service=['sshd']),
+        configurations=['reboot'] if reboot else [],
+    )
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def simulate(host_count, profile, parallel=None, users=5, packages=5, reboot=False, resource_limits=None, connect_timeout=60, ssh_key_password=None):
+    """
+        Sets up host_count simulated servers and returns what it took, as a dictionary.
+        With ssh_key_password the servers only let in a key protected by it, and the password goes in as a credential
+    """
+    _raise_file_limit()
+    # Rebooting servers drop our connections, which paramiko would complain about every time
+    logging.getLogger('paramiko').setLevel(logging.CRITICAL)
+    parallel = parallel if parallel else host_count
+    step_durations = []
+    retries = []
+    finished_at = {}
+    lock = threading.Lock()
+
+    def on_step(hostname, step):
+        with lock:
+            step_durations.append(step.duration)
+            retries.append(step.retries)
+            finished_at[hostname] = time.monotonic()
+
+    with tempfile.TemporaryDirectory() as history_directory:
+        ssh_key = None
+        if ssh_key_password:
+            ssh_key = os.path.join(history_directory, 'id_rsa')
+            login_key = paramiko.RSAKey.generate(2048)
+            login_key.write_private_key_file(ssh_key, password=ssh_key_password)
+            profile = copy.copy(profile)
+            profile.login_key = login_key.get_base64()
+        with Fleet(host_count, profile) as fleet:
+            configs = [host_config(index, port, users, packages, reboot, ssh_key) for index, port in enumerate(fleet.ports)]
+            history = StepHistory(os.path.join(history_directory, 'history.json'))
+            usage = resource.getrusage(resource.RUSAGE_SELF)
+            started = time.monotonic()
+            with ControllerMonitor() as monitor:
+                results = api.setup_many(
+                    configs,
+                    parallel=parallel,
+                    history=history,
+                    credentials={'ssh_key_password': ssh_key_password} if ssh_key_password else None,
+                    on_step=on_step,
+                    resource_limits=resource_limits,
+                    connect_timeout=connect_timeout,
+                    reboot_timeout=connect_timeout + profile.reboot_time,
+                    # The driver is chatty, and at a few hundred servers the terminal becomes the bottleneck
+                    output=False
+                )
+            wall = time.monotonic() - started
+            finished_usage = resource.getrusage(resource.RUSAGE_SELF)
+            fleet_stats = fleet.stats.snapshot()
+
+    cpu = (finished_usage.ru_utime - usage.ru_utime) + (finished_usage.ru_stime - usage.ru_stime)
+    host_durations = [finished_at[result.hostname] - started for result in results if result.succeeded and result.hostname in finished_at.keys()]
+    errors = {}
+    for result in results:
+        if result.error is not None:
+            errors[type(result.error).__name__] = errors.get(type(result.error).__name__, 0) + 1
+    return dict(
+        hosts=host_count,
+        parallel=parallel,
+        succeeded=len([result for result in results if result.succeeded]),
+        failed=len([result for result in results if not result.succeeded]),
+        errors=errors,
+        wall_seconds=wall,
+        hosts_per_minute=60 * len(host_durations) / wall if wall else 0,
+        steps=len(step_durations),
+        steps_per_second=len(step_durations) / wall if wall else 0,
+        retries=sum(retries),
+        step_p50=percentile(step_durations, 0.5),
+        step_p95=percentile(step_durations, 0.95),
+        step_p99=percentile(step_durations, 0.99),
+        host_p50=percentile(host_durations, 0.5),
+        host_p95=percentile(host_durations, 0.95),
+        host_p99=percentile(host_durations, 0.99),
+        controller_cpu_seconds=cpu,
+        controller_cpu_percent=100 * cpu / wall if wall else 0,
+        controller_peak_rss_mb=monitor.peak_rss / (1024 * 1024),
+        controller_peak_threads=monitor.peak_threads,
+        controller_peak_sockets=monitor.peak_sockets,
+        **fleet_stats
+    )
+
+
+def _format(value):
+    if value is None:
+        return '-'
+    if isinstance(value, float):
+        return f'{value:.2f}'
+    return f'{value}'
+
+
+def print_report(reports):
+    columns = [
+        ('hosts', 'hosts'), ('parallel', 'parallel'), ('succeeded', 'ok'), ('failed', 'failed'), ('wall_seconds', 'wall s'),
+        ('hosts_per_minute', 'hosts/min'), ('steps_per_second', 'steps/s'), ('retries', 'retries'), ('step_p50', 'step p50'), ('step_p95', 'step p95'),
+        ('step_p99', 'step p99'), ('host_p95', 'host p95'), ('host_p99', 'host p99'), ('controller_cpu_percent', 'cpu %'),
+        ('controller_peak_rss_mb', 'rss MB'), ('controller_peak_threads', 'threads'), ('controller_peak_sockets', 'sockets'),
+        ('connections', 'conns'), ('peak_connections', 'peak conns'), ('commands', 'commands'),
+    ]
+    rows = [[title for _, title in columns]] + [[_format(report[key]) for key, _ in columns] for report in reports]
+    widths = [max(len(row[column]) for row in rows) for column in range(len(columns))]
+    for row in rows:
+        print('  '.join(value.rjust(width) for value, width in zip(row, widths)))
+    for report in reports:
+        if report['errors']:
+            print(f"{report['hosts']} hosts: {', '.join(f'{count} {error}' for error, count in report['errors'].items())}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the driver against a simulated fleet and report how it held up')
+    parser.add_argument('--hosts', help='How many simulated servers to set up. Give several to see how things scale. Default is 10 50 100', type=int, nargs='+', default=[10, 50, 100])
+    parser.add_argument('-p', '--parallel', help='How many servers to set up at the same time. Default is all of them', type=int)
+    parser.add_argument('--users', help='Users per server. Default is 5', type=int, default=5)
+    parser.add_argument('--packages', help='Dependencies per server. Default is 5', type=int, default=5)
+    parser.add_argument('--reboot', help='Reboot every server at the end', action='store_true')
+    parser.add_argument('--latency', help='Seconds every command takes. Default is 0.01', type=float, default=0.01)
+    parser.add_argument('--package-latency', help='Extra seconds every package manager command takes. Default is 0.5', type=float, default=0.5)
+    parser.add_argument('--jitter', help='How much (as a fraction) delays vary. Default is 0.2', type=float, default=0.2)
+    parser.add_argument('--bandwidth', help='Bytes per second each command gets to send output at. Default is 0 (unlimited)', type=int, default=0)
+    parser.add_argument('--output-bytes', help='How much package managers print. Default is 4096', type=int, default=4096)
+    parser.add_argument('--failure-rate', help='Chance (0-1) a package manager command fails. Default is 0', type=float, default=0.0)
+    parser.add_argument('--connect-failure-rate', help='Chance (0-1) a new connection is dropped. Default is 0', type=float, default=0.0)
+    parser.add_argument('--reboot-time', help='Seconds a server stays down when rebooted. Default is 2', type=float, default=2.0)
+    parser.add_argument('--distros', help=f"Distros to hand out to the servers, round robin. Options are {', '.join(DISTROS.keys())}. Default is ubuntu", nargs='+', default=['ubuntu'], choices=list(DISTROS.keys()))
+    parser.add_argument('--limit', help='Resource limits, as name=count (see serverautomation --limit)', action='append', default=[])
+    parser.add_argument('--ssh-key-password', help='Log into the servers with an ssh key protected by this password (handed to the driver as a credential) instead of a password')
+    parser.add_argument('--json', help='Print the results as JSON instead of a table', action='store_true')
+    input_args = parser.parse_args()
+
+    profile = FleetProfile(
+        latency=input_args.latency,
+        package_latency=input_args.package_latency,
+        jitter=input_args.jitter,
+        bandwidth=input_args.bandwidth,
+        output_bytes=input_args.output_bytes,
+        failure_rate=input_args.failure_rate,
+        connect_failure_rate=input_args.connect_failure_rate,
+        reboot_time=input_args.reboot_time,
+        distros=input_args.distros
+    )
+    try:
+        resource_limits = ResourceLimits(parse_limits(input_args.limit))
+    except ValueError as exception:
+        parser.error(f'{exception}')
+    reports = []
+    for host_count in input_args.hosts:
+        if not input_args.json:
+            print(f'Simulating {host_count} servers', file=sys.stderr)
+        reports.append(simulate(
+            host_count,
+            profile,
+            parallel=input_args.parallel,
+            users=input_args.users,
+            packages=input_args.packages,
+            reboot=input_args.reboot,
+            resource_limits=resource_limits,
+            ssh_key_password=input_args.ssh_key_password
+        ))
+    if input_args.json:
+        print(json.dumps(reports, indent=4))
+    else:
+        print_report(reports)
+
+
+if __name__ == '__main__':
+    main()
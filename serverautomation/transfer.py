@@ -0,0 +1,290 @@
+"""
+    Uploads files to the server in chunks, over several sftp channels of the same connection at once.
+
+    Every chunk lands in a parts directory next to the destination (named after the file's hash) and is only
+    renamed into place once it is completely written. If the upload breaks, the next attempt (or the next run)
+    checks the parts that are already there and only sends the ones that are missing or don't match.
+    Once every part is there, they are put back together on the server and the result is checked against
+    the hash of the local file before anything gets to run it.
+
+    However many servers a file goes to, it is only read and hashed once. The file is mapped into memory and
+    every upload (to every server, at the same time) reads straight out of that one mapping. Once the run is over
+    (see artifact_scope) the mapping is let go of.
+"""
+import hashlib
+import io
+import mmap
+import os
+import os.path
+import posixpath
+import queue
+import shlex
+import threading
+import contextlib
+import concurrent.futures
+
+try:
+    # We prefer using this, but if we are being called directly, this import fails
+    from serverautomation.messages import print
+except ImportError:
+    from messages import print
+
+CHUNK_SIZE = 8 * 1024 * 1024
+# Files smaller than this go up in one piece (still verified)
+CHUNK_THRESHOLD = 2 * CHUNK_SIZE
+CHANNELS = 4
+CHUNK_RETRIES = 3
+
+
+class UploadFailed(Exception):
+    pass
+
+
+class Artifact:
+    """
+        A local file, mapped into memory once and hashed once (per chunk size).
+        Use get_artifact instead of making these, so everything in the process shares them
+    """
+    def __init__(self, local_path):
+        self.path = local_path
+        with open(local_path, 'rb') as local_file:
+            # Empty files can't be mapped (and there is nothing to share anyway)
+            size = os.fstat(local_file.fileno()).st_size
+            self._map = mmap.mmap(local_file.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        self.view = memoryview(self._map)
+        self.size = len(self.view)
+        self._hashes = {}
+        self._digests = {}
+        self._lock = threading.Lock()
+
+    def chunk_count(self, chunk_size=CHUNK_SIZE):
+        return (self.size + chunk_size - 1) // chunk_size
+
+    def chunk(self, index, chunk_size=CHUNK_SIZE):
+        return self.view[index * chunk_size:(index + 1) * chunk_size]
+
+    def hashes(self, chunk_size=CHUNK_SIZE):
+        """
+            Returns the sha256 of the whole file, and of each chunk_size piece of it, worked out in one pass
+        """
+        with self._lock:
+            if chunk_size not in self._hashes.keys():
+                file_hash = hashlib.sha256()
+                chunk_hashes = []
+                for index in range(self.chunk_count(chunk_size)):
+                    chunk = self.chunk(index, chunk_size)
+                    file_hash.update(chunk)
+                    chunk_hashes.append(hashlib.sha256(chunk).hexdigest())
+                self._hashes[chunk_size] = (file_hash.hexdigest(), chunk_hashes)
+            return self._hashes[chunk_size]
+
+    def reader(self):
+        return ArtifactReader(self.view)
+
+    def digest(self, prefix=b''):
+        """
+            Returns the sha256 of prefix followed by the file. Worked out once per prefix
+        """
+        with self._lock:
+            if prefix not in self._digests.keys():
+                digest = hashlib.sha256(prefix)
+                digest.update(self.view)
+                self._digests[prefix] = digest.hexdigest()
+            return self._digests[prefix]
+
+    def close(self):
+        try:
+            self.view.release()
+            if isinstance(self._map, mmap.mmap):
+                self._map.close()
+        except BufferError:
+            # Something is still reading out of it. The mapping goes away along with the last reference to it
+            pass
+
+
+class ArtifactReader(io.RawIOBase):
+    """
+        A file object reading out of an Artifact's mapping. Each upload gets its own, they all share the data
+    """
+    def __init__(self, view):
+        super().__init__()
+        self._view = view
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = max(0, min(len(buffer), len(self._view) - self._position))
+        buffer[:count] = self._view[self._position:self._position + count]
+        self._position += count
+        return count
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._view)}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+
+_artifacts = {}
+_artifacts_lock = threading.Lock()
+# How many runs (see artifact_scope) are going on
+_scopes = 0
+
+
+def get_artifact(local_path):
+    """
+        Returns the shared Artifact for local_path. If the file changed since it was last mapped, it is mapped again
+    """
+    stat = os.stat(local_path)
+    real_path = os.path.realpath(local_path)
+    key = (real_path, stat.st_size, stat.st_mtime_ns)
+    with _artifacts_lock:
+        artifact = _artifacts.get(key)
+        if artifact is None:
+            # Anything still uploading an older version keeps its own reference
+            for stale in [stale for stale in _artifacts.keys() if stale[0] == real_path]:
+                del _artifacts[stale]
+            artifact = _artifacts[key] = Artifact(local_path)
+    return artifact
+
+
+def _unmap(artifacts):
+    for artifact in artifacts:
+        artifact.close()
+
+
+def release_artifacts():
+    """
+        Unmaps every shared Artifact. Anything asking for one afterwards gets it mapped (and hashed) again
+    """
+    with _artifacts_lock:
+        artifacts = list(_artifacts.values())
+        _artifacts.clear()
+    _unmap(artifacts)
+
+
+@contextlib.contextmanager
+def artifact_scope():
+    """
+        Wrap a run in this. Artifacts stay mapped while any run is going, and are released when the last one finishes
+    """
+    global _scopes
+    with _artifacts_lock:
+        _scopes += 1
+    try:
+        yield
+    finally:
+        artifacts = []
+        with _artifacts_lock:
+            _scopes -= 1
+            if _scopes == 0:
+                artifacts = list(_artifacts.values())
+                _artifacts.clear()
+        _unmap(artifacts)
+
+
+def _remote_hashes(server_connection, pattern):
+    """
+        Returns {remote path: sha256} for everything matching pattern (a shell glob)
+    """
+    output = server_connection.run(f'''sha256sum {pattern} 2>/dev/null''', hide=True, warn=True).stdout
+    hashes = {}
+    for line in output.splitlines():
+        file_hash, _, path = line.partition(' ')
+        if path:
+            hashes[path.lstrip(' *')] = file_hash
+    return hashes
+
+
+def _part_name(index):
+    return f'part-{index:06d}'
+
+
+def _upload_chunk(server_connection, sftp_clients, artifact, parts_directory, index, chunk_size):
+    """
+        Sends one chunk over whichever sftp channel is free (replacing the channel if it broke)
+    """
+    chunk = artifact.chunk(index, chunk_size)
+    remote_part = posixpath.join(parts_directory, _part_name(index))
+    last_exception = None
+    for _ in range(CHUNK_RETRIES):
+        sftp = sftp_clients.get()
+        try:
+            with sftp.open(f'{remote_part}.tmp', 'wb') as remote_file:
+                remote_file.set_pipelined(True)
+                remote_file.write(chunk)
+            sftp.posix_rename(f'{remote_part}.tmp', remote_part)
+            sftp_clients.put(sftp)
+            return
+        except Exception as exception:
+            last_exception = exception
+            try:
+                sftp.close()
+            except Exception:
+                pass
+            sftp_clients.put(server_connection.client.open_sftp())
+    raise UploadFailed(f'Unable to upload chunk {index} of {artifact.path}: {last_exception}')
+
+
+def upload_file(server_connection, local_path, remote_directory, channels=CHANNELS, chunk_size=CHUNK_SIZE, verbose=False):
+    """
+        Uploads local_path into remote_directory (which needs to exist and be writable by the ssh user),
+        and makes sure what arrived matches what we have. Returns the remote path. Raises UploadFailed
+    """
+    remote_path = posixpath.join(remote_directory, os.path.basename(local_path))
+    artifact = get_artifact(local_path)
+    # Hashed once, however many servers are waiting on it
+    file_hash, chunk_hashes = artifact.hashes(chunk_size)
+    parts_directory = posixpath.join(remote_directory, f'.parts-{file_hash}')
+    # Connections that live in another process (see sessiond) read the file themselves, in one go
+    by_path = getattr(server_connection, 'put_by_path', False)
+    chunked = artifact.size >= CHUNK_THRESHOLD and not by_path
+
+    if not chunked:
+        server_connection.put(local_path if by_path else artifact.reader(), remote_path)
+    else:
+        server_connection.run(f'''mkdir -p {shlex.quote(parts_directory)}''', hide=True)
+        uploaded = _remote_hashes(server_connection, f'{shlex.quote(parts_directory)}/part-*')
+        missing = [
+            index for index, chunk_hash in enumerate(chunk_hashes)
+            if uploaded.get(posixpath.join(parts_directory, _part_name(index))) != chunk_hash
+        ]
+        if verbose and len(missing) < len(chunk_hashes):
+            print(f'Resuming upload of {local_path}. {len(chunk_hashes) - len(missing)} of {len(chunk_hashes)} chunks already uploaded')
+        elif verbose:
+            print(f'Uploading {local_path} in {len(chunk_hashes)} chunks')
+
+        if missing:
+            # Each sftp client is its own channel on the one connection, and paramiko sftp clients aren't thread safe,
+            # so every worker takes one out of the queue while it sends a chunk
+            sftp_clients = queue.Queue()
+            for _ in range(min(channels, len(missing))):
+                sftp_clients.put(server_connection.client.open_sftp())
+            try:
+                with concurrent.futures.ThreadPoolExecutor(max_workers=min(channels, len(missing))) as executor:
+                    list(executor.map(
+                        lambda index: _upload_chunk(server_connection, sftp_clients, artifact, parts_directory, index, chunk_size),
+                        missing
+                    ))
+            finally:
+                while not sftp_clients.empty():
+                    sftp_clients.get().close()
+
+        parts = ' '.join(shlex.quote(posixpath.join(parts_directory, _part_name(index))) for index in range(len(chunk_hashes)))
+        server_connection.run(f'''cat {parts} > {shlex.quote(remote_path)}.tmp && mv {shlex.quote(remote_path)}.tmp {shlex.quote(remote_path)}''', hide=True)
+
+    verified = _remote_hashes(server_connection, shlex.quote(remote_path)).get(remote_path) == file_hash
+    if chunked:
+        # Either we are done with the parts, or one of them is bad in a way its own hash didn't catch. Both mean start over
+        server_connection.run(f'''rm -rf {shlex.quote(parts_directory)}''', hide=True, warn=True)
+    if not verified:
+        server_connection.run(f'''rm -f {shlex.quote(remote_path)}''', hide=True, warn=True)
+        raise UploadFailed(f'{remote_path} does not match {local_path} after upload')
+    return remote_path
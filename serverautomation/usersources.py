@@ -0,0 +1,113 @@
+import base64
+import csv
+import re
+
+try:
+    # We prefer using this, but if we are being called directly, this import fails
+    from serverautomation.rules import validate_user
+except ImportError:
+    from rules import validate_user
+
+CSV = ['csv',]
+LDIF = ['ldif',]
+
+# LDIF attribute (lower case) to user key
+LDIF_ATTRIBUTES = {
+    'uid': 'username',
+    'loginshell': 'shell',
+    'homedirectory': 'home_directory',
+    'memberof': 'groups',
+    'sshpublickey': 'ssh_key',
+}
+
+
+def source_format(source, file_format=None):
+    file_format = (file_format if file_format else source.split('.')[-1]).lower()
+    if file_format not in CSV + LDIF:
+        raise Exception(f'Unsupported user source format {file_format}. Supported formats are csv and ldif')
+    return file_format
+
+
+def _read_csv(source):
+    with open(source, newline='') as csv_data:
+        # Line 1 is the header
+        for line_number, row in enumerate(csv.DictReader(csv_data), start=2):
+            yield line_number, {key.strip().lower(): value.strip() for key, value in row.items() if key and value is not None}
+
+
+def _ldif_entry(lines):
+    entry = {}
+    for line in lines:
+        if line.startswith('#') or ':' not in line:
+            continue
+        attribute, _, value = line.partition(':')
+        if value.startswith(':'):
+            value = base64.b64decode(value[1:].strip()).decode('utf-8')
+        else:
+            value = value.strip()
+        key = LDIF_ATTRIBUTES.get(attribute.strip().lower())
+        if not key:
+            continue
+        if key == 'groups':
+            # memberOf is a dn, we only want the group name out of it
+            value = value.split(',')[0].split('=')[-1]
+            entry.setdefault('groups', []).append(value)
+        elif key == 'ssh_key':
+            # A user can have as many sshPublicKey values as they like
+            entry.setdefault('ssh_key', []).append(value)
+        else:
+            entry[key] = value
+    return entry
+
+
+def _read_ldif(source):
+    with open(source) as ldif_data:
+        lines = []
+        entry_line_number = 1
+        for line_number, line in enumerate(ldif_data, start=1):
+            line = line.rstrip('\r\n')
+            if line.startswith(' ') and lines:
+                # Folded line, continues the previous one
+                lines[-1] += line[1:]
+                continue
+            if line.strip() == '':
+                if lines:
+                    entry = _ldif_entry(lines)
+                    if entry:
+                        yield entry_line_number, entry
+                lines = []
+                entry_line_number = line_number + 1
+                continue
+            lines.append(line)
+        if lines:
+            entry = _ldif_entry(lines)
+            if entry:
+                yield entry_line_number, entry
+
+
+def normalize_row(row, defaults=None):
+    user = dict(defaults) if defaults else {}
+    user.update({key: value for key, value in row.items() if value not in [None, '']})
+    groups = user.get('groups')
+    if isinstance(groups, str):
+        user['groups'] = [group.strip() for group in re.split('[;,]', groups) if group.strip()]
+    ssh_key = user.get('ssh_key')
+    if isinstance(ssh_key, str) and ';' in ssh_key:
+        # Keys contain commas and spaces, so multiple keys in one csv column are split on ; only
+        user['ssh_key'] = [key.strip() for key in ssh_key.split(';') if key.strip()]
+    return user
+
+
+def iter_user_rows(source, file_format=None, defaults=None):
+    """
+        Streams users out of a csv (with a header row naming the user keys) or ldif file, one at a time.
+        Yields (line number, user dictionary, list of problems with that user)
+    """
+    reader = _read_csv if source_format(source, file_format) in CSV else _read_ldif
+    for line_number, row in reader(source):
+        user = normalize_row(row, defaults)
+        yield line_number, user, validate_user(user)
+
+
+def count_user_rows(source, file_format=None):
+    return sum(1 for _ in iter_user_rows(source, file_format))
@@ -0,0 +1,335 @@
+import json
+import os
+import os.path
+import shutil
+import platform
+import concurrent.futures
+
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+from getpass import getuser
+
+try:
+    # We prefer using this, but if we are being called directly, this import fails
+    from serverautomation import usersources
+    from serverautomation.mirrors import FAMILIES as MIRROR_FAMILIES
+    from serverautomation.rules import USERNAME_PATTERN, KEY_TYPES, validate_user, parse_script_param, is_boolean
+except ImportError:
+    import usersources
+    from mirrors import FAMILIES as MIRROR_FAMILIES
+    from rules import USERNAME_PATTERN, KEY_TYPES, validate_user, parse_script_param, is_boolean
+
+JSON = ['json',]
+YAML = ['yaml' ,'yml']
+
+TOP_LEVEL_KEYS = ['server_connection', 'users', 'dependencies', 'server_configuration', 'server_config', 'timeouts', 'configurations']
+CONNECTION_KEYS = ['ip_address', 'hostname', 'ssh_user', 'ssh_user_password', 'ssh_key', 'ssh_key_password', 'elevation_password', 'host_class', 'jump_host']
+USER_KEYS = ['username', 'password', 'shell', 'groups', 'system_user', 'ssh_key', 'home_directory', 'install_shell_if_missing']
+USER_SOURCE_KEYS = ['source', 'format', 'chunk_size', 'defaults']
+SERVER_CONFIGURATION_KEYS = ['hostname', 'update', 'upgrade', 'reboot_on_finish', 'reboot', 'enable_service', 'mirrors', 'keep_mirror']
+
+
+class ConfigValidator:
+    """
+        Checks a configuration file without prompting for anything or connecting to anything, and
+        collects every problem it finds instead of stopping at the first one
+    """
+    def __init__(self, input_file):
+        self.input_file = input_file
+        self.errors = []
+        self.warnings = []
+
+    def error(self, path, message):
+        self.errors.append(dict(path=path, message=message))
+
+    def warning(self, path, message):
+        self.warnings.append(dict(path=path, message=message))
+
+    def result(self):
+        return dict(file=self.input_file, valid=len(self.errors) == 0, errors=self.errors, warnings=self.warnings)
+
+    def validate(self):
+        connection_setup = self._load()
+        if connection_setup is None:
+            return self.result()
+        if not isinstance(connection_setup, dict):
+            self.error('', 'Configuration must be a mapping')
+            return self.result()
+
+        for key in connection_setup.keys():
+            if key not in TOP_LEVEL_KEYS:
+                self.warning(key, 'Unknown key. It will be ignored')
+
+        self._validate_connection(connection_setup.get('server_connection'))
+        self._validate_users(connection_setup.get('users'))
+        self._validate_string_list('dependencies', connection_setup.get('dependencies'))
+        server_configuration = connection_setup.get('server_configuration', connection_setup.get('server_config'))
+        self._validate_server_configuration(server_configuration)
+        self._validate_timeouts(connection_setup.get('timeouts'))
+        self._validate_configurations(connection_setup.get('configurations'))
+        return self.result()
+
+    def _load(self):
+        extension = self.input_file.split('.')[-1].lower()
+        try:
+            with open(self.input_file) as config_data:
+                if extension in JSON:
+                    return json.load(config_data)
+                if extension in YAML:
+                    if yaml is None:
+                        self.error('', 'YAML support not found. Unable to read YAML configs')
+                        return None
+                    return yaml.safe_load(config_data)
+        except Exception as exception:
+            # Missing files, bad json and bad yaml all end up here
+            self.error('', f'Unable to load configuration file: {exception}')
+            return None
+        self.error('', f'Unsupported file type .{extension}')
+        return None
+
+    def _validate_connection(self, connection):
+        if connection is None:
+            self.error('server_connection', 'Missing. No IP Address/Hostname provided!')
+            return
+        if not isinstance(connection, dict):
+            self.error('server_connection', 'Must be a mapping')
+            return
+        for key in connection.keys():
+            if key not in CONNECTION_KEYS:
+                self.warning(f'server_connection.{key}', 'Unknown key. It will be ignored')
+        if not connection.get('ip_address') and not connection.get('hostname'):
+            self.error('server_connection', 'No IP Address/Hostname provided!')
+        if connection.get('ssh_key'):
+            if not self._resolve_key(connection['ssh_key'], public=False):
+                self.error('server_connection.ssh_key', f"Unable to find ssh key {connection['ssh_key']}")
+        elif not connection.get('ssh_user'):
+            if not self._resolve_key('default', public=False):
+                self.warning('server_connection', 'No ssh_user or ssh_key provided, and no default key found. A run would prompt for them')
+        if not connection.get('elevation_password'):
+            self.warning('server_connection.elevation_password', 'Not provided. A run would prompt for it')
+
+    def _validate_users(self, users):
+        if users is None:
+            return
+        if not isinstance(users, list):
+            self.error('users', 'Must be a list')
+            return
+        usernames = set()
+        for index, user in enumerate(users):
+            path = f'users[{index}]'
+            if not isinstance(user, dict):
+                self.error(path, 'Must be a mapping')
+                continue
+            if 'source' in user.keys():
+                self._validate_user_source(path, user, usernames)
+                continue
+            for key in user.keys():
+                if key not in USER_KEYS:
+                    self.warning(f'{path}.{key}', 'Unknown key. It will be ignored')
+            # The same checks the parser (and every user source row) goes by
+            errors = validate_user(user)
+            for error in errors:
+                self.error(path, error)
+            username = user.get('username')
+            if not errors and username in usernames:
+                self.error(f'{path}.username', f'{username} is defined more than once')
+            elif not errors:
+                usernames.add(username)
+            groups = user.get('groups')
+            if groups is not None and not isinstance(groups, (list, str)):
+                self.error(f'{path}.groups', 'Must be a list of groups')
+            for key in ['password', 'shell', 'home_directory']:
+                if user.get(key) is not None and not isinstance(user[key], str):
+                    self.error(f'{path}.{key}', 'Must be a string')
+            ssh_key = user.get('ssh_key')
+            if ssh_key:
+                self._validate_user_keys(f'{path}.ssh_key', ssh_key)
+
+    def _validate_user_keys(self, path, ssh_keys):
+        if not isinstance(ssh_keys, (list, str)):
+            self.error(path, 'Must be a key, or a list of keys')
+            return
+        for ssh_key in ssh_keys if isinstance(ssh_keys, list) else [ssh_keys]:
+            if not isinstance(ssh_key, str) or not ssh_key.strip():
+                self.error(path, 'Must be a key, or a list of keys')
+            elif ssh_key.strip().startswith(KEY_TYPES):
+                # A literal public key, nothing to look up
+                continue
+            elif not self._resolve_key(ssh_key.strip(), public=True):
+                self.error(path, f'Unable to find ssh key {ssh_key}')
+
+    def _validate_user_source(self, path, user_source, usernames):
+        for key in user_source.keys():
+            if key not in USER_SOURCE_KEYS:
+                self.warning(f'{path}.{key}', 'Unknown key. It will be ignored')
+        source = user_source['source']
+        try:
+            file_format = usersources.source_format(source, user_source.get('format'))
+        except Exception as exception:
+            self.error(f'{path}.format', f'{exception}')
+            return
+        if not os.path.isfile(source):
+            self.error(f'{path}.source', f'Unable to find user source {source}')
+            return
+        if user_source.get('chunk_size') is not None and (not str(user_source['chunk_size']).isdigit() or int(user_source['chunk_size']) < 1):
+            self.error(f'{path}.chunk_size', f"Must be a positive number, not {user_source['chunk_size']}")
+        try:
+            for line_number, user, errors in usersources.iter_user_rows(source, file_format, user_source.get('defaults')):
+                for error in errors:
+                    self.error(f'{path}.source:{line_number}', error)
+                username = user.get('username')
+                if not errors and username in usernames:
+                    self.error(f'{path}.source:{line_number}', f'{username} is defined more than once')
+                elif not errors:
+                    usernames.add(username)
+        except Exception as exception:
+            self.error(f'{path}.source', f'Unable to read user source: {exception}')
+
+    def _validate_string_list(self, path, values):
+        if values is None:
+            return
+        if not isinstance(values, list):
+            self.error(path, 'Must be a list')
+            return
+        for index, value in enumerate(values):
+            if not isinstance(value, str) or not value.strip():
+                self.error(f'{path}[{index}]', 'Must be a non empty string')
+
+    def _validate_server_configuration(self, server_configuration):
+        if server_configuration is None:
+            return
+        if not isinstance(server_configuration, dict):
+            self.error('server_configuration', 'Must be a mapping')
+            return
+        for key, value in server_configuration.items():
+            if key not in SERVER_CONFIGURATION_KEYS:
+                self.warning(f'server_configuration.{key}', 'Not a built in command. It will only run if the distro layer knows it')
+        if 'enable_service' in server_configuration.keys():
+            self._validate_string_list('server_configuration.enable_service', server_configuration['enable_service'])
+        if 'mirrors' in server_configuration.keys():
+            self._validate_mirrors(server_configuration['mirrors'])
+        if 'keep_mirror' in server_configuration.keys() and not is_boolean(server_configuration['keep_mirror']):
+            self.error('server_configuration.keep_mirror', f"Must be True or False, not {server_configuration['keep_mirror']}")
+
+    def _validate_mirrors(self, mirrors):
+        candidates = {'server_configuration.mirrors': mirrors}
+        if isinstance(mirrors, dict):
+            candidates = {}
+            for family, family_mirrors in mirrors.items():
+                if family not in MIRROR_FAMILIES:
+                    self.error(f'server_configuration.mirrors.{family}', f'Must be one of {", ".join(MIRROR_FAMILIES)}')
+                    continue
+                candidates[f'server_configuration.mirrors.{family}'] = family_mirrors
+        for path, family_mirrors in candidates.items():
+            self._validate_string_list(path, family_mirrors)
+            if not isinstance(family_mirrors, list):
+                continue
+            for index, mirror in enumerate(family_mirrors):
+                if isinstance(mirror, str) and mirror.strip() and not mirror.startswith(('http://', 'https://')):
+                    self.error(f'{path}[{index}]', 'Must be an http:// or https:// url')
+
+    def _validate_timeouts(self, timeouts):
+        if timeouts is None:
+            return
+        if not isinstance(timeouts, dict):
+            self.error('timeouts', 'Must be a mapping of step type to seconds')
+            return
+        for step_type, seconds in timeouts.items():
+            if not self._is_seconds(seconds):
+                self.error(f'timeouts.{step_type}', f'Must be a number of seconds, not {seconds}')
+
+    def _validate_configurations(self, configurations):
+        if configurations is None:
+            return
+        if not isinstance(configurations, list):
+            self.error('configurations', 'Must be a list')
+            return
+        for index, script in enumerate(configurations):
+            path = f'configurations[{index}]'
+            if not isinstance(script, str) or not script.strip():
+                self.error(path, 'Must be a non empty string')
+                continue
+            if script.strip().lower() == 'reboot':
+                continue
+            split_script = [part for part in script.split(' ') if part and not part.isspace()]
+            script_path = split_script[0]
+            params = {}
+            for param in split_script[1:]:
+                name, value = parse_script_param(param)
+                params[name] = value
+            if 'local' in params.keys():
+                if not os.path.exists(script_path) and not shutil.which(script_path):
+                    self.error(path, f'Unable to find local script {script_path}')
+            elif not os.path.isfile(script_path):
+                self.error(path, f'Unable to find script {script_path} to copy to the server')
+            if 'runas' in params.keys():
+                if params['runas'] is True or not USERNAME_PATTERN.match(params['runas']):
+                    self.error(path, f'--runAs needs a valid username, not {params["runas"]}')
+            for name in ['timeout', 'stall_timeout']:
+                if name in params.keys() and not self._is_seconds(params[name]):
+                    self.error(path, f'--{name} must be a number of seconds, not {params[name]}')
+            if params.get('resource') is True or params.get('resource') == '':
+                self.error(path, '--resource needs the name of the resource the script uses')
+
+    def _is_seconds(self, seconds):
+        if isinstance(seconds, bool):
+            return False
+        try:
+            return float(seconds) >= 0
+        except (TypeError, ValueError):
+            return False
+
+    def _resolve_key(self, ssh_key, public):
+        """
+            Mirrors how Configuration looks up ssh keys: 'default', a bare key name in the running user's .ssh
+            directory, or a path
+        """
+        ssh_directory = os.path.join('C:\\', 'Users', getuser(), '.ssh') if platform.system() == 'Windows' else os.path.join('/home', getuser(), '.ssh')
+        suffix = '.pub' if public else ''
+        if ssh_key.lower() == 'default':
+            return os.path.exists(os.path.join(ssh_directory, f'id_rsa{suffix}'))
+        if '/' not in ssh_key and '\\' not in ssh_key:
+            return os.path.exists(os.path.join(ssh_directory, f'{ssh_key}{suffix}')) or os.path.exists(ssh_key)
+        return os.path.exists(ssh_key)
+
+
+def validate_file(input_file):
+    return ConfigValidator(input_file).validate()
+
+
+def find_config_files(paths):
+    config_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, files in os.walk(path):
+                config_files.extend(
+                    os.path.join(directory, file) for file in sorted(files) if file.split('.')[-1].lower() in JSON + YAML
+                )
+        else:
+            config_files.append(path)
+    return config_files
+
+
+def validate_files(paths, workers=None):
+    """
+        Validates every config file in paths (directories are searched) across a process pool.
+        Returns a summary dictionary, with results only for the files that have something to report
+    """
+    config_files = find_config_files(paths)
+    workers = workers if workers else os.cpu_count()
+    results = []
+    if workers <= 1 or len(config_files) <= 1:
+        results = [validate_file(config_file) for config_file in config_files]
+    else:
+        # Each file is cheap to check, so hand them out in batches to keep the pool overhead down
+        chunksize = max(1, len(config_files) // (workers * 4))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(validate_file, config_files, chunksize=chunksize))
+    return dict(
+        files=len(config_files),
+        invalid=len([result for result in results if not result['valid']]),
+        results=[result for result in results if result['errors'] or result['warnings']]
+    )